@@ -0,0 +1,49 @@
+import click as cli
+import h5py
+
+from pathlib import Path
+
+from preprocess.index import DatasetIndex
+from preprocess.layout import storage_options
+from preprocess.sdf import SDF_DTYPES, add_sdf
+
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
+@cli.argument("vdir", type=cli.Path(exists=True, resolve_path=True, path_type=Path, file_okay=False))
+@cli.option("--band", "-b", default=None, type=cli.FloatRange(min=0, min_open=True),
+            help="Clip signed distances to that many meters around the surface.")
+@cli.option("--dtype", "-t", default="float16", type=cli.Choice(SDF_DTYPES),
+            help="Type signed distances are stored as, `int8` maps the band to [-127, 127] (needs `--band`).")
+@cli.option("--compression", "-z", default=None,
+            help="Compression filter of grid datasets (gzip, lzf, or the ID of a registered filter).")
+@cli.option("--compression-opts", "compression_opts", default=None, type=int,
+            help="Options of the compression filter (e.g. gzip level).")
+@cli.option("--shuffle/--no-shuffle", default=False, help="Whether to apply the shuffle filter to grid datasets.")
+def add_sdfs(vdir, band, dtype, compression, compression_opts, shuffle):
+    """
+    Add the signed distance to the ground truth surface of pre-processed files, in
+    place, computed from their grids. It's stored in `GroundTruthSDF`, in the same
+    layout as `GroundTruth`.
+
+    \b
+    VDIR    DIR    Directory of pre-processed files.
+    """
+    if dtype == "int8" and band is None:
+        raise cli.BadParameter("Signed distances can only be quantized to int8 within a band.",
+                               param_hint="'--band'")
+    storage = storage_options(compression=compression, compression_opts=compression_opts,
+                              shuffle=shuffle)
+    del storage["layout"] # Follow the ground truth one
+    index = DatasetIndex(vdir)
+    for hname in sorted(vdir.glob("*.h5")):
+        print(f"Adding signed distances to {hname.name}. . .")
+        with h5py.File(hname, 'a') as hdf:
+            add_sdf(hdf, band, dtype, storage)
+        if hname.stem in index:
+            index.update(hname)
+
+
+
+if __name__ == "__main__":
+    add_sdfs()
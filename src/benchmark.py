@@ -0,0 +1,160 @@
+"""
+Benchmark of the pre-processing hot paths on synthetic data, runs anywhere.
+"""
+
+import click as cli
+import h5py
+import json
+import numpy as np
+import platform
+import sys
+import time
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from preprocess.dicoms import get_frames
+from preprocess.layout import GridWriter
+from preprocess.meshes import VOXELIZERS, voxelize_frames
+from preprocess.plyio import PlyCache, load_mesh
+from preprocess.sequence import MeshSequence
+from utils.synthetic import array_source, rv_sequence, volume_info, write_plys
+
+
+
+def _best_time(func, repeat):
+    """ Fastest of `repeat` runs, the others being slowed down by something else """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_voxelization(tmpdir, resolutions, size, nbf, repeat):
+    results = []
+    for res in resolutions:
+        vinfo = volume_info(size, res, angle=0.3)
+        center = vinfo["VolumeInfo"]["directions"].sum(axis=0) / 2
+        fnames = write_plys(rv_sequence(nbf, size / 5, center), tmpdir.joinpath(f"ply-{res}"))
+        params = { "resolution": res, "shape": vinfo["VolumeInfo"]["shape"].tolist(), "frames": nbf }
+        mesh = load_mesh(fnames[0])
+        for name, voxelizer in VOXELIZERS.items():
+            seconds = _best_time(lambda: voxelizer(vinfo, mesh), repeat)
+            results.append({ "name": f"voxelize/{name}", "params": params, "seconds": seconds })
+        meshes = MeshSequence.from_plys(fnames)
+        seconds = _best_time(lambda: list(voxelize_frames(meshes, vinfo, incremental=True)), repeat)
+        results.append({ "name": "voxelize/incremental", "params": params, "seconds": seconds / nbf })
+        seconds = _best_time(lambda: [load_mesh(f) for f in fnames], repeat)
+        results.append({ "name": "ply/load", "params": params, "seconds": seconds / nbf })
+        cache = PlyCache(tmpdir.joinpath(f"cache-{res}"))
+        for fname in fnames: # Warm it up, only hits are timed
+            load_mesh(fname, cache)
+        seconds = _best_time(lambda: [load_mesh(f, cache) for f in fnames], repeat)
+        results.append({ "name": "ply/load-cached", "params": params, "seconds": seconds / nbf })
+    return results
+
+def bench_hdf(tmpdir, grid_sizes, nbf, repeat):
+    results = []
+    layouts = { "frames": { "layout": "frames" }, "stacked": { "layout": "stacked" },
+                "stacked-gzip": { "layout": "stacked", "compression": "gzip" },
+                "stacked-lzf": { "layout": "stacked", "compression": "lzf", "shuffle": True } }
+    rng = np.random.default_rng(0)
+    for gsize in grid_sizes:
+        params = { "shape": [gsize] * 3, "frames": nbf }
+        # Speckle-like input, and a blob as ground truth
+        inputs = rng.integers(0, 256, size=(nbf, gsize, gsize, gsize), dtype=np.uint8)
+        idx = np.indices((gsize,) * 3) - gsize / 2
+        truth = (idx ** 2).sum(axis=0) < (gsize / 4) ** 2
+        for name, storage in layouts.items():
+            def write():
+                with h5py.File(tmpdir.joinpath("write.h5"), 'w') as hdf:
+                    writer = GridWriter(hdf.create_group("Input"), nbf, **storage)
+                    for i in range(nbf):
+                        writer.write(i, inputs[i])
+                    writer = GridWriter(hdf.create_group("GroundTruth"), nbf, **storage)
+                    for i in range(nbf):
+                        writer.write(i, truth)
+            seconds = _best_time(write, repeat)
+            results.append({ "name": f"hdf/write/{name}", "params": params, "seconds": seconds / nbf })
+        source = array_source(volume_info(gsize * 0.001, 0.001), nbf)
+        def extract():
+            with h5py.File(tmpdir.joinpath("frames.h5"), 'w') as hdf:
+                hdf.create_group("VolumeInfo")
+                get_frames(source, hdf, None, None, tmpdir.joinpath("synthetic", "dicom"))
+        seconds = _best_time(extract, repeat)
+        results.append({ "name": "dicom/get_frames", "params": params, "seconds": seconds / nbf })
+    return results
+
+
+def _key(result):
+    return f"{result['name']} {json.dumps(result['params'], sort_keys=True)}"
+
+def compare_results(baseline, current, tolerance):
+    """ Return the results of `current` slower than `baseline` by more than `tolerance` """
+    reference = { _key(r): r["seconds"] for r in baseline["results"] }
+    regressions = []
+    for result in current["results"]:
+        before = reference.get(_key(result))
+        if before is not None and result["seconds"] > before * (1 + tolerance):
+            regressions.append((result, before))
+    return regressions
+
+
+@cli.group(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
+def benchmark():
+    """ Time voxelization, PLY loading and HDF writes on synthetic acquisitions. """
+
+@benchmark.command()
+@cli.option("--output-filename", "-o", "oname", default="benchmark.json",
+            type=cli.Path(dir_okay=False, resolve_path=True, path_type=Path),
+            help="Where to store results, as JSON.")
+@cli.option("--resolution", "-r", "resolutions", type=cli.FloatRange(min=0, min_open=True),
+            multiple=True, default=[0.002, 0.001], help="Voxel spacing in meter.")
+@cli.option("--size", "-s", default=0.08, type=cli.FloatRange(min=0, min_open=True),
+            help="Size of the voxelized volume in meter.")
+@cli.option("--grid-size", "-g", "grid_sizes", type=cli.IntRange(min=1), multiple=True,
+            default=[64, 128], help="Size of grids written in HDF.")
+@cli.option("--frames", "-f", "nbf", default=20, type=cli.IntRange(min=1),
+            help="Number of frames of synthetic acquisitions.")
+@cli.option("--repeat", "-n", default=3, type=cli.IntRange(min=1),
+            help="Number of runs of each benchmark, the fastest one is kept.")
+def run(oname, resolutions, size, grid_sizes, nbf, repeat):
+    """ Run benchmarks. Timings are in second per frame. """
+    with TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        results = bench_voxelization(tmpdir, resolutions, size, nbf, repeat)
+        results += bench_hdf(tmpdir, grid_sizes, nbf, repeat)
+    out = { "meta": { "python": platform.python_version(), "numpy": np.__version__,
+                      "machine": platform.machine(), "date": time.strftime("%Y-%m-%dT%H:%M:%S") },
+            "results": results }
+    with open(oname, 'w') as fd:
+        json.dump(out, fd, indent=4)
+    for result in results:
+        print(f"{_key(result)}: {result['seconds']:.4f}s")
+
+@benchmark.command()
+@cli.argument("baseline", type=cli.Path(exists=True, dir_okay=False, path_type=Path))
+@cli.argument("current", type=cli.Path(exists=True, dir_okay=False, path_type=Path))
+@cli.option("--tolerance", "-t", default=0.2, type=cli.FloatRange(min=0),
+            help="Relative slow down tolerated before being flagged as a regression.")
+def compare(baseline, current, tolerance):
+    """
+    Flag regressions of CURRENT results against BASELINE ones, exit with an error if
+    there's any.
+    """
+    with open(baseline, 'r') as fd:
+        baseline = json.load(fd)
+    with open(current, 'r') as fd:
+        current = json.load(fd)
+    regressions = compare_results(baseline, current, tolerance)
+    for result, before in regressions:
+        print(f"REGRESSION {_key(result)}: {before:.4f}s -> {result['seconds']:.4f}s")
+    if regressions:
+        sys.exit(1)
+    print("No regression.")
+
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,39 @@
+import click as cli
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from preprocess.index import DatasetIndex, file_entry
+
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
+@cli.argument("vdir", type=cli.Path(exists=True, resolve_path=True, path_type=Path, file_okay=False))
+@cli.option("--force/--no-force", "-f/-F", default=False,
+            help="Index every file again, even those unchanged since they were indexed.")
+@cli.option("--number-workers", "-n", "nb_workers", default=1, type=cli.IntRange(min=1),
+            help="Number of worker reading files (and computing their checksum).")
+def build_index(vdir, force, nb_workers):
+    """
+    Build or refresh the index of pre-processed files, dropping the files that are gone.
+
+    \b
+    VDIR    DIR    Directory of pre-processed files.
+    """
+    index = DatasetIndex(vdir)
+    hnames = sorted(vdir.glob("*.h5"))
+    for patient in set(index.entries) - { hname.stem for hname in hnames }:
+        print(f"Removing {patient}. . .")
+        index.remove(patient)
+    hnames = [hname for hname in hnames if force or not index.uptodate(hname)]
+    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        # Entries are read in parallel, but only this process writes the index
+        for hname, entry in zip(hnames, executor.map(file_entry, hnames)):
+            print(f"Indexing {hname.name}. . .")
+            index.update(hname, entry)
+    print(f"{len(index)} files indexed.")
+
+
+
+if __name__ == "__main__":
+    build_index()
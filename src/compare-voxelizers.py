@@ -0,0 +1,47 @@
+import click as cli
+import h5py
+
+from pathlib import Path
+
+from preprocess.meshes import VOXELIZERS
+from preprocess.plyio import load_mesh
+
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
+@cli.argument("hname", type=cli.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path))
+@cli.argument("plydir", type=cli.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path))
+@cli.option("--voxelizer", "-x", default="scanline", type=cli.Choice(list(VOXELIZERS.keys())),
+            help="Voxelizer to compare against the reference one (`contains`).")
+@cli.option("--frames", "-f", type=cli.IntRange(min=0), multiple=True,
+            help="Frames to compare, all of them if not given.")
+@cli.option("--chunk-size", "-c", default=4096, type=cli.IntRange(min=1),
+            help="Number of voxels tested at once against a mesh.")
+def compare_voxelizers(hname, plydir, voxelizer, frames, chunk_size):
+    """
+    Report the voxel disagreement rate between a voxelizer and `mesh2vox`, on the
+    grid of an already pre-processed file.
+
+    \b
+    HNAME     FILE    Pre-processed file to take the voxel grid (`VolumeInfo`) from.
+    PLYDIR    DIR     Directory of the PLYs of the same acquisition.
+    """
+    with h5py.File(hname, 'r') as hdf:
+        if not frames:
+            frames = range(hdf["FrameInfo"]["frameNumber"][()])
+        total = 0
+        for i in frames:
+            mesh = load_mesh(next(plydir.glob(f"*_{i:03d}.ply")))
+            ref = VOXELIZERS["contains"](hdf, mesh, chunk_size=chunk_size)
+            grid = VOXELIZERS[voxelizer](hdf, mesh, chunk_size=chunk_size)
+            diff = (ref ^ grid).sum()
+            total += diff
+            # Rate is relative to the ventricle size, not to the whole grid
+            print(f"Frame {i:02d}: {diff} voxels disagree "
+                  f"({100 * diff / max(1, (ref | grid).sum()):.3f}% of the ventricle).")
+        print(f"Overall, {total} voxels disagree over {len(frames)} frames.")
+
+
+
+if __name__ == "__main__":
+    compare_voxelizers()
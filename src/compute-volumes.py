@@ -0,0 +1,65 @@
+import click as cli
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from preprocess.index import DatasetIndex
+from preprocess.volumes import SOURCES, indexed_volumes
+
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
+@cli.argument("vdir", type=cli.Path(exists=True, resolve_path=True, path_type=Path, file_okay=False))
+@cli.option("--report-filename", "-r", "rname", default="volumes-report.csv",
+            type=cli.Path(resolve_path=True, path_type=Path),
+            help="Where to store the EDV, ESV and EF of every file, from each source.")
+@cli.option("--tolerance", "-t", default=0.1, type=cli.FloatRange(min=0),
+            help="Relative difference to the CSV volumes above which a file is reported.")
+@cli.option("--number-workers", "-n", "nb_workers", default=1, type=cli.IntRange(min=1),
+            help="Number of worker computing volumes.")
+@cli.option("--save-every", default=100, type=cli.IntRange(min=1),
+            help="Number of files computed between two saves of the index.")
+def compute_volumes(vdir, rname, tolerance, nb_workers, save_every):
+    """
+    Compute the right ventricle volume of each frame of pre-processed files, from
+    their meshes and their ground truth, and the ejection fraction it gives. Results
+    are added to the index, and compared to the AutoRVQ volumes (from the CSVs).
+
+    \b
+    VDIR    DIR    Directory of pre-processed files.
+    """
+    index = DatasetIndex(vdir)
+    hnames = sorted(vdir.glob("*.h5"))
+    uptodate = [index.uptodate(hname) for hname in hnames]
+    rows = []
+    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        # Files are only read by workers (entries and checksums too), results stream back in order
+        results = executor.map(indexed_volumes, hnames, uptodate,
+                               chunksize=max(1, len(hnames) // (8 * nb_workers)))
+        for n, (hname, (entry, result)) in enumerate(zip(hnames, results), 1):
+            if entry is not None: # Results are attached to up to date entries
+                index.update(hname, entry)
+            index.annotate(hname.stem, result)
+            rows.append({ "file": hname.stem, **{ k: v for k, v in result.items()
+                                                  if not k.endswith("Volumes") } })
+            if n % save_every == 0:
+                print(f"{n}/{len(hnames)} files computed.")
+                index.save()
+    index.save()
+    report = pd.DataFrame(rows, columns=["file"] + [f"{k}{s.capitalize()}" for k in ["edv", "esv", "ef"]
+                                                    for s in SOURCES]
+                                        + [f"{s}Error" for s in SOURCES[:2]])
+    report.to_csv(rname, index=False)
+    print(f"Volumes of {len(report)} files computed.")
+    for s in SOURCES[:2]:
+        off = report[report[f"{s}Error"].astype(float) > tolerance]
+        if len(off):
+            print(f"{len(off)} files with {s} volumes more than {tolerance:.0%} away from the CSV ones:")
+        for _, row in off.iterrows():
+            print(f"    {row.file}: {row[f'{s}Error']:.1%}")
+
+
+
+if __name__ == "__main__":
+    compute_volumes()
@@ -0,0 +1,67 @@
+import click as cli
+import h5py
+import os
+
+from pathlib import Path
+
+from preprocess.index import DatasetIndex
+from preprocess.layout import LAYOUTS, GridWriter, Grids, storage_options
+
+
+
+def _convert_group(src, dst, storage):
+    for key in src.keys():
+        if key == "Pyramid": # Same groups for each level
+            for level in src[key].keys():
+                _convert_group(src[key][level], dst.create_group(f"{key}/{level}"), storage)
+        elif key in ["Input", "GroundTruth", "GroundTruthSDF"]:
+            grids = Grids(src[key])
+            group = dst.create_group(key)
+            group.attrs.update(src[key].attrs) # e.g. timings, or how to read distances
+            crop = {} if not grids.cropped else { "offset": grids.offset, "full_shape": grids.shape }
+            writer = GridWriter(group, len(grids), **crop, **storage)
+            for i in range(len(grids)):
+                writer.write(i, grids.crop(i), **grids.attrs(i))
+        else:
+            src.copy(src[key], dst, name=key)
+
+def convert_file(hname, storage):
+    """ Rewrite `hname` grids with the `storage` options, the rest is copied as is """
+    tmpname = hname.with_name(hname.name + ".tmp")
+    with h5py.File(hname, 'r') as src, h5py.File(tmpname, 'w') as dst:
+        _convert_group(src, dst, storage)
+        dst.attrs.update(src.attrs)
+    # Only replace the original once the new one is complete
+    os.replace(tmpname, hname)
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
+@cli.argument("vdir", type=cli.Path(exists=True, resolve_path=True, path_type=Path, file_okay=False))
+@cli.option("--layout", "-l", default="stacked", type=cli.Choice(LAYOUTS),
+            help="Layout to convert grids to.")
+@cli.option("--chunk-shape", "chunks", type=cli.IntRange(min=1), nargs=4, default=None,
+            help="Chunk shape (T, X, Y, Z) of grid datasets.")
+@cli.option("--compression", "-z", default=None,
+            help="Compression filter of grid datasets (gzip, lzf, or the ID of a registered filter).")
+@cli.option("--compression-opts", "compression_opts", default=None, type=int,
+            help="Options of the compression filter (e.g. gzip level).")
+@cli.option("--shuffle/--no-shuffle", default=False, help="Whether to apply the shuffle filter to grid datasets.")
+def convert_layout(vdir, layout, chunks, compression, compression_opts, shuffle):
+    """
+    Migrate pre-processed files, in place, to another grid layout or compression.
+
+    \b
+    VDIR    DIR    Directory of pre-processed files.
+    """
+    storage = storage_options(layout, chunks, compression, compression_opts, shuffle)
+    index = DatasetIndex(vdir)
+    for hname in sorted(vdir.glob("*.h5")):
+        print(f"Converting {hname.name}. . .")
+        convert_file(hname, storage)
+        if hname.stem in index: # Virtual datasets map the old layout
+            index.update(hname)
+
+
+
+if __name__ == "__main__":
+    convert_layout()
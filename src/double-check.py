@@ -0,0 +1,93 @@
+import click as cli
+import h5py
+import pandas as pd
+import yaml
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from preprocess.layout import Grids
+
+
+
+# Kind of data expected in each group, unsigned or signed integers, and boolean
+_KINDS = { "Input": "ui", "GroundTruth": "b" }
+
+
+def check_file(vname, strict=False):
+    """
+    Check a pre-processed file from its metadata only, return the reason why it's
+    incomplete or None. Ground truth emptiness comes from the `voxelCount` attribute
+    of each grid, read from the grid itself for files written before it existed
+    (unless `strict`, then they fail).
+    """
+    try:
+        vox = h5py.File(vname, 'r')
+    except OSError: # File was probably not closed properly or something
+        return "unreadable file"
+    with vox:
+        try:
+            nbf = vox["FrameInfo"]["frameNumber"][()]
+            vshape = tuple(vox["VolumeInfo"]["shape"][()])
+        except KeyError: # If this didn't get store, for sure the file is incomplete
+            return "missing frame number or shape"
+        for key, kinds in _KINDS.items():
+            if key not in vox:
+                return f"missing {key}"
+            grids = Grids(vox[key])
+            for f in range(nbf):
+                if f not in grids: # We're missing at least a grid
+                    return f"missing {key} frame {f}"
+                shape, gtype = grids.meta(f)
+                if tuple(shape) != vshape or gtype.kind not in kinds:
+                    return f"{key} frame {f} is {gtype}{tuple(shape)}, expected shape {vshape}"
+        grids = Grids(vox["GroundTruth"])
+        for f in range(nbf):
+            count = grids.attrs(f).get("voxelCount")
+            if count is None:
+                if strict:
+                    return "no voxel count"
+                count = grids[f].sum()
+            if count == 0: # Ground truth is innexistant or didn't voxelize properly
+                return f"empty GroundTruth frame {f}"
+    return None
+
+
+@cli.command(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
+@cli.argument("vdir", type=cli.Path(exists=True, resolve_path=True, path_type=Path, file_okay=False))
+@cli.option("--output-filename", "-o", "oname", default="processed-files.yml",
+            type=cli.Path(resolve_path=True, path_type=Path),
+            help="Where to store list of properly processed files.")
+@cli.option("--report-filename", "-r", "rname", default="processed-report.csv",
+            type=cli.Path(resolve_path=True, path_type=Path),
+            help="Where to store the status of every file, and why it failed.")
+@cli.option("--number-workers", "-n", "nb_workers", default=1, type=cli.IntRange(min=1),
+            help="Number of worker used to check files.")
+@cli.option("--strict/--no-strict", default=False,
+            help="Fail files processed before voxel counts were stored, instead of reading their ground truth.")
+def check_if_processed(vdir, oname, rname, nb_workers, strict):
+    """
+    In the event of data pre-processing crashing, use this to list successfully
+    processed files.
+
+    \b
+    VDIR    DIR    Directory of pre-processed files.
+    """
+    vnames = sorted(vdir.glob("*.h5"))
+    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        reasons = list(executor.map(check_file, vnames, [strict] * len(vnames)))
+    report = pd.DataFrame({ "file": [vname.stem for vname in vnames],
+                            "status": ["ok" if r is None else "failed" for r in reasons],
+                            "reason": reasons })
+    report.to_csv(rname, index=False)
+    ok_files = report.file[report.status == "ok"].tolist()
+    with open(oname, 'w') as fd:
+        yaml.dump(ok_files, fd, default_flow_style=False, indent=4)
+    print(f"{len(ok_files)}/{len(vnames)} files are complete.")
+    for _, row in report[report.status != "ok"].iterrows():
+        print(f"    {row.file}: {row.reason}")
+
+
+
+if __name__ == "__main__":
+    check_if_processed()
@@ -0,0 +1,51 @@
+"""
+Transform between voxel indices of a grid and world coordinates, computed once per
+acquisition.
+"""
+
+import numpy as np
+
+
+
+class Affine:
+    """
+    Voxel grid of `shape` voxels, starting at `origin`, each step along axis `i`
+    moving by `delta[i]`: `world = idx @ delta + origin`. Points are given as
+    `(..., 3)` arrays.
+    """
+    def __init__(self, origin, delta, shape):
+        self.origin = np.asarray(origin, dtype=float)
+        self.delta = np.asarray(delta, dtype=float)
+        self.shape = np.asarray(shape, dtype=int)
+        self.inv = np.linalg.inv(self.delta)
+
+    @classmethod
+    def from_volume_info(cls, hdf):
+        """ Grid of `hdf["VolumeInfo"]`, `hdf` being an HDF or `meshes.read_volume_info` output """
+        vinfo = hdf["VolumeInfo"]
+        directions = vinfo["directions"][()]
+        # Each row of `directions` is an axis of the grid, scaled to the size of the box
+        delta = directions / np.linalg.norm(directions, axis=1)[:, None] * vinfo["resolution"][()][:, None]
+        return cls(vinfo["origin"][()], delta, vinfo["shape"][()])
+
+    def to_voxel(self, points):
+        """ Continuous voxel indices of world `points` """
+        return (points - self.origin) @ self.inv
+
+    def to_world(self, idx):
+        return idx @ self.delta + self.origin
+
+    def bounds(self, points):
+        """
+        `(2, 3)` lower and upper voxel indices (both included) of the bounding box of
+        world `points`, clipped to the grid
+        """
+        idx = self.to_voxel(points).reshape(-1, 3)
+        lower = np.clip(np.floor(idx.min(axis=0)), 0, self.shape - 1)
+        upper = np.clip(np.ceil(idx.max(axis=0)), 0, self.shape - 1)
+        return np.stack([lower, upper]).astype(int)
+
+    def crop(self, lower, upper):
+        """ Sub-grid from voxel `lower` (included) to `upper` (excluded) """
+        lower = np.asarray(lower)
+        return Affine(self.to_world(lower), self.delta, np.asarray(upper) - lower)
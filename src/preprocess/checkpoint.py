@@ -0,0 +1,65 @@
+"""
+Keep track of what is already stored in an HDF being written, so an interrupted
+pre-processing can be resumed without redoing finished stages and frames.
+"""
+
+import json
+import os
+
+
+
+class Checkpoint:
+    """
+    Completion state of each stage (and each of its frames), saved in the JSON
+    manifest `path`. Only kept in memory if `path` is None.
+    """
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.state = { "stages": [], "frames": {} }
+        if resume and path is not None and path.exists():
+            with open(path, 'r') as fd:
+                self.state = json.load(fd)
+
+    def done(self, stage, frame=None):
+        if frame is None:
+            return stage in self.state["stages"]
+        return frame in self.state["frames"].get(stage, [])
+
+    def frames(self, stage):
+        return list(self.state["frames"].get(stage, []))
+
+    def mark(self, stage, frame=None, hdf=None):
+        """
+        Record `stage` (or only one of its frames) as done. `hdf` is flushed first, so
+        the manifest never claims more than what's on disk.
+        """
+        if frame is None:
+            self.state["stages"].append(stage)
+        else:
+            self.state["frames"].setdefault(stage, []).append(int(frame))
+        if hdf is not None:
+            hdf.flush()
+        self.save()
+
+    def reset(self, stage):
+        """ Forget `stage` and its frames, so it is done again from scratch """
+        if stage in self.state["stages"]:
+            self.state["stages"].remove(stage)
+        self.state["frames"].pop(stage, None)
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        # Write aside then rename, so the manifest is never half written
+        tmpname = self.path.with_name(self.path.name + ".tmp")
+        with open(tmpname, 'w') as fd:
+            json.dump(self.state, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmpname, self.path)
+
+    def clear(self):
+        self.state = { "stages": [], "frames": {} }
+        if self.path is not None and self.path.exists():
+            self.path.unlink()
@@ -2,22 +2,34 @@
 Based on code from Gabriel Kiss 01.2020
 """
 
-import comtypes.client as ccomtypes
 import numpy as np
 import platform
 
-from pathlib import WindowsPath
+from collections import deque
+from pathlib import PureWindowsPath
 from warnings import filterwarnings
 
+from preprocess.affine import Affine
+from preprocess.checkpoint import Checkpoint
+from preprocess.layout import GridWriter, Grids, storage_options
 from preprocess.lookup_table import LUT
-from preprocess.utils import safe2np, frame2arr
+from preprocess.pipeline import run_pipeline
+from preprocess.pyramid import alignment, write_level_info
+from preprocess.sources import HDFLoader
+from preprocess.utils import apply_lut, frame2view, safe2np
+from utils.profiling import NullProfiler
+
+try:
+    import comtypes.client as ccomtypes
+except ImportError: # Not on Windows, only stand-in sources can be used
+    ccomtypes = None
 
 
 
 
 ### Change this according to your system ###
 Image3DAPIWin32 = None
-Image3DAPIx64 = WindowsPath("C:/Users/malou/Documents/dev/Image3dAPI/x64/Image3dAPI.tlb")
+Image3DAPIx64 = PureWindowsPath("C:/Users/malou/Documents/dev/Image3dAPI/x64/Image3dAPI.tlb")
 ############################################
 
 # Silence a warning I can't do anything about
@@ -26,9 +38,27 @@ filterwarnings("ignore", message="A builtin ctypes object gave a PEP3118 format
 # Patch for files that are not fully annotated
 _PROBLEMATIC_CHILDS = { "104001": 19, "110001": 26, "470001": 18, "730001": 25, "920001": 31 }
 
+LOADERS = ["com", "hdf"]
+# File loaders of this process, reused from one file to the next
+_LOADERS = {}
+
 
 
-def get_frames(src, hdf, bbox, max_vshape, fname):
+def get_frames(src, hdf, bbox, max_vshape, fname, storage=None, checkpoint=None, queue_depth=2,
+               profiler=None, bounds=None):
+    """
+    Fetch frames, map them to colors and store them in a pipeline, so COM calls,
+    numpy work and disk writes overlap. COM calls stay on this thread, as COM objects
+    can't be used from another one: only numpy views of the frame buffers go down the
+    pipeline, and frames are released here once mapped. Frames are cropped to
+    `bounds` if given.
+    """
+    if storage is None:
+        storage = storage_options()
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+    if profiler is None:
+        profiler = NullProfiler()
     nbf = src.GetFrameCount() # Number of frames
     if fname.parent.stem in _PROBLEMATIC_CHILDS.keys():
         nbf = _PROBLEMATIC_CHILDS[fname.parent.stem]
@@ -38,41 +68,153 @@ def get_frames(src, hdf, bbox, max_vshape, fname):
         lut = np.array(src.GetColorMap(), dtype=np.uint).astype(np.uint8)
     except AttributeError:
         lut = LUT
-    group = hdf.create_group("/Input")
-    time = []
-    for f in range(nbf):
-        frame = src.GetFrame(f, bbox, max_vshape)
-        arr_frame = lut[frame2arr(frame)]
-        group.create_dataset(f"grid{f:02d}", data=arr_frame)
-        time.append(frame.time)
+    group = hdf.require_group("/Input")
+    # Cropped grids need the full shape, known once the first frame is there
+    writer = None
+    time = np.zeros(nbf)
+    # When resuming, time of frames already there was stored along their grid
+    for f in checkpoint.frames("input"):
+        time[f] = Grids(hdf["Input"]).attrs(f)["time"]
+
+    # Frames whose buffer is still being mapped, and those done with
+    fetched, mapped = {}, deque()
+
+    def fetch():
+        for f in range(nbf):
+            while mapped:
+                del fetched[mapped.popleft()]
+            if not checkpoint.done("input", f):
+                with profiler.stage("get_frame", f):
+                    frame = src.GetFrame(f, bbox, max_vshape)
+                    # Views are only valid as long as their frame, it's kept until mapped
+                    fetched[f] = frame
+                    item = f, frame.time, frame2view(frame)
+                yield item
+
+    # Output buffers are recycled once written, there's at most one per queued frame
+    buffers, scratch = [], None
+
+    def colorize(item):
+        nonlocal scratch
+        f, ftime, view = item
+        with profiler.stage("lut", f):
+            if scratch is None:
+                scratch = np.empty(view.shape[1:], dtype=np.intp)
+            out = buffers.pop() if buffers else np.empty(view.shape, dtype=lut.dtype)
+            out = apply_lut(view, lut, out, scratch)
+        mapped.append(f)
+        return f, ftime, out
+
+    def write(item):
+        nonlocal writer
+        f, ftime, arr_frame = item
+        with profiler.stage("write_input", f):
+            if bounds is None:
+                writer = writer or GridWriter(group, nbf, **storage)
+                writer.write(f, arr_frame, time=ftime)
+            else:
+                writer = writer or GridWriter(group, nbf, offset=bounds[0],
+                                              full_shape=arr_frame.shape, **storage)
+                writer.write(f, arr_frame[tuple(slice(l, u) for l, u in zip(*bounds))], time=ftime)
+        buffers.append(arr_frame)
+        time[f] = ftime
+        checkpoint.mark("input", f, hdf)
+
+    try:
+        stats = run_pipeline(fetch(), [("lut", colorize), ("write", write)], depth=queue_depth,
+                             name="fetch")
+    finally: # Stages are done with them, release the last ones here too
+        fetched.clear()
+    # Keep track of the bottleneck
+    for sname, s in stats.items():
+        hdf["Input"].attrs[f"{sname}Seconds"] = s["busy"]
+        hdf["Input"].attrs[f"{sname}Frames"] = s["items"]
     # Safely assume the same shape for every frame
-    hdf["VolumeInfo"].create_dataset("shape", data=arr_frame.shape)
+    hdf["VolumeInfo"].create_dataset("shape", data=Grids(hdf["Input"]).shape)
+    for factor in storage.get("pyramid", ()):
+        write_level_info(hdf, factor)
     group = hdf.create_group("/FrameInfo")
     group.create_dataset("frameNumber", data=int(nbf))
-    group.create_dataset("frameTimes", data=np.array(time))
+    group.create_dataset("frameTimes", data=time)
+    return stats
 
 
-def dcm2vox(fname, hdf, vres):
+def _create_loader(kind):
+    if kind == "hdf":
+        return HDFLoader()
     if "32" in platform.architecture()[0]:
         Image3dAPI = ccomtypes.GetModule(str(Image3DAPIWin32))
     else:
         Image3dAPI = ccomtypes.GetModule(str(Image3DAPIx64))
     # Create loader object
     loader = ccomtypes.CreateObject("GEHC_CARD_US.Image3dFileLoader")
-    loader = loader.QueryInterface(Image3dAPI.IImage3dFileLoader)
+    return loader.QueryInterface(Image3dAPI.IImage3dFileLoader)
+
+def get_loader(kind):
+    """ File loader of `kind` (`com`, or `hdf` for the stand-in), created once per process """
+    if kind not in _LOADERS:
+        _LOADERS[kind] = _create_loader(kind)
+    return _LOADERS[kind]
+
+def init_loaders():
+    """ Pool initializer, so each worker builds the type library and its loaders up front """
+    for kind in LOADERS:
+        if kind != "com" or ccomtypes is not None:
+            get_loader(kind)
+
+def load_source(fname, cached=True):
+    """
+    Image source of `fname`, read through Image3dAPI. HDFs from a previous
+    extraction are served by a stand-in instead, so this runs anywhere. If not
+    `cached`, it's loaded by a loader of its own, left to this call.
+    """
+    kind = "hdf" if fname.suffix == ".h5" else "com"
+    if kind == "com" and ccomtypes is None:
+        raise RuntimeError(f"Reading {fname} requires Image3dAPI, which is only available on Windows.")
+    loader = get_loader(kind) if cached else _create_loader(kind)
     # Load file
     err_type, err_msg = loader.LoadFile(str(fname)) #TODO? Print errors
-    src = loader.GetImageSource()
+    return loader.GetImageSource()
+
+def _directions(bbox):
+    """ Axes of the box of the frames, one per row """
+    return np.array([[bbox.dir1_x, bbox.dir1_y, bbox.dir1_z],
+                     [bbox.dir2_x, bbox.dir2_y, bbox.dir2_z],
+                     [bbox.dir3_x, bbox.dir3_y, bbox.dir3_z]])
+
+def input_shape(fname, vres):
+    """
+    Shape of the input grids of `fname`, from its bounding box. Its loader isn't
+    kept, so this can run before forking workers.
+    """
+    directions = _directions(load_source(fname, cached=False).GetBoundingBox())
+    return np.round(np.linalg.norm(directions, axis=1) / vres).astype(int)
+
+
+def dcm2vox(fname, hdf, vres, storage=None, checkpoint=None, queue_depth=2, profiler=None,
+            meshes=None, roi_margin=0):
+    """
+    Extract the frames of the DICOM `fname` as input. If `meshes` (a `MeshSequence`)
+    are given, only the box holding them (grown by `roi_margin` voxels) is stored.
+    """
+    if storage is None:
+        storage = storage_options()
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+    if profiler is None:
+        profiler = NullProfiler()
+    for key in ["ECG", "VolumeInfo", "FrameInfo"]:
+        if key in hdf: # Leftovers of an interrupted run, they're rewritten below
+            del hdf[key]
+    with profiler.stage("com_load"):
+        src = load_source(fname)
     # Get volume & various information
     ecg = src.GetECG()
     samples = safe2np(ecg.samples)
     trig_time = safe2np(ecg.trig_times)
     bbox = src.GetBoundingBox()
     origin = np.array([bbox.origin_x, bbox.origin_y, bbox.origin_z])
-    dir_x = np.array([bbox.dir1_x, bbox.dir1_y, bbox.dir1_z])
-    dir_y = np.array([bbox.dir2_x, bbox.dir2_y, bbox.dir2_z])
-    dir_z = np.array([bbox.dir3_x, bbox.dir3_y, bbox.dir3_z])
-    directions = np.stack([dir_x, dir_y, dir_z])
+    directions = _directions(bbox)
     vshape = np.round(np.linalg.norm(directions, axis=1) / vres)
     max_vshape = np.ctypeslib.as_ctypes(vshape.astype(np.ushort))
     # Store in HDF format
@@ -88,4 +230,10 @@ def dcm2vox(fname, hdf, vres):
     group.create_dataset("directions", data=directions)
     group.create_dataset("resolution", data=vres)
     group.create_dataset("colorMap", data=src.GetColorMap())
-    get_frames(src, hdf, bbox, max_vshape, fname)
+    bounds = None
+    if meshes is not None:
+        vinfo = { "origin": origin, "directions": directions, "resolution": vres, "shape": vshape }
+        bounds = meshes.roi(Affine.from_volume_info({ "VolumeInfo": vinfo }), roi_margin,
+                            alignment(storage.get("pyramid", ())))
+    return get_frames(src, hdf, bbox, max_vshape, fname, storage, checkpoint, queue_depth,
+                      profiler, bounds)
@@ -1,33 +1,154 @@
 import click as cli
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
 
-from pathlib import WindowsPath
-from subprocess import run
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from subprocess import PIPE, Popen, TimeoutExpired, run
 
 
 
-def _get_smallest(directory):
-    """ Return filename of smallest file in directory """
-    out = next(directory.iterdir())
-    for fname in directory.iterdir():
-        if fname.suffix in [".json", ".csv", ".ply"] or fname.is_dir():
-            continue
-        if fname.stat().st_size < out.stat().st_size:
-            out = fname
-    return out
-
-def _get_other(other):
-    """ Return the first filename that is different than other in the same directory """
-    out = other
-    for fname in other.parent.iterdir():
-        if fname.suffix in [".json", ".csv", ".ply"] or fname.is_dir() or fname.name == other.name:
+# Kept in the output directory of a patient once a job of that kind succeeded
+MARKER = ".done-{}"
+# Characters of the tool output kept in the log
+OUTPUT_TAIL = 2000
+# The tool and whatever it starts are in a group of their own, killed together
+GROUP = ({ "creationflags": subprocess.CREATE_NEW_PROCESS_GROUP } if os.name == "nt"
+         else { "start_new_session": True })
+
+
+def _candidates(directory):
+    """ DICOMs of `directory`, the smallest first because it's the most likely """
+    fnames = [f for f in directory.iterdir()
+              if f.suffix not in [".json", ".csv", ".ply"] and not f.is_dir()]
+    return sorted(fnames, key=lambda f: f.stat().st_size)
+
+
+def _jobs(pdcm, pout, mesh, ed, es, volume, force):
+    """ One job per patient and kind of extraction, skipping those already done """
+    kinds = []
+    if mesh or volume:
+        kinds.append(("mesh", ["--mesh"] * mesh + ["--volume"] * volume))
+    if ed:
+        kinds.append(("ed", ["--ed"]))
+    if es:
+        kinds.append(("es", ["--es"]))
+    jobs = []
+    for directory in sorted(pdcm.iterdir()):
+        if not directory.is_dir():
             continue
-        return fname
+        for kind, flags in kinds:
+            oname = pout.joinpath(directory.name)
+            if not force and oname.joinpath(MARKER.format(kind)).exists():
+                print(f"Skipping {directory.name} ({kind}), already extracted.")
+                continue
+            jobs.append({ "patient": directory.name, "kind": kind, "flags": flags,
+                          "candidates": _candidates(directory), "output": oname, "attempt": 0 })
+    return jobs
+
+
+def _kill_group(proc):
+    """ Kill `proc` and every process it started """
+    if os.name == "nt":
+        run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError: # Already gone
+            pass
+
+def _run(cmd, timeout):
+    """ Run `cmd`, killed (with its children) after `timeout` seconds, and return what happened """
+    start = time.perf_counter()
+    try:
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE, text=True, errors="replace", **GROUP)
+    except OSError as err: # E.g. no such executable, no DICOM would do better
+        record = { "status": "error", "returncode": None, "stdout": None, "stderr": str(err) }
+    else:
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+            status = "ok" if proc.returncode == 0 else "failed"
+            record = { "status": status, "returncode": proc.returncode,
+                       "stdout": stdout, "stderr": stderr }
+        except TimeoutExpired:
+            # Children left behind would keep the pipes open, and `communicate` waiting
+            _kill_group(proc)
+            stdout, stderr = proc.communicate()
+            record = { "status": "timeout", "returncode": None,
+                       "stdout": stdout, "stderr": stderr }
+    for key in ["stdout", "stderr"]:
+        out = record[key]
+        record[key] = out[-OUTPUT_TAIL:] if out else ''
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def run_jobs(jobs, executable, workers=1, timeout=None, log=None):
+    """
+    Run `jobs` on `workers` threads, each waiting on one extraction. Jobs of a patient
+    run one after the other, first on the DICOM that worked for the previous ones. A
+    failed job is queued again with the next DICOM of its patient, until there's
+    none left. Every attempt is appended to the JSON lines `log`.
+    Return the jobs that failed on every DICOM.
+    """
+    pending, running = deque(jobs), {}
+    busy, found, failing, failed = set(), {}, {}, []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                if job["patient"] in busy:
+                    continue
+                pending.remove(job)
+                if not job["candidates"]:
+                    print(f"No DICOM left to extract {job['patient']} ({job['kind']}) from.")
+                    failed.append(job)
+                    continue
+                # Later kinds start with a DICOM known to work, and leave those that
+                # failed another kind for last
+                good, bad = found.get(job["patient"]), failing.get(job["patient"], set())
+                job["candidates"].sort(key=lambda f: (f != good, f in bad))
+                dicom = job["candidates"].pop(0)
+                job["attempt"] += 1
+                print(f"Extracting file {Path(dicom.parent.name, dicom.name)} ({job['kind']}). . .")
+                job["output"].mkdir(parents=True, exist_ok=True)
+                cmd = [str(executable), str(dicom), str(job["output"]), *job["flags"]]
+                running[executor.submit(_run, cmd, timeout)] = (job, dicom)
+                busy.add(job["patient"])
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, dicom = running.pop(future)
+                busy.discard(job["patient"])
+                record = { "patient": job["patient"], "kind": job["kind"], "dicom": str(dicom),
+                           "attempt": job["attempt"], "time": time.time(), **future.result() }
+                if log is not None:
+                    with open(log, 'a') as fd:
+                        fd.write(json.dumps(record) + '\n')
+                if record["status"] == "ok":
+                    job["output"].joinpath(MARKER.format(job["kind"])).touch()
+                    found[job["patient"]] = dicom
+                elif record["status"] == "error":
+                    print(f"Couldn't run {executable}: {record['stderr']}")
+                    failed.append(job)
+                else:
+                    failing.setdefault(job["patient"], set()).add(dicom)
+                    # Try the other DICOMs in the directory, after what's already queued
+                    print(f"Whoops, {record['status']} on {Path(dicom.parent.name, dicom.name)} "
+                          f"({job['kind']}), queued again with another DICOM.")
+                    pending.append(job)
+    return failed
 
 
 # Add flag to extract mesh, ed, es, volume
 @cli.command(context_settings={"help_option_names": ["-h", "--help"], "show_default": True})
-@cli.argument("pdcm", type=cli.Path(exists=True, resolve_path=True, file_okay=False, path_type=WindowsPath))
-@cli.option("--output-directory", "-o", "pout", type=cli.Path(resolve_path=True, path_type=WindowsPath),
+@cli.argument("pdcm", type=cli.Path(exists=True, resolve_path=True, file_okay=False, path_type=Path))
+@cli.option("--output-directory", "-o", "pout", type=cli.Path(resolve_path=True, path_type=Path),
             default="outputs", help="Where output files will be stored.")
 @cli.option("--mesh/--no-mesh", "-m/-M", default=True,
             help="Whether to extract right ventricle meshes.")
@@ -37,7 +158,17 @@ def _get_other(other):
             help="Whether to extract end systole mesh.")
 @cli.option("--volume/--no-volume", "-v/-V", default=True,
             help="Whether to extract volumes for each right ventricle meshes.")
-def extract_mesh(pdcm, pout, mesh, ed, es, volume):
+@cli.option("--number-workers", "-n", "nb_workers", default=1, type=cli.IntRange(min=1),
+            help="Number of extractions running at the same time.")
+@cli.option("--timeout", "-t", default=None, type=cli.FloatRange(min=0, min_open=True),
+            help="Seconds after which an extraction is killed, and tried on another DICOM. No limit if not given.")
+@cli.option("--executable", "-e", default="PersistentStateLoader.exe",
+            help="Extraction tool, any program taking the same arguments will do (e.g. a stub for testing).")
+@cli.option("--log", "-l", default=None, type=cli.Path(resolve_path=True, dir_okay=False, path_type=Path),
+            help="JSON lines file every attempt is appended to.  [default: POUT/extract-log.jsonl]")
+@cli.option("--force/--no-force", "-f/-F", default=False,
+            help="Extract again what was already extracted.")
+def extract_mesh(pdcm, pout, mesh, ed, es, volume, nb_workers, timeout, executable, log, force):
     """
     Extract meshes from AutoRVQ using the `PersistentStateLoader.exe` from GE. This
     script must be located in the same place as `PersistentStateLoader.exe`.
@@ -50,31 +181,20 @@ def extract_mesh(pdcm, pout, mesh, ed, es, volume):
     |-- subdir2/
         |-- ...
 
-    /!\ For some reason, ED & ES can't be extracted at the same time as all meshes. Just run the script twice...
+    /!\ For some reason, ED & ES can't be extracted at the same time as all meshes, so
+    each is a job of its own. What's already extracted is skipped, unless `--force`.
 
     PDCM    DIR    Directory where the data to be extracted is located
     """
     pout.mkdir(parents=True, exist_ok=True)
-    for fname in pdcm.iterdir():
-        if not fname.is_dir():
-            continue
-        rvname = _get_smallest(fname) #Try this first, because it's the most likely
-        print(f"Extracting file {WindowsPath().joinpath(rvname.parent.name, rvname.name)}. . .")
-        oname = pout.joinpath(fname.name)
-        oname.mkdir(parents=True, exist_ok=True)
-        # Convert flag to string arguments
-        mesh = "--mesh" if mesh else ''
-        ed = "--ed" if ed else ''
-        es = "--es" if es else ''
-        volume = "--volume" if volume else ''
-        res = run(["PersistentStateLoader.exe", f"{rvname}", f"{oname}", f"{mesh}",
-                   f"{ed}", f"{es}", f"{volume}"], stdout=None)
-        if res.returncode != 0: # There was an issue with the file
-            # Try the other DICOM in the directory
-            rvname = _get_other(rvname)
-            print(f"Whoops, looked at the wrong file. Extracting {WindowsPath().joinpath(rvname.parent.name, rvname.name)}. . .")
-            res = run(["PersistentStateLoader.exe", f"{rvname}", f"{oname}",
-                       f"{mesh}", f"{ed}", f"{es}", f"{volume}"], stdout=None)
+    jobs = _jobs(pdcm, pout, mesh, ed, es, volume, force)
+    failed = run_jobs(jobs, executable, nb_workers, timeout,
+                      log or pout.joinpath("extract-log.jsonl"))
+    print(f"Extracted {len(jobs) - len(failed)}/{len(jobs)} jobs.")
+    if failed:
+        for job in failed:
+            print(f"Failed: {job['patient']} ({job['kind']})")
+        sys.exit(1)
 
 
 
@@ -0,0 +1,177 @@
+"""
+Index of every pre-processed file of a directory: a JSON catalogue of their
+metadata, and an HDF exposing all their grids through virtual datasets. Both are
+updated as files are completed, so nothing has to open every file to find some.
+"""
+
+import h5py
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+
+from pathlib import Path
+
+from preprocess.layout import Grids
+
+
+
+CATALOGUE = "dataset-index.json"
+VIRTUAL = "dataset-index.hdf5" # Not `.h5`, so it's not mistaken for a pre-processed file
+
+
+def closest_frames(hdf, key):
+    """ Index of the frames closest to each `key` (`endDiastole` or `endSystole`) timestamp """
+    times = hdf["FrameInfo"]["frameTimes"][()]
+    return [int(np.abs(times - t).argmin()) for t in np.atleast_1d(hdf["FrameInfo"][key][()])]
+
+def key_frames(hdf):
+    """ Index of the frames closest to the end of diastole and systole timestamps """
+    return sorted(set(closest_frames(hdf, "endDiastole") + closest_frames(hdf, "endSystole")))
+
+def _times(group, key):
+    return np.atleast_1d(group[key][()]).tolist() if key in group else None
+
+def checksum(fname, block_size=2**24):
+    digest = hashlib.sha256()
+    with open(fname, "br") as fd:
+        while block := fd.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_entry(hname):
+    """ Catalogue entry of `hname`, from its metadata only (and its checksum) """
+    with h5py.File(hname, 'r') as hdf:
+        finfo, vinfo = hdf["FrameInfo"], hdf["VolumeInfo"]
+        entry = { "patient": hname.stem, "file": hname.name,
+                  "frames": int(finfo["frameNumber"][()]),
+                  "shape": vinfo["shape"][()].tolist(),
+                  "resolution": vinfo["resolution"][()].tolist(),
+                  "layout": Grids(hdf["GroundTruth"]).layout,
+                  "endDiastole": _times(finfo, "endDiastole"),
+                  "endSystole": _times(finfo, "endSystole"),
+                  "keyFrames": key_frames(hdf) if "endDiastole" in finfo else None,
+                  "volumes": vinfo["volumes"][()].tolist() if "volumes" in vinfo else None,
+                  "pyramid": sorted(int(k[1:]) for k in hdf["Pyramid"].keys()) if "Pyramid" in hdf else [] }
+    stat = os.stat(hname)
+    entry.update({ "size": stat.st_size, "mtime": stat.st_mtime, "checksum": checksum(hname) })
+    return entry
+
+
+def _virtual_grids(src, dst, fname):
+    """ Stacked `grids` dataset in `dst` mapping every grid of the `src` group """
+    grids = Grids(src)
+    # Crops are mapped as they are, along their offset
+    dst.attrs.update(src.attrs)
+    dst.attrs["layout"] = "stacked"
+    if grids.layout == "stacked":
+        dset = grids.dset
+        layout = h5py.VirtualLayout(shape=dset.shape, dtype=dset.dtype)
+        layout[...] = h5py.VirtualSource(fname, dset.name, shape=dset.shape)
+        vdset = dst.create_virtual_dataset("grids", layout)
+        vdset.attrs.update(dset.attrs)
+        return
+    nbf = len(grids)
+    layout = h5py.VirtualLayout(shape=(nbf, *grids.stored_shape), dtype=grids.dtype)
+    for i in range(nbf):
+        layout[i] = h5py.VirtualSource(fname, f"{src.name}/grid{i:02d}", shape=grids.stored_shape)
+    vdset = dst.create_virtual_dataset("grids", layout)
+    # Same attributes as the stacked layout, so `Grids` reads it the same way
+    vdset.attrs["packed"] = False
+    vdset.attrs["shape"] = grids.stored_shape
+    for i in range(nbf):
+        for k, v in grids.attrs(i).items():
+            values = vdset.attrs[k] if k in vdset.attrs else np.zeros(nbf, dtype=np.asarray(v).dtype)
+            values[i] = v
+            vdset.attrs[k] = values
+
+
+class DatasetIndex:
+    """
+    Catalogue (one entry per patient, as `file_entry`) and virtual HDF of the
+    pre-processed files of `directory`. In the virtual HDF, each patient has its
+    `FrameInfo` and `VolumeInfo` copied, and its `Input` and `GroundTruth` (and
+    `GroundTruthSDF`, if any) mapped to the original file as in the `stacked` layout
+    (read them with `Grids`).
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.path = self.directory.joinpath(CATALOGUE)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, 'r') as fd:
+                self.entries = json.load(fd)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, patient):
+        return patient in self.entries
+
+    def __getitem__(self, patient):
+        return self.entries[patient]
+
+    def table(self):
+        """ Catalogue as a data frame, e.g. `index.table().query("frames >= 25")` """
+        return pd.DataFrame(list(self.entries.values()))
+
+    def save(self):
+        # Write aside then rename, so the catalogue is never half written
+        tmpname = self.path.with_name(self.path.name + ".tmp")
+        with open(tmpname, 'w') as fd:
+            json.dump(self.entries, fd, indent=4)
+        os.replace(tmpname, self.path)
+
+    def uptodate(self, hname):
+        """ Whether `hname` is indexed and unchanged since """
+        entry = self.entries.get(hname.stem)
+        if entry is None:
+            return False
+        stat = os.stat(hname)
+        return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+
+    def update(self, hname, entry=None, force=False):
+        """
+        Add or refresh the pre-processed file `hname`, unless it's up to date and not
+        `force`. `entry` is computed if not given. Annotations are kept as long as
+        the file has the same checksum.
+        """
+        hname = Path(hname)
+        if not force and entry is None and self.uptodate(hname):
+            return
+        entry = file_entry(hname) if entry is None else entry
+        old = self.entries.get(entry["patient"], {})
+        if old.get("checksum") == entry["checksum"]: # E.g. copied, or indexed again with `force`
+            entry = { **{ k: v for k, v in old.items() if k not in entry }, **entry }
+        self.entries[entry["patient"]] = entry
+        with h5py.File(self.directory.joinpath(VIRTUAL), 'a') as vhdf:
+            if entry["patient"] in vhdf:
+                del vhdf[entry["patient"]]
+            group = vhdf.create_group(entry["patient"])
+            with h5py.File(hname, 'r') as hdf:
+                for key in ["FrameInfo", "VolumeInfo"]:
+                    hdf.copy(hdf[key], group)
+                # Relative to the virtual file, so the directory can be moved
+                for key in ["Input", "GroundTruth", "GroundTruthSDF"]:
+                    if key in hdf:
+                        _virtual_grids(hdf[key], group.create_group(key), hname.name)
+        self.save()
+
+    def annotate(self, patient, fields):
+        """
+        Add `fields` to the entry of `patient`, until its file changes (see `update`).
+        Not saved, so many entries can be annotated before saving once.
+        """
+        self.entries[patient].update(fields)
+
+    def remove(self, patient):
+        self.entries.pop(patient, None)
+        with h5py.File(self.directory.joinpath(VIRTUAL), 'a') as vhdf:
+            if patient in vhdf:
+                del vhdf[patient]
+        self.save()
+
+    def open(self):
+        """ Virtual HDF, for reading """
+        return h5py.File(self.directory.joinpath(VIRTUAL), 'r')
@@ -0,0 +1,250 @@
+"""
+How voxel grids are stored in the HDF. Either one dataset per frame (`grid00`,
+`grid01`, ...) or, for the `stacked` layout, a single chunked `(T, X, Y, Z)`
+dataset named `grids` per group. Boolean grids are bit-packed along the last axis
+in the `stacked` layout. Groups may only hold a crop of the grids, starting at
+voxel `offset` of the `fullShape` grid (both stored as group attributes), the rest
+being `fill` (a group attribute as well, 0 if missing).
+"""
+
+import numpy as np
+
+from preprocess.pyramid import block_reduce, level_name
+
+
+
+LAYOUTS = ["frames", "stacked"]
+
+
+def storage_options(layout="frames", chunks=None, compression=None, compression_opts=None,
+                    shuffle=False, pyramid=(), reduction="majority"):
+    """ Gather dataset creation options, `compression` can be a registered filter ID """
+    if compression is not None and compression.isdigit():
+        compression = int(compression)
+    return { "layout": layout, "chunks": chunks, "compression": compression,
+             "compression_opts": compression_opts, "shuffle": shuffle,
+             "pyramid": tuple(pyramid), "reduction": reduction }
+
+
+class GridWriter:
+    """
+    Write the `nbf` grids of `group` with the given layout. Datasets are created on
+    the first write, once the grid shape is known. Each grid is also reduced by the
+    factors of `pyramid`, and written in the same group of each pyramid level.
+    Grids can also be written by slabs along their first axis (see `write_slab`).
+    If `offset` is given, grids are crops starting at that voxel of a `full_shape`
+    grid (`offset` must then be a multiple of every pyramid factor).
+    """
+    def __init__(self, group, nbf, layout="frames", chunks=None, compression=None,
+                 compression_opts=None, shuffle=False, pyramid=(), reduction="majority",
+                 offset=None, full_shape=None):
+        self.group = group
+        self.nbf = nbf
+        self.layout = layout
+        self.chunks = chunks
+        self.filters = { "compression": compression, "compression_opts": compression_opts,
+                         "shuffle": shuffle }
+        self.group.attrs["layout"] = layout
+        if offset is not None:
+            self.group.attrs["offset"] = offset
+            self.group.attrs["fullShape"] = full_shape
+        else: # Left by a run that cropped grids
+            for key in ["offset", "fullShape"]:
+                self.group.attrs.pop(key, None)
+        self.reduction = reduction
+        self.counts = {} # Voxel count of frames written by slabs
+        self.levels = [(f, GridWriter(group.file.require_group(level_name(f) + group.name), nbf,
+                                      layout, chunks, compression, compression_opts, shuffle,
+                                      offset=None if offset is None else np.asarray(offset) // f,
+                                      full_shape=None if offset is None else np.asarray(full_shape) // f))
+                       for f in pyramid]
+
+    def _chunks(self, shape):
+        if self.chunks is None:
+            # One frame per chunk, in spatial blocks for cheap random access
+            return (1, *[min(s, 64) for s in shape]) if self.layout == "stacked" else None
+        chunks = tuple(min(c, s) for c, s in zip(self.chunks, (self.nbf, *shape)))
+        return chunks if self.layout == "stacked" else chunks[1:]
+
+    def _stacked(self, grid_shape, grid_dtype):
+        if "grids" in self.group:
+            return self.group["grids"]
+        shape, dtype = tuple(grid_shape), grid_dtype
+        if grid_dtype == bool: # Store 8 voxels per byte
+            shape, dtype = (*shape[:-1], -(-shape[-1] // 8)), np.uint8
+        dset = self.group.create_dataset("grids", shape=(self.nbf, *shape), dtype=dtype,
+                                         chunks=self._chunks(shape), **self.filters)
+        dset.attrs["packed"] = grid_dtype == bool
+        dset.attrs["shape"] = tuple(grid_shape)
+        return dset
+
+    def write(self, i, grid, **attrs):
+        """ Store `grid` as the `i`th frame, with per-frame attributes `attrs` """
+        for factor, writer in self.levels:
+            coarse = block_reduce(grid, factor, self.reduction)
+            if "voxelCount" in attrs: # Only one that depends on the grid content
+                writer.write(i, coarse, **{ **attrs, "voxelCount": _count(coarse) })
+            else:
+                writer.write(i, coarse, **attrs)
+        if self.layout == "frames":
+            if f"grid{i:02d}" in self.group: # Partially written by an interrupted run
+                del self.group[f"grid{i:02d}"]
+            dset = self.group.create_dataset(f"grid{i:02d}", data=grid,
+                                             chunks=self._chunks(grid.shape), **self.filters)
+            dset.attrs.update(attrs)
+            return
+        dset = self._stacked(grid.shape, grid.dtype)
+        dset[i] = np.packbits(grid, axis=-1) if dset.attrs["packed"] else grid
+        self._attrs(dset, i, attrs)
+
+    def write_slab(self, i, start, slab, shape):
+        """
+        Store `slab` as the rows from `start` (along the first axis) of the `i`th frame,
+        a grid of `shape`. Slabs of a frame are written in order from row 0, then the
+        frame is `finish`ed. Unless it's the last one, a slab must start and end on
+        a block of every pyramid level.
+        """
+        for factor, writer in self.levels:
+            writer.write_slab(i, start // factor, block_reduce(slab, factor, self.reduction),
+                              np.asarray(shape) // factor)
+        self.counts[i] = (0 if start == 0 else self.counts[i]) + _count(slab)
+        rows = slice(start, start + slab.shape[0])
+        if self.layout == "frames":
+            if start == 0: # Also replaces what an interrupted run left
+                if f"grid{i:02d}" in self.group:
+                    del self.group[f"grid{i:02d}"]
+                self.group.create_dataset(f"grid{i:02d}", shape=tuple(shape), dtype=slab.dtype,
+                                          chunks=self._chunks(tuple(shape)), **self.filters)
+            self.group[f"grid{i:02d}"][rows] = slab
+            return
+        dset = self._stacked(shape, slab.dtype)
+        dset[i, rows] = np.packbits(slab, axis=-1) if dset.attrs["packed"] else slab
+
+    def finish(self, i, **attrs):
+        """ Store per-frame `attrs` of the `i`th frame written by slabs """
+        for _, writer in self.levels:
+            writer.finish(i, **attrs)
+        count = self.counts.pop(i)
+        if "voxelCount" in attrs: # Counted as slabs were written
+            attrs = { **attrs, "voxelCount": count }
+        if self.layout == "frames":
+            self.group[f"grid{i:02d}"].attrs.update(attrs)
+        else:
+            self._attrs(self.group["grids"], i, attrs)
+
+    def _attrs(self, dset, i, attrs):
+        for k, v in attrs.items():
+            # Per-frame attributes are stored as one array per dataset
+            values = dset.attrs[k] if k in dset.attrs else np.zeros(self.nbf, dtype=np.asarray(v).dtype)
+            values[i] = v
+            dset.attrs[k] = values
+
+
+def _count(grid):
+    """ Voxels inside, summed exactly whatever the order (fractions are multiples of 1/512) """
+    return grid.sum() if grid.dtype == bool else grid.sum(dtype=np.float64)
+
+
+class Grids:
+    """
+    Read the grids of `group` the same way, whatever its layout. Cropped grids are
+    read as full ones, filled around the crop, unless read with `crop`.
+    """
+    def __init__(self, group):
+        self.group = group
+        self.layout = "stacked" if "grids" in group else "frames"
+        if self.layout == "stacked":
+            self.dset = group["grids"]
+            self.packed = bool(self.dset.attrs["packed"])
+            self.stored_shape = tuple(int(s) for s in self.dset.attrs["shape"])
+            self.dtype = np.dtype(bool) if self.packed else self.dset.dtype
+        else:
+            self.names = sorted(k for k in group.keys() if k.startswith("grid"))
+            first = group[self.names[0]] if self.names else None
+            self.stored_shape = first.shape if first is not None else None
+            self.dtype = first.dtype if first is not None else None
+        self.offset = group.attrs["offset"] if "offset" in group.attrs else None
+        self.fill = group.attrs["fill"] if "fill" in group.attrs else 0
+        if self.cropped:
+            self.shape = tuple(int(s) for s in group.attrs["fullShape"])
+        else:
+            self.shape = self.stored_shape
+
+    @property
+    def cropped(self):
+        return self.offset is not None
+
+    @property
+    def box(self):
+        """ Region of the full grids that is stored """
+        if not self.cropped:
+            return tuple(slice(0, s) for s in self.shape)
+        return tuple(slice(int(o), int(o) + s) for o, s in zip(self.offset, self.stored_shape))
+
+    def __len__(self):
+        return self.dset.shape[0] if self.layout == "stacked" else len(self.names)
+
+    def __contains__(self, i):
+        return 0 <= i < len(self) if self.layout == "stacked" else f"grid{i:02d}" in self.group
+
+    def crop(self, i):
+        """ `i`th grid as it is stored, i.e. only the crop of cropped grids """
+        if self.layout == "frames":
+            return self.group[f"grid{i:02d}"][()]
+        grid = self.dset[i]
+        if self.packed:
+            grid = np.unpackbits(grid, axis=-1, count=self.stored_shape[-1]).astype(bool)
+        return grid
+
+    def __getitem__(self, i):
+        if not self.cropped:
+            return self.crop(i)
+        grid = np.full(self.shape, self.fill, dtype=self.dtype)
+        grid[self.box] = self.crop(i)
+        return grid
+
+    def read(self, i, region=None):
+        """
+        `i`th grid, or only its `region` (a tuple of one slice per axis, without step),
+        reading nothing else from disk
+        """
+        if region is None:
+            return self[i]
+        if not self.cropped:
+            return self._read(i, region)
+        # Only the part of `region` overlapping the crop is read, the rest is filled
+        region = [slice(*r.indices(s)[:2]) for r, s in zip(region, self.shape)]
+        grid = np.full([max(0, r.stop - r.start) for r in region], self.fill, dtype=self.dtype)
+        lower = np.maximum([r.start for r in region], self.offset)
+        upper = np.minimum([r.stop for r in region], self.offset + np.array(self.stored_shape))
+        if (upper > lower).all():
+            dst = tuple(slice(l - r.start, u - r.start) for l, u, r in zip(lower, upper, region))
+            grid[dst] = self._read(i, tuple(slice(l - o, u - o)
+                                            for l, u, o in zip(lower, upper, self.offset)))
+        return grid
+
+    def _read(self, i, region):
+        """ `region` of the `i`th grid, in the coordinates of what is stored """
+        if self.layout == "frames":
+            return self.group[f"grid{i:02d}"][region]
+        if not self.packed:
+            return self.dset[(i, *region)]
+        # Whole bytes holding the last axis slice, then trim bits out of it
+        start, stop, _ = region[-1].indices(self.stored_shape[-1])
+        first = start // 8
+        grid = self.dset[(i, *region[:-1], slice(first, -(-stop // 8)))]
+        grid = np.unpackbits(grid, axis=-1).astype(bool)
+        return grid[..., start - 8 * first:stop - 8 * first]
+
+    def meta(self, i):
+        """ Shape and type of the `i`th grid, without reading it """
+        if self.layout == "frames":
+            dset = self.group[f"grid{i:02d}"]
+            return (self.shape if self.cropped else dset.shape), dset.dtype
+        return self.shape, self.dtype
+
+    def attrs(self, i):
+        """ Per-frame attributes of the `i`th grid """
+        if self.layout == "frames":
+            return dict(self.group[f"grid{i:02d}"].attrs)
+        return { k: v[i] for k, v in self.dset.attrs.items() if k not in ["packed", "shape"] }
@@ -5,92 +5,347 @@ Code from github.com/mailys-hau/echovox
 import scipy.ndimage as sci
 import numpy as np
 import trimesh as tm
-import trimesh.exchange.ply as tmply
 
-from trimesh.voxel.creation import local_voxelize
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 
+from preprocess.affine import Affine
+from preprocess.checkpoint import Checkpoint
+from preprocess.layout import GridWriter, storage_options
+from preprocess.plyio import full_load_ply # Moved to `plyio`, still importable from here
+from preprocess.pyramid import alignment, write_level_info
+from preprocess.sequence import MeshSequence
+from preprocess.scanline import scanline2vox
+from utils.profiling import NullProfiler, Profiler
 
 
-def full_load_ply(file_obj, resolver=None, fix_texture=True, prefer_color=None,
-                  *args, **kwargs):
-    """ Trimesh's `load_ply` doesn't return normals, we're fixing this """
-    # First part is the same as `trimesh.exchange.ply.load_ply`
-    elements, is_ascii, image_name = tmply._parse_header(file_obj)
-    if is_ascii:
-        tmply._ply_ascii(elements, file_obj)
-    else:
-        tmply._ply_binary(elements, file_obj)
-    image = None
-    try:
-        import PIL.Image
-        if image_name is not None:
-            data = resolver.get(image_name)
-            image = PIL.Image.open(tm.util.wrap_as_stream(data))
-    except ImportError:
-        tm.util.log.debug("textures require `pip install pillow`")
-    except BaseException:
-        tm.util.log.warning("unable to load image!", exc_info=True)
-    kwargs = tmply._elements_to_kwargs(
-            image=image, elements=elements, fix_texture=fix_texture, prefer_color=prefer_color)
-    # Check elements for normals and add it to the kwargs
-    if "normal" in elements and elements["normal"]["length"]:
-        normals = np.column_stack([elements["normal"]["data"][i] for i in "xyz"])
-        if not tm.util.is_shape(normals, (-1, 3)):
-            raise ValueError("Normals were not (n, 3)!")
-        if normals.shape == kwargs["vertices"].shape:
-            k = "vertex_normals"
-        elif normals.shape[0] == kwargs["faces"].shape[0]:
-            k = "face_normals"
-        else:
-            raise ValueError("Number of normals match neither vertices or faces!")
-        kwargs[k] = normals
-    return kwargs
-
-
-def get_smallest_bounds(mesh, origin, delta):
+
+def get_smallest_bounds(mesh, affine):
     """
     Convert the mesh to the destination world before getting its bounding box.
     That way the bounding box is smaller than converting the bounding to the
     destination coordinate system.
     """
-    # Mesh vertices in the voxel grid coordinate system
-    def _get_coord(p):
-        return np.linalg.inv(delta) @ (p - origin)
-    vfunc = np.vectorize(_get_coord, signature="(n)->(n)")
-    idx = vfunc(mesh.vertices)
-    bbox = tm.Trimesh(vertices=abs(idx), faces=mesh.faces).bounds
-    return bbox.astype(int)
+    return affine.bounds(mesh.vertices)
 
-def mesh2vox(hdf, mesh):
+def _contains(mesh, coord, chunk_size):
+    """ Batched `mesh.contains`, by chunks of `chunk_size` points to bound memory """
+    inside = np.zeros(coord.shape[0], dtype=bool)
+    for start in range(0, coord.shape[0], chunk_size):
+        inside[start:start + chunk_size] = mesh.contains(coord[start:start + chunk_size])
+    return inside
+
+def _region(affine, region):
+    return np.stack([np.zeros(3, dtype=int), affine.shape]) if region is None else np.asarray(region)
+
+def mesh2vox(hdf, mesh, chunk_size=4096, affine=None, region=None):
     """
+    Voxelize `mesh` on the grid described in `hdf["VolumeInfo"]` (or by `affine`, if
+    given). Every voxel center of the mesh bounding box is computed at once, and
+    classified by chunks of `chunk_size` points (each ray cast by `contains` is
+    costly in memory). If `region` is given (`(2, 3)` lower and upper voxel indices,
+    upper excluded), only that part of the grid is voxelized and returned.
     """
-    vshape = hdf["VolumeInfo"]["shape"][()]
-    vres = hdf["VolumeInfo"]["resolution"][()]
-    origin = hdf["VolumeInfo"]["origin"][()]
-    directions = hdf["VolumeInfo"]["directions"][()]
-    delta = vres * directions / np.linalg.norm(directions, axis=0)
-    grid = np.zeros(vshape, dtype=bool)
-    bbox = get_smallest_bounds(mesh, origin, delta)
-    for i in range(bbox[0, 0], bbox[1, 0] + 1):
-        for j in range(bbox[0, 1], bbox[1, 1] + 1):
-            for k in range(bbox[0, 2], bbox[1, 2] + 1):
-                # This is highly ineficient, but that's the best choice we had to
-                # align the input & ground truth
-                idx = np.array([i, j, k])
-                coord = delta.T @ idx + origin
-                if mesh.contains(np.expand_dims(coord, axis=0)):
-                    grid[i, j, k] = True
+    if affine is None:
+        affine = Affine.from_volume_info(hdf)
+    box = _region(affine, region)
+    grid = np.zeros(box[1] - box[0], dtype=bool)
+    bbox = get_smallest_bounds(mesh, affine)
+    bbox = np.stack([np.maximum(bbox[0], box[0]), np.minimum(bbox[1], box[1] - 1)])
+    if (bbox[1] < bbox[0]).any():
+        return grid
+    # Voxel indices of the bounding box, one column per voxel
+    idx = np.mgrid[bbox[0, 0]:bbox[1, 0] + 1,
+                   bbox[0, 1]:bbox[1, 1] + 1,
+                   bbox[0, 2]:bbox[1, 2] + 1].reshape(3, -1)
+    inside = _contains(mesh, affine.to_world(idx.T), chunk_size)
+    grid[tuple(idx[:, inside] - box[0][:, None])] = True
     return grid
 
 
-def ply2vox(plydir, hdf, progress, tid):
+def mesh2vox_scanline(hdf, mesh, chunk_size=4096, affine=None, region=None, rule="parity"):
+    """
+    Voxelize `mesh` on the grid described in `hdf["VolumeInfo"]` (or by `affine`, if
+    given), casting one ray per (i, j) column of the grid instead of one per voxel.
+    Only `region` of the grid is voxelized and returned, if given.
+    """
+    if affine is None:
+        affine = Affine.from_volume_info(hdf)
+    return scanline2vox(affine.to_voxel(mesh.vertices), mesh.faces, affine.shape, rule=rule,
+                        chunk_size=chunk_size, region=region)
+
+# Peak bytes per voxel of the region each voxelizer works on (grid, and indices and
+# world coordinates or ray crossings)
+VOXEL_BYTES = { "contains": 56, "scanline": 24 }
+
+VOXELIZERS = { "contains": mesh2vox, "scanline": mesh2vox_scanline }
+
+
+def mesh2vox_incremental(hdf, mesh, previous, voxelizer="contains", chunk_size=4096,
+                         band_width=1, max_band=0.5, affine=None):
+    """
+    Voxelize `mesh` by updating `previous`, the grid of the previous frame. Only the
+    voxels in a band of `band_width` voxels around the old and new surfaces are
+    tested, as well as one voxel per connected region outside of that band (no
+    surface crosses them, so they're entirely inside or outside). Tested voxels are
+    classified by `voxelizer`, `scanline` casting only the columns they're in. Fall
+    back to a full voxelization when the band covers more than `max_band` of the
+    bounding box. Return the grid and the number of tested voxels.
+    """
+    if affine is None:
+        affine = Affine.from_volume_info(hdf)
+    vshape = affine.shape
+    vidx = affine.to_voxel(mesh.vertices)
+    # Bounding box of both surfaces, with a margin so the band fits in it
+    lower, upper = np.floor(vidx.min(axis=0)), np.ceil(vidx.max(axis=0))
+    if previous.any():
+        inside = np.argwhere(previous)
+        lower, upper = np.minimum(lower, inside.min(axis=0)), np.maximum(upper, inside.max(axis=0))
+    lower = np.clip(lower.astype(int) - band_width - 1, 0, vshape - 1)
+    upper = np.clip(upper.astype(int) + band_width + 1, 0, vshape - 1)
+    box = tuple(slice(l, u + 1) for l, u in zip(lower, upper))
+    old = previous[box]
+    # New surface, sampled finely enough for each sample to be within a voxel of it
+    samples, _ = tm.remesh.subdivide_to_size(vidx, mesh.faces, max_edge=0.5)
+    samples = np.round(samples).astype(int) - lower
+    samples = samples[((samples >= 0) & (samples < old.shape)).all(axis=1)]
+    surface = old ^ sci.binary_erosion(old)
+    surface[tuple(samples.T)] = True
+    band = sci.binary_dilation(surface, structure=np.ones((3, 3, 3)), iterations=band_width)
+    if band.sum() > max_band * band.size:
+        # Not worth it, a full voxelization is faster. It classifies the whole grid.
+        grid = VOXELIZERS[voxelizer](hdf, mesh, chunk_size=chunk_size, affine=affine)
+        return grid, int(np.prod(vshape))
+    # Everything left is split in regions no surface goes through, `0` is the band
+    labels, _ = sci.label(~band)
+    values, first = np.unique(labels.ravel(), return_index=True)
+    first = np.stack(np.unravel_index(first[values > 0], labels.shape), axis=1)
+    tested = np.concatenate([np.argwhere(band), first])
+    if voxelizer == "scanline": # Same rays as a full voxelization, so the same grid
+        columns = np.zeros(old.shape[:2], dtype=bool)
+        columns[tuple(tested[:, :2].T)] = True
+        sub = scanline2vox(vidx, mesh.faces, vshape, chunk_size=chunk_size,
+                           region=np.stack([lower, upper + 1]), columns=columns)
+        inside = sub[tuple(tested.T)]
+    else:
+        inside = _contains(mesh, affine.to_world(tested + lower), chunk_size)
+    new = np.zeros(old.shape, dtype=bool)
+    new[band] = inside[:-first.shape[0] or None]
+    # Carry over the value of each region from its first voxel
+    new[labels > 0] = inside[-first.shape[0]:][labels[labels > 0] - 1]
+    grid = np.zeros(vshape, dtype=bool)
+    grid[box] = new
+    return grid, tested.shape[0]
+
+
+def read_volume_info(hdf):
+    """
+    Load the grid description once, with the same layout as the HDF so voxelizers
+    can take either. Unlike an HDF handle, it can be sent to other processes.
+    """
+    keys = ["shape", "resolution", "origin", "directions"]
+    return { "VolumeInfo": { k: hdf["VolumeInfo"][k][()] for k in keys } }
+
+def voxelize_frames(meshes, hdf, voxelizer="contains", chunk_size=4096, incremental=False,
+                    band_width=1, bounds=None, profiler=None):
+    """
+    Yield the grid of each mesh of `meshes` (a `MeshSequence`), and the number of
+    tested voxels if `incremental`. Grids are cropped to `bounds` (as `MeshSequence.roi`)
+    if given, nothing outside of it is allocated.
+    """
+    if profiler is None:
+        profiler = NullProfiler()
+    # Same grid for every frame
+    affine = Affine.from_volume_info(hdf)
+    if incremental and bounds is not None: # Updates the previous grid, so it works on the crop
+        affine, bounds = affine.crop(*bounds), None
+    # First frame is "updated" from an empty grid
+    box = _region(affine, bounds)
+    grid = np.zeros(box[1] - box[0], dtype=bool)
+    tested = None
+    for frame, mesh in meshes.items():
+        with profiler.stage("voxelize", frame):
+            if incremental:
+                grid, tested = mesh2vox_incremental(hdf, mesh, grid, voxelizer=voxelizer,
+                                                    chunk_size=chunk_size, band_width=band_width,
+                                                    affine=affine)
+            else:
+                grid = VOXELIZERS[voxelizer](hdf, mesh, chunk_size=chunk_size, affine=affine,
+                                             region=bounds)
+        yield grid, tested
+
+def slab_rows(box, voxelizer, memory_budget, align=1):
+    """
+    Number of rows (along the first axis) of `box` to voxelize at once, so it takes
+    at most `memory_budget` bytes (but at least `align` rows, and a multiple of it)
+    """
+    row_bytes = np.prod(box[1, 1:] - box[0, 1:]) * VOXEL_BYTES[voxelizer]
+    return max(align, int(memory_budget // row_bytes) // align * align)
+
+def stream_frames(meshes, hdf, writer, todo, bounds=None, voxelizer="contains",
+                  chunk_size=4096, memory_budget=2**30, align=1, profiler=None):
+    """
+    Voxelize each mesh of `meshes` (as the `todo` frames) slab by slab, each slab
+    written to `writer` as soon as it's done, so only one is in memory at a time.
+    Yield each frame once written.
+    """
+    if profiler is None:
+        profiler = NullProfiler()
+    affine = Affine.from_volume_info(hdf)
+    box = _region(affine, bounds)
+    shape = box[1] - box[0]
+    rows = slab_rows(box, voxelizer, memory_budget, align)
+    for i, (_, mesh) in zip(todo, meshes.items()):
+        count = 0
+        for start in range(box[0, 0], box[1, 0], rows):
+            region = box.copy()
+            region[:, 0] = start, min(start + rows, box[1, 0])
+            with profiler.stage("voxelize", i):
+                slab = VOXELIZERS[voxelizer](hdf, mesh, chunk_size=chunk_size, affine=affine,
+                                             region=region)
+            with profiler.stage("write_groundtruth", i):
+                writer.write_slab(i, start - box[0, 0], slab, shape)
+            count += slab.sum()
+        writer.finish(i, voxelCount=count)
+        yield i
+
+def _frames2shm(meshes, vinfo, bounds, vox_opts, profile):
+    """
+    Voxelize a block of frames, grids are handed back through shared memory. Return
+    their shared memory name and profiling records.
+    """
+    profiler = Profiler() if profile else NullProfiler()
+    out = []
+    try:
+        for grid, tested in voxelize_frames(meshes, vinfo, bounds=bounds, profiler=profiler,
+                                            **vox_opts):
+            shm = SharedMemory(create=True, size=max(1, grid.nbytes))
+            out.append((shm.name, tested))
+            np.ndarray(grid.shape, dtype=grid.dtype, buffer=shm.buf)[...] = grid
+            # Writer is in charge of unlinking it, don't let this process clean it up on exit
+            resource_tracker.unregister(shm._name, "shared_memory")
+            shm.close()
+    except BaseException: # Nobody will receive the grids of this block
+        for name, _ in out:
+            _unlink(name)
+        raise
+    return out, profiler.records
+
+def _unlink(name):
+    """ Free the shared memory `name`, if it's still there """
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+def _write_grid(writer, i, grid, tested):
+    # Voxel count allows checking the ground truth isn't empty without reading it
+    if tested is None:
+        writer.write(i, grid, voxelCount=grid.sum())
+    else:
+        writer.write(i, grid, voxelCount=grid.sum(), testedVoxels=tested)
+
+def ply2vox(plydir, hdf, progress, tid, frame_workers=1, storage=None, checkpoint=None,
+            profiler=None, ply_cache=None, roi_margin=None, memory_budget=None,
+            store_meshes=False, **vox_opts):
+    """
+    Voxelize the meshes of `plydir` as ground truth, and store them in `/Mesh` along
+    the grids if `store_meshes`. If `plydir` is None, meshes stored by a previous run
+    are voxelized instead. With
+    a `roi_margin`, only the box holding the meshes of every frame (grown by that
+    many voxels) is voxelized and stored. With a `memory_budget` (in bytes), frames
+    are voxelized and written by slabs fitting in it, one frame at a time.
+    """
+    if storage is None:
+        storage = storage_options()
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+    if profiler is None:
+        profiler = NullProfiler()
     nbf = hdf["FrameInfo"]["frameNumber"][()]
-    group = hdf.create_group("/GroundTruth")
-    for i in range(nbf):
-        fname = next(plydir.glob(f"*_{i:03d}.ply")) # Make sure it's ordered
-        with open(fname, "br") as fd: # Need to be opened in binary mode for Trimesh
-            dict_mesh = full_load_ply(fd, prefer_color="face")
-        mesh = tm.Trimesh(**dict_mesh)
-        grid = mesh2vox(hdf, mesh)
-        group.create_dataset(f"grid{i:02d}", data=grid)
-        progress[tid] = { "progress": i + 1, "total": nbf }
+    for factor in storage.get("pyramid", ()): # Input may have been extracted without it
+        write_level_info(hdf, factor)
+    # Make sure it's ordered, and skip frames done by an interrupted run
+    todo = [i for i in range(nbf) if not checkpoint.done("groundtruth", i)]
+    if plydir is None:
+        if "Mesh" not in hdf:
+            raise RuntimeError(f"No PLYs for {hdf.filename}, and no meshes stored in it (see `--store-meshes`).")
+        meshes = MeshSequence.load(hdf["Mesh"])
+    else:
+        with profiler.stage("ply_parse"):
+            fnames = [next(plydir.glob(f"*_{i:03d}.ply")) for i in range(nbf)]
+            meshes = MeshSequence.from_plys(fnames, ply_cache)
+        if store_meshes:
+            meshes.save(hdf.require_group("/Mesh"))
+        elif "Mesh" in hdf: # Left by a previous run, it may not match the PLYs anymore
+            del hdf["Mesh"]
+    bounds, crop = None, {}
+    if roi_margin is not None:
+        # From every frame, so it's the same when resuming
+        affine = Affine.from_volume_info(hdf)
+        bounds = meshes.roi(affine, roi_margin, alignment(storage.get("pyramid", ())))
+        crop = { "offset": bounds[0], "full_shape": affine.shape }
+    writer = GridWriter(hdf.require_group("/GroundTruth"), nbf, **crop, **storage)
+    meshes = meshes[todo]
+    done = nbf - len(todo)
+    if memory_budget is not None:
+        frames = stream_frames(meshes, hdf, writer, todo, bounds, vox_opts["voxelizer"],
+                               vox_opts["chunk_size"], memory_budget,
+                               alignment(storage.get("pyramid", ())), profiler)
+        for i in frames:
+            checkpoint.mark("groundtruth", i, hdf)
+            done += 1
+            progress[tid] = { "progress": done, "total": nbf }
+        return
+    if frame_workers == 1:
+        grids = voxelize_frames(meshes, hdf, bounds=bounds, profiler=profiler, **vox_opts)
+        for i, (grid, tested) in zip(todo, grids):
+            with profiler.stage("write_groundtruth", i):
+                _write_grid(writer, i, grid, tested)
+            checkpoint.mark("groundtruth", i, hdf)
+            done += 1
+            progress[tid] = { "progress": done, "total": nbf }
+        return
+    # Incremental voxelization needs consecutive frames, so give a block to each worker
+    bsize = -(-len(todo) // frame_workers) if vox_opts.get("incremental") else 1
+    vinfo = read_volume_info(hdf)
+    vshape = vinfo["VolumeInfo"]["shape"] if bounds is None else bounds[1] - bounds[0]
+    # HDF can't be shared between processes, workers voxelize and we write here
+    with ProcessPoolExecutor(max_workers=frame_workers) as executor:
+        profile = isinstance(profiler, Profiler)
+        futures = { executor.submit(_frames2shm, meshes[start:start + bsize], vinfo, bounds,
+                                    vox_opts, profile): start
+                    for start in range(0, len(todo), bsize) }
+        received = set()
+        try:
+            for future in as_completed(futures):
+                received.add(future)
+                out, records = future.result()
+                try:
+                    profiler.extend(records)
+                    for j, (name, tested) in enumerate(out, start=futures[future]):
+                        shm = SharedMemory(name=name)
+                        try:
+                            with profiler.stage("write_groundtruth", todo[j]):
+                                _write_grid(writer, todo[j],
+                                            np.ndarray(vshape, dtype=bool, buffer=shm.buf), tested)
+                        finally:
+                            shm.close()
+                            shm.unlink()
+                        checkpoint.mark("groundtruth", todo[j], hdf)
+                        done += 1
+                finally: # Grids left if writing failed half way through the block
+                    for name, _ in out:
+                        _unlink(name)
+                progress[tid] = { "progress": done, "total": nbf }
+        except BaseException:
+            # Stop pending blocks, and free the grids of those already voxelized
+            executor.shutdown(cancel_futures=True)
+            for future in futures:
+                if future not in received and not future.cancelled() and future.exception() is None:
+                    for name, _ in future.result()[0]:
+                        _unlink(name)
+            raise
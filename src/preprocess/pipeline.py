@@ -0,0 +1,78 @@
+"""
+Minimal producer/consumer pipeline, to overlap stages that wait on different
+things (e.g. COM calls, numpy work and disk writes).
+"""
+
+import time
+
+from queue import Queue
+from threading import Event, Thread
+
+
+
+_DONE = object() # Sentinel, sent through queues when there's no more item
+
+
+def _run_stage(func, qin, qout, stats, failed, errors):
+    while (item := qin.get()) is not _DONE:
+        if failed.is_set():
+            continue # Keep draining so upstream never blocks
+        start = time.perf_counter()
+        try:
+            out = func(item)
+        except BaseException as err:
+            errors.append(err)
+            failed.set()
+            continue
+        stats["busy"] += time.perf_counter() - start
+        stats["items"] += 1
+        if qout is not None:
+            qout.put(out)
+    if qout is not None:
+        qout.put(_DONE)
+
+def run_pipeline(source, stages, depth=2, name="source"):
+    """
+    Feed the items of `source` (iterated on the calling thread) to `stages`, a list
+    of `(name, func)` each run in its own thread, and connected to the next one by a
+    queue of at most `depth` items. The output of the last stage is dropped.
+    Return the time spent working and the number of items processed by each stage.
+    """
+    stats = { n: { "busy": 0., "items": 0 } for n in [name] + [n for n, _ in stages] }
+    queues = [Queue(maxsize=depth) for _ in stages]
+    failed, errors = Event(), []
+    threads = [Thread(target=_run_stage, daemon=True,
+                      args=(func, queues[i], queues[i + 1] if i + 1 < len(stages) else None,
+                            stats[sname], failed, errors))
+               for i, (sname, func) in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        source = iter(source)
+        while not failed.is_set():
+            start = time.perf_counter()
+            try:
+                item = next(source)
+            except StopIteration:
+                break
+            stats[name]["busy"] += time.perf_counter() - start
+            stats[name]["items"] += 1
+            queues[0].put(item)
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return stats
+
+def format_stats(stats):
+    """ One line per stage, with its throughput """
+    lines = []
+    for sname, s in stats.items():
+        rate = s["items"] / s["busy"] if s["busy"] > 0 else float("inf")
+        lines.append(f"{sname:>10}: {s['items']} items in {s['busy']:.2f}s ({rate:.2f} items/s)")
+    return '\n'.join(lines)
@@ -0,0 +1,236 @@
+"""
+PLY loading. Binary meshes are read straight into arrays, and parsed
+meshes can be kept in an on-disk cache so re-runs don't parse them again.
+"""
+
+import hashlib
+import numpy as np
+import os
+import trimesh as tm
+import trimesh.exchange.ply as tmply
+import zipfile
+
+from pathlib import Path
+
+
+
+_TYPES = { "char": "i1", "uchar": "u1", "short": "i2", "ushort": "u2", "int": "i4", "uint": "u4",
+           "float": "f4", "double": "f8", "int8": "i1", "uint8": "u1", "int16": "i2",
+           "uint16": "u2", "int32": "i4", "uint32": "u4", "float32": "f4", "float64": "f8" }
+_COLORS = ["red", "green", "blue", "alpha"]
+
+
+def full_load_ply(file_obj, resolver=None, fix_texture=True, prefer_color=None,
+                  *args, **kwargs):
+    """ Trimesh's `load_ply` doesn't return normals, we're fixing this """
+    # First part is the same as `trimesh.exchange.ply.load_ply`
+    elements, is_ascii, image_name = tmply._parse_header(file_obj)
+    if is_ascii:
+        tmply._ply_ascii(elements, file_obj)
+    else:
+        tmply._ply_binary(elements, file_obj)
+    image = None
+    try:
+        import PIL.Image
+        if image_name is not None:
+            data = resolver.get(image_name)
+            image = PIL.Image.open(tm.util.wrap_as_stream(data))
+    except ImportError:
+        tm.util.log.debug("textures require `pip install pillow`")
+    except BaseException:
+        tm.util.log.warning("unable to load image!", exc_info=True)
+    kwargs = tmply._elements_to_kwargs(
+            image=image, elements=elements, fix_texture=fix_texture, prefer_color=prefer_color)
+    # Check elements for normals and add it to the kwargs
+    if "normal" in elements and elements["normal"]["length"]:
+        normals = np.column_stack([elements["normal"]["data"][i] for i in "xyz"])
+        if not tm.util.is_shape(normals, (-1, 3)):
+            raise ValueError("Normals were not (n, 3)!")
+        if normals.shape == kwargs["vertices"].shape:
+            k = "vertex_normals"
+        elif normals.shape[0] == kwargs["faces"].shape[0]:
+            k = "face_normals"
+        else:
+            raise ValueError("Number of normals match neither vertices or faces!")
+        kwargs[k] = normals
+    return kwargs
+
+
+def _parse_header(buf):
+    """
+    Return the header length, the byte order, and each element as a `(name, count,
+    fields)` tuple, or None if the file isn't a triangle mesh `read_ply` can map.
+    """
+    end = buf.find(b"end_header")
+    if end < 0:
+        return None
+    end = buf.index(b"\n", end) + 1
+    lines = buf[:end].decode("ascii", errors="replace").splitlines()
+    if lines[0].strip() != "ply":
+        return None
+    order, elements = None, []
+    for line in lines[1:]:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == "format":
+            order = { "binary_little_endian": '<', "binary_big_endian": '>' }.get(words[1])
+        elif words[0] == "element":
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == "property":
+            if words[1] == "list":
+                # Only triangles with a fixed size count, anything else goes the slow way
+                if elements[-1][0] != "face" or words[4] not in ["vertex_indices", "vertex_index"]:
+                    return None
+                elements[-1][2].append(("count", _TYPES[words[2]], ()))
+                elements[-1][2].append(("indices", _TYPES[words[3]], (3,)))
+            else:
+                elements[-1][2].append((words[2], _TYPES[words[1]], ()))
+    if order is None: # ASCII
+        return None
+    return end, order, elements
+
+def _colors(data):
+    colors = [data[c] for c in _COLORS if c in data.dtype.names]
+    return np.column_stack(colors) if len(colors) >= 3 else None
+
+def _fallback(fname):
+    with open(fname, "br") as fd: # Need to be opened in binary mode for Trimesh
+        return full_load_ply(fd, prefer_color="face")
+
+def read_ply(fname):
+    """
+    Load a PLY as keyword arguments of `trimesh.Trimesh`, the same ones as
+    `full_load_ply`. Elements of binary triangle meshes are viewed straight from the
+    file buffer, other files fall back to `full_load_ply`.
+    """
+    with open(fname, "br") as fd:
+        buf = fd.read()
+    header = _parse_header(buf)
+    if header is None:
+        return _fallback(fname)
+    offset, order, elements = header
+    data = {}
+    for name, count, fields in elements:
+        dtype = np.dtype([(f, order + t, s) for f, t, s in fields])
+        if offset + count * dtype.itemsize > len(buf):
+            # Truncated, or faces aren't all triangles so elements are larger than that
+            return _fallback(fname)
+        data[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        offset += count * dtype.itemsize
+    vertex, face = data.get("vertex"), data.get("face")
+    if vertex is None or face is None or not (face["count"] == 3).all():
+        return _fallback(fname)
+    kwargs = { "vertices": np.column_stack([vertex[i] for i in "xyz"]),
+               "faces": np.array(face["indices"]) }
+    if all(n in vertex.dtype.names for n in ["nx", "ny", "nz"]):
+        kwargs["vertex_normals"] = np.column_stack([vertex[n] for n in ["nx", "ny", "nz"]])
+    kwargs["face_colors"] = _colors(face)
+    kwargs["vertex_colors"] = _colors(vertex)
+    # Same as `full_load_ply`
+    if "normal" in data and data["normal"].shape[0]:
+        normals = np.column_stack([data["normal"][i] for i in "xyz"])
+        if normals.shape == kwargs["vertices"].shape:
+            kwargs["vertex_normals"] = normals
+        elif normals.shape[0] == kwargs["faces"].shape[0]:
+            kwargs["face_normals"] = normals
+        else:
+            raise ValueError("Number of normals match neither vertices or faces!")
+    return kwargs
+
+def ply_bounds(fname, header_size=2**16):
+    """
+    `(2, 3)` bounding box of the vertices of `fname`. For binary PLYs starting with
+    their vertices, only the header and the vertices are read.
+    """
+    with open(fname, "br") as fd:
+        header = _parse_header(fd.read(header_size))
+        if header is None or header[2][0][0] != "vertex":
+            vertices = read_ply(fname)["vertices"]
+        else:
+            offset, order, elements = header
+            _, count, fields = elements[0]
+            dtype = np.dtype([(f, order + t, s) for f, t, s in fields])
+            fd.seek(offset)
+            block = fd.read(count * dtype.itemsize)
+            if len(block) < count * dtype.itemsize: # Truncated, let the full parser deal with it
+                vertices = read_ply(fname)["vertices"]
+            else:
+                vertex = np.frombuffer(block, dtype=dtype)
+                vertices = np.column_stack([vertex[i] for i in "xyz"])
+    return np.stack([vertices.min(axis=0), vertices.max(axis=0)])
+
+
+def load_mesh(fname, cache=None):
+    """ Parse `fname`, or get it from `cache` (a `PlyCache`) if given """
+    if cache is not None:
+        return cache.load(fname)
+    return tm.Trimesh(**read_ply(fname))
+
+
+class PlyCache:
+    """
+    Meshes stored as `.npz` in `directory`, keyed by path, size and modification time
+    of their PLY. Arrays are stored once processed by Trimesh (e.g. with duplicate
+    vertices merged), so a cached mesh is rebuilt without parsing nor processing it
+    again. Least recently used ones are evicted once the cache is over `max_bytes`.
+    """
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def _path(self, fname):
+        stat = os.stat(fname)
+        key = f"{Path(fname).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+        return self.directory.joinpath(hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+    def load(self, fname):
+        """ Mesh of `fname`, as a `trimesh.Trimesh` """
+        path = self._path(fname)
+        try:
+            with np.load(path) as npz:
+                arrays = { k: npz[k] for k in npz.files }
+            os.utime(path) # Recently used
+            return tm.Trimesh(process=False, **arrays)
+        except (OSError, ValueError, zipfile.BadZipFile): # Not there, or half written
+            pass
+        kwargs = read_ply(fname)
+        mesh = tm.Trimesh(**kwargs)
+        arrays = { "vertices": mesh.vertices, "faces": mesh.faces }
+        # Only what was in the file, anything else is computed on demand as usual
+        for k in ["vertex_normals", "face_normals"]:
+            if kwargs.get(k) is not None:
+                arrays[k] = getattr(mesh, k)
+        if mesh.visual.kind in ["face", "vertex"]:
+            k = f"{mesh.visual.kind}_colors"
+            arrays[k] = getattr(mesh.visual, k)
+        self.store(path, arrays)
+        return mesh
+
+    def store(self, path, arrays):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Write aside then rename, other processes may be reading the same entry
+        tmpname = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmpname, "bw") as fd:
+            np.savez(fd, **arrays)
+        os.replace(tmpname, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # Evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
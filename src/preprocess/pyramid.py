@@ -0,0 +1,57 @@
+"""
+Coarser copies of the grids, derived from the finest ones by block reduction. The
+level of factor `f` is stored in `/Pyramid/x{f}`, with the same groups as the root
+of the file (`Input`, `GroundTruth` and its own `VolumeInfo`).
+"""
+
+import numpy as np
+
+from preprocess.affine import Affine
+
+
+
+REDUCTIONS = ["majority", "fraction"]
+
+
+def block_reduce(grid, factor, reduction="majority"):
+    """
+    Reduce `grid` by blocks of `factor` voxels per side, voxels left over at the far
+    end of each axis are dropped. Boolean grids become the fraction of each block
+    inside (as float16, exact for any factor up to 8) or whether most of it is inside
+    (`majority`). Other grids are averaged, keeping their type.
+    """
+    shape = np.array(grid.shape) // factor
+    grid = grid[tuple(slice(0, s * factor) for s in shape)]
+    blocks = grid.reshape(shape[0], factor, shape[1], factor, shape[2], factor)
+    mean = blocks.mean(axis=(1, 3, 5))
+    if grid.dtype == bool:
+        return mean >= 0.5 if reduction == "majority" else mean.astype(np.float16)
+    if np.issubdtype(grid.dtype, np.integer):
+        mean = np.round(mean)
+    return mean.astype(grid.dtype)
+
+def alignment(factors):
+    """ Crops must start on a block of every level, to be reduced along the grids """
+    return int(np.lcm.reduce([1, *factors]))
+
+def level_name(factor):
+    return f"/Pyramid/x{factor}"
+
+def write_level_info(hdf, factor):
+    """
+    `VolumeInfo` of the level of `factor`. Each coarse voxel is centered on the block
+    of fine voxels it comes from, so the origin moves by half a block (minus half a
+    fine voxel).
+    """
+    vinfo = hdf["VolumeInfo"]
+    affine = Affine.from_volume_info(hdf)
+    group = hdf.require_group(level_name(factor))
+    if "VolumeInfo" in group: # From an interrupted run
+        del group["VolumeInfo"]
+    group = group.create_group("VolumeInfo")
+    group.create_dataset("origin", data=affine.to_world(np.full(3, (factor - 1) / 2)))
+    group.create_dataset("directions", data=vinfo["directions"][()])
+    group.create_dataset("resolution", data=vinfo["resolution"][()] * factor)
+    group.create_dataset("shape", data=vinfo["shape"][()] // factor)
+    if "colorMap" in vinfo:
+        group.create_dataset("colorMap", data=vinfo["colorMap"][()])
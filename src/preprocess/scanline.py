@@ -0,0 +1,100 @@
+"""
+Voxelization by casting one ray per (i, j) column of the voxel grid, along k.
+"""
+
+import numpy as np
+
+
+
+def _edge(p, u, v):
+    """ 2D edge function, positive when `p` is on the left of `u` -> `v` """
+    return (v[:, 0] - u[:, 0]) * (p[:, 1] - u[:, 1]) - (v[:, 1] - u[:, 1]) * (p[:, 0] - u[:, 0])
+
+def _owns_edge(u, v, sign):
+    """
+    Top-left rule, so a ray going exactly through an edge shared by two triangles
+    is only counted once.
+    """
+    dx = (v[:, 0] - u[:, 0]) * sign
+    dy = (v[:, 1] - u[:, 1]) * sign
+    return (dy < 0) | ((dy == 0) & (dx > 0))
+
+def _bin_triangles(tri, lower, upper):
+    """
+    Pair each triangle with the (i, j) columns its projection may cover.
+    Return the triangle index and the column of each pair.
+    """
+    cmin = np.maximum(np.ceil(tri[:, :, :2].min(axis=1)).astype(int), lower)
+    cmax = np.minimum(np.floor(tri[:, :, :2].max(axis=1)).astype(int), upper)
+    size = np.clip(cmax - cmin + 1, 0, None)
+    counts = size[:, 0] * size[:, 1]
+    tid = np.repeat(np.arange(tri.shape[0]), counts)
+    # Position of each pair inside its triangle footprint
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ii = cmin[tid, 0] + local // size[tid, 1]
+    jj = cmin[tid, 1] + local % size[tid, 1]
+    return tid, np.stack([ii, jj], axis=1)
+
+def _hits(tri, column):
+    """
+    Intersect the ray going through `column` along k with the paired triangle.
+    Return which pairs hit, the k coordinate of the hit and the winding sign.
+    """
+    a, b, c = tri[:, 0], tri[:, 1], tri[:, 2]
+    area = _edge(c, a, b)
+    sign = np.sign(area)
+    wa, wb, wc = _edge(column, b, c) * sign, _edge(column, c, a) * sign, _edge(column, a, b) * sign
+    hit = ((wa > 0) | ((wa == 0) & _owns_edge(b, c, sign))) \
+        & ((wb > 0) | ((wb == 0) & _owns_edge(c, a, sign))) \
+        & ((wc > 0) | ((wc == 0) & _owns_edge(a, b, sign))) \
+        & (area != 0) # Triangles parallel to the ray are never hit
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k = (wa * a[:, 2] + wb * b[:, 2] + wc * c[:, 2]) / abs(area)
+    return hit, k, sign.astype(int)
+
+def scanline2vox(vidx, faces, vshape, rule="parity", chunk_size=4096, region=None, columns=None):
+    """
+    Fill a `vshape` grid with the closed mesh of vertices `vidx`, expressed in voxel
+    index coordinates. Voxels are inside if the number of crossed faces before them
+    is odd ("parity"), or if the surface winds around them ("winding"). Triangles
+    are processed by chunks of `chunk_size` (triangle, column) pairs. If `region` is
+    given (`(2, 3)` lower and upper voxel indices, upper excluded), only that part of
+    the grid is filled and returned. Each column is cast on its own, so it's the
+    same as cropping the whole grid. If `columns` is given (a boolean mask of the
+    (i, j) columns of the region), only those are cast, others are left empty.
+    """
+    box = np.stack([np.zeros(3, dtype=int), vshape]) if region is None else np.asarray(region)
+    grid = np.zeros(box[1] - box[0], dtype=bool)
+    # Only work in the part of the grid covered by the mesh
+    lower = np.maximum(np.ceil(vidx.min(axis=0)).astype(int), box[0])
+    upper = np.minimum(np.floor(vidx.max(axis=0)).astype(int), box[1] - 1)
+    if (upper < lower).any():
+        return grid
+    sub_shape = upper - lower + 1
+    crossings = np.zeros(sub_shape.prod(), dtype=int)
+    tri = vidx[faces]
+    if region is not None: # Triangles away from its columns can't cross them
+        keep = ((tri[:, :, :2].max(axis=1) >= lower[:2]) & (tri[:, :, :2].min(axis=1) <= upper[:2])).all(axis=1)
+        tri = tri[keep]
+        if not tri.shape[0]:
+            return grid
+    # Rough estimate of columns per triangle, to get chunks of `chunk_size` pairs
+    extent = np.ptp(tri[:, :, :2], axis=1) + 1
+    step = max(1, int(chunk_size // max(1, np.prod(extent, axis=1).mean())))
+    for start in range(0, tri.shape[0], step):
+        chunk = tri[start:start + step]
+        tid, column = _bin_triangles(chunk, lower[:2], upper[:2])
+        if columns is not None:
+            keep = columns[column[:, 0] - box[0, 0], column[:, 1] - box[0, 1]]
+            tid, column = tid[keep], column[keep]
+        hit, k, sign = _hits(chunk[tid], column)
+        # A hit toggles every voxel strictly above it
+        pos = np.clip(np.floor(k[hit]).astype(int) + 1 - lower[2], 0, None)
+        keep = pos < sub_shape[2]
+        column, pos = column[hit][keep] - lower[:2], pos[keep]
+        flat = np.ravel_multi_index((column[:, 0], column[:, 1], pos), sub_shape)
+        np.add.at(crossings, flat, 1 if rule == "parity" else sign[hit][keep])
+    crossings = np.cumsum(crossings.reshape(sub_shape), axis=2)
+    inside = crossings % 2 == 1 if rule == "parity" else crossings != 0
+    grid[tuple(slice(l, u + 1) for l, u in zip(lower - box[0], upper - box[0]))] = inside
+    return grid
@@ -0,0 +1,64 @@
+"""
+Order files so the costliest ones start first, and the run doesn't end waiting on a
+long one started last. Also size the pool of workers to the available memory.
+"""
+
+import numpy as np
+import os
+
+from preprocess.plyio import ply_bounds
+
+try:
+    import psutil
+except ImportError: # Only POSIX systems can tell their free memory then
+    psutil = None
+
+
+
+SCHEDULES = ["cost", "listed"]
+# Memory of a worker before it voxelizes anything: interpreter, numpy, scipy, trimesh, h5py
+# (about 130 MiB once imported), and their caches
+WORKER_OVERHEAD = 256 * 2**20
+
+
+def job_cost(mpath, vres):
+    """
+    Estimated cost of the acquisition of mesh directory `mpath`: its number of frames
+    times the number of voxels in the bounding box of its first mesh
+    """
+    fnames = sorted(mpath.glob("*.ply")) if mpath.is_dir() else []
+    if not fnames:
+        return 0
+    lower, upper = ply_bounds(fnames[0])
+    return len(fnames) * float(np.prod(np.ceil((upper - lower) / vres) + 1))
+
+def longest_first(jobs, costs):
+    """ `jobs` by decreasing cost, ties keep their order """
+    order = sorted(range(len(jobs)), key=lambda i: -costs[i])
+    return [jobs[i] for i in order]
+
+def available_memory():
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def input_buffers(shape, queue_depth):
+    """
+    Bytes held by a worker extracting input frames of `shape`: raw and colorized
+    frames in flight (`queue_depth` queued, one being fetched, mapped or written) and
+    the scratch slice of the LUT mapping
+    """
+    voxels = int(np.prod(shape))
+    return 2 * (queue_depth + 2) * voxels + np.dtype(np.intp).itemsize * voxels // int(shape[0])
+
+def worker_count(memory_budget, input_bytes=0, nb_jobs=None):
+    """
+    Number of workers that fit in the available memory, each using `memory_budget`
+    bytes to voxelize ground truth and `input_bytes` to extract input (on top of
+    `WORKER_OVERHEAD`). No more than CPUs, nor `nb_jobs` if given.
+    """
+    count = int(available_memory() // (WORKER_OVERHEAD + memory_budget + input_bytes))
+    count = min(count, os.cpu_count() or 1)
+    if nb_jobs is not None:
+        count = min(count, nb_jobs)
+    return max(1, count)
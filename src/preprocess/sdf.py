@@ -0,0 +1,88 @@
+"""
+Signed distance to the ground truth surface, computed from the voxel grids with
+Euclidean distance transforms instead of querying meshes again.
+"""
+
+import numpy as np
+import scipy.ndimage as sci
+
+from preprocess.layout import GridWriter, Grids
+from preprocess.pyramid import level_name
+from utils.profiling import NullProfiler
+
+
+
+SDF_DTYPES = ["float16", "int8"]
+
+
+def _edt(grid, sampling):
+    """ Outside voxels get their distance to the nearest inside one, and conversely (negated) """
+    return sci.distance_transform_edt(~grid, sampling=sampling) \
+         - sci.distance_transform_edt(grid, sampling=sampling)
+
+def grid2sdf(grid, sampling, band=None):
+    """
+    Signed distance (in the unit of `sampling`, the voxel size along each axis) from
+    each voxel center of the boolean `grid` to the nearest voxel center on the other
+    side of its surface, negative inside. If `band` is given, distances are clipped
+    to `[-band, band]`, and only computed in the bounding box of the inside grown by
+    `band` (nothing further can be closer than `band` to the surface).
+    """
+    sampling = np.asarray(sampling, dtype=float)
+    if not grid.any(): # No surface, everything is as far as can be
+        return np.full(grid.shape, np.inf if band is None else band)
+    if band is None:
+        return _edt(grid, sampling)
+    inside = np.argwhere(grid)
+    margin = np.ceil(band / sampling).astype(int) + 1
+    lower = np.maximum(inside.min(axis=0) - margin, 0)
+    upper = np.minimum(inside.max(axis=0) + margin + 1, grid.shape)
+    box = tuple(slice(l, u) for l, u in zip(lower, upper))
+    sdf = np.full(grid.shape, float(band))
+    sdf[box] = np.clip(_edt(grid[box], sampling), -band, band)
+    return sdf
+
+def quantize(sdf, band, dtype="float16"):
+    """ Store `sdf` as float16, or as int8 scaled so `[-band, band]` maps to `[-127, 127]` """
+    if dtype == "float16":
+        return sdf.astype(np.float16)
+    return np.round(np.clip(sdf, -band, band) / band * 127).astype(np.int8)
+
+def _add_level_sdf(group, sampling, band, dtype, storage, profiler):
+    gt = Grids(group["GroundTruth"])
+    if "GroundTruthSDF" in group: # Computed again from scratch
+        del group["GroundTruthSDF"]
+    out = group.create_group("GroundTruthSDF")
+    # Values outside of cropped grids, as `Grids` fills them with it
+    fill = np.inf if band is None else band
+    out.attrs["fill"] = quantize(np.full(1, fill), band, dtype)[0]
+    out.attrs["scale"] = 1. if dtype == "float16" else band / 127
+    crop = {} if not gt.cropped else { "offset": gt.offset, "full_shape": gt.shape }
+    # Same layout as the ground truth unless told otherwise, levels have their own
+    writer = GridWriter(out, len(gt), **crop, **{ "layout": gt.layout, **storage, "pyramid": () })
+    for i in range(len(gt)):
+        with profiler.stage("sdf", i):
+            grid = gt.crop(i)
+            if grid.dtype != bool: # Fraction of each voxel inside, for coarse levels
+                grid = grid >= 0.5
+            writer.write(i, quantize(grid2sdf(grid, sampling, band), band, dtype))
+
+def add_sdf(hdf, band=None, dtype="float16", storage=None, profiler=None):
+    """
+    Store the signed distance map of every ground truth frame of `hdf` (and of each
+    of its pyramid levels) in `GroundTruthSDF`, in meters. Stored values are to be
+    multiplied by the `scale` attribute of the group (1 unless quantized to int8,
+    which needs a `band`).
+    """
+    if storage is None: # Not `storage_options`, its layout would override the ground truth one
+        storage = {}
+    if profiler is None:
+        profiler = NullProfiler()
+    if dtype == "int8" and band is None:
+        raise ValueError("Signed distances can only be quantized to int8 within a band.")
+    levels = [hdf]
+    if "Pyramid" in hdf:
+        levels += [hdf[level_name(int(k[1:]))] for k in sorted(hdf["Pyramid"].keys())]
+    for group in levels:
+        sampling = group["VolumeInfo"]["resolution"][()]
+        _add_level_sdf(group, sampling, band, dtype, storage, profiler)
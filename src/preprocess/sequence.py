@@ -0,0 +1,122 @@
+"""
+Meshes of every frame of an acquisition. AutoRVQ meshes share their faces, only
+vertices move, so they're stored once for all frames.
+"""
+
+import h5py
+import numpy as np
+import trimesh as tm
+
+from preprocess.plyio import load_mesh
+
+
+
+class MeshSequence:
+    """
+    Meshes of `frames`. If they share the same topology, `faces` is a single
+    `(F, 3)` array and `vertices` a `(T, V, 3)` one. Otherwise, both are lists with
+    one array per frame, and every method falls back to looping over frames.
+    """
+    def __init__(self, frames, vertices, faces):
+        self.frames = [int(f) for f in frames]
+        self.vertices = vertices
+        self.faces = faces
+
+    @property
+    def shared(self):
+        return isinstance(self.vertices, np.ndarray)
+
+    @classmethod
+    def from_meshes(cls, frames, meshes):
+        faces = meshes[0].faces
+        if all(m.faces.shape == faces.shape and np.array_equal(m.faces, faces) for m in meshes):
+            return cls(frames, np.stack([m.vertices for m in meshes]), faces)
+        return cls(frames, [m.vertices for m in meshes], [m.faces for m in meshes])
+
+    @classmethod
+    def from_plys(cls, fnames, cache=None):
+        """ Load PLYs named after their frame number, as written by AutoRVQ """
+        frames = [int(fname.stem.split('_')[-1]) for fname in fnames]
+        return cls.from_meshes(frames, [load_mesh(fname, cache) for fname in fnames])
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _faces(self, i):
+        return self.faces if self.shared else self.faces[i]
+
+    def __getitem__(self, i):
+        """ Mesh of the `i`-th frame, or a sub-sequence if `i` is a slice or a list """
+        if isinstance(i, (int, np.integer)):
+            # Meshes were processed once loaded, no need to do it again
+            return tm.Trimesh(vertices=self.vertices[i], faces=self._faces(i), process=False)
+        idx = np.arange(len(self))[i]
+        frames = [self.frames[j] for j in idx]
+        if self.shared:
+            return MeshSequence(frames, self.vertices[idx], self.faces)
+        return MeshSequence(frames, [self.vertices[j] for j in idx], [self.faces[j] for j in idx])
+
+    def items(self):
+        for i, frame in enumerate(self.frames):
+            yield frame, self[i]
+
+    def transform(self, affine):
+        """ Vertices of every frame in voxel indices of the grid of `affine` """
+        if self.shared:
+            return affine.to_voxel(self.vertices)
+        return [affine.to_voxel(v) for v in self.vertices]
+
+    def bounds(self):
+        """ `(T, 2, 3)` bounding box of each frame """
+        if self.shared:
+            return np.stack([self.vertices.min(axis=1), self.vertices.max(axis=1)], axis=1)
+        return np.array([[v.min(axis=0), v.max(axis=0)] for v in self.vertices])
+
+    def roi(self, affine, margin=0, align=1):
+        """
+        `(2, 3)` lower (included) and upper (excluded) voxel indices of the box holding
+        every frame in the grid of `affine`, grown by `margin` voxels. Its lower corner
+        is a multiple of `align`, and so is its size unless it reaches the grid end.
+        """
+        vertices = self.vertices if self.shared else np.concatenate(self.vertices)
+        lower, upper = affine.bounds(vertices)
+        lower = np.maximum(lower - margin, 0) // align * align
+        size = -(-(upper + 1 + margin - lower) // align) * align
+        return np.stack([lower, np.minimum(lower + size, affine.shape)])
+
+    def volumes(self):
+        """
+        Enclosed volume of each frame, as the sum of the signed volumes of the
+        tetrahedra made by each face and the origin (meshes must be closed).
+        """
+        if self.shared:
+            tri = self.vertices[:, self.faces] # (T, F, 3, 3)
+            signed = np.einsum("tfi,tfi->t", tri[:, :, 0], np.cross(tri[:, :, 1], tri[:, :, 2]))
+        else:
+            signed = []
+            for v, f in zip(self.vertices, self.faces):
+                tri = v[f]
+                signed.append(np.einsum("fi,fi->", tri[:, 0], np.cross(tri[:, 1], tri[:, 2])))
+        # Sign only depends on faces orientation
+        return np.abs(signed) / 6
+
+    def save(self, group):
+        """ Store the sequence in the HDF `group`, replacing what's in it """
+        for key in list(group.keys()):
+            del group[key]
+        group.create_dataset("frames", data=self.frames)
+        if self.shared:
+            group.create_dataset("vertices", data=self.vertices)
+            group.create_dataset("faces", data=self.faces)
+            return
+        for f, v, t in zip(self.frames, self.vertices, self.faces):
+            group.create_dataset(f"vertices/frame{f:02d}", data=v)
+            group.create_dataset(f"faces/frame{f:02d}", data=t)
+
+    @classmethod
+    def load(cls, group):
+        frames = group["frames"][()]
+        if isinstance(group["vertices"], h5py.Group): # One dataset per frame
+            return cls(frames, [group[f"vertices/frame{f:02d}"][()] for f in frames],
+                       [group[f"faces/frame{f:02d}"][()] for f in frames])
+        return cls(frames, group["vertices"][()], group["faces"][()])
@@ -0,0 +1,100 @@
+"""
+Stand-ins for the image source of Image3dAPI, serving frames from numpy arrays or
+from already extracted HDFs, and for its file loader. They expose the same methods
+`dcm2vox` uses, so it can run without Windows or COM.
+"""
+
+import h5py
+import numpy as np
+
+from types import SimpleNamespace
+
+from preprocess.layout import Grids
+
+
+
+class ArraySource:
+    """
+    Image source of `frames`, a `(T, X, Y, Z)` uint8 array, with its bounding box
+    given by `origin` and `directions` (one direction per row, scaled to the box
+    size).
+    """
+    def __init__(self, frames, times, origin, directions, ecg_samples=None, ecg_times=None,
+                 color_map=None):
+        self.frames = frames
+        self.times = times
+        self.origin = np.asarray(origin, dtype=float)
+        self.directions = np.asarray(directions, dtype=float)
+        self.ecg_samples = np.zeros(0) if ecg_samples is None else np.asarray(ecg_samples)
+        self.ecg_times = np.zeros(0) if ecg_times is None else np.asarray(ecg_times)
+        # Gray scale, stored as unsigned int like the API does
+        self.color_map = np.arange(256, dtype=np.uint32) if color_map is None else color_map
+
+    def GetFrameCount(self):
+        return self.frames.shape[0]
+
+    def GetFrame(self, index, bbox=None, max_res=None):
+        """ Frames are returned as they are stored, `bbox` and `max_res` are ignored """
+        frame = self.frames[index]
+        # Image3dAPI buffers go along the first axis first
+        data = np.asfortranarray(frame).ravel(order='F')
+        return SimpleNamespace(data=data, dims=frame.shape, stride0=frame.shape[0],
+                               stride1=frame.shape[0] * frame.shape[1],
+                               time=float(self.times[index]))
+
+    def GetBoundingBox(self):
+        bbox = SimpleNamespace()
+        for i, axis in enumerate("xyz"):
+            setattr(bbox, f"origin_{axis}", self.origin[i])
+            for d in range(3):
+                setattr(bbox, f"dir{d + 1}_{axis}", self.directions[d, i])
+        return bbox
+
+    def GetECG(self):
+        return SimpleNamespace(samples=self.ecg_samples, trig_times=self.ecg_times)
+
+    def GetColorMap(self):
+        return self.color_map
+
+
+class HDFSource(ArraySource):
+    """
+    Image source of the input frames of `fname`, a pre-processed (or partially
+    pre-processed) HDF. Frames are read lazily. They're already mapped to colors,
+    so the served color map is the identity.
+    """
+    def __init__(self, fname):
+        self.hdf = h5py.File(fname, 'r')
+        vinfo, ecg = self.hdf["VolumeInfo"], self.hdf["ECG"]
+        times = ecg["times"][()] if ecg["times"].shape else np.zeros(0)
+        # Times were spread evenly between the two trigger times
+        trig_times = times[[0, -1]] if times.size > 1 else np.zeros(0)
+        super().__init__(Grids(self.hdf["Input"]), self.hdf["FrameInfo/frameTimes"][()],
+                         vinfo["origin"][()], vinfo["directions"][()],
+                         ecg_samples=ecg["samples"][()], ecg_times=trig_times)
+
+    def GetFrameCount(self):
+        return len(self.frames)
+
+    def close(self):
+        self.hdf.close()
+
+
+class HDFLoader:
+    """
+    File loader serving HDFs as `HDFSource`. Like the one of Image3dAPI, it's
+    created once and loads files one after the other.
+    """
+    def __init__(self):
+        self.source = None
+        self.loaded = 0
+
+    def LoadFile(self, fname):
+        if self.source is not None: # Done with the previous one
+            self.source.close()
+        self.source = HDFSource(fname)
+        self.loaded += 1
+        return 0, "" # Error type and message, as the API does
+
+    def GetImageSource(self):
+        return self.source
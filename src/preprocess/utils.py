@@ -2,14 +2,20 @@
 Code from Gabriel Kiss 01.2020
 """
 
-import comtypes
 import ctypes
 import numpy as np
 
+try:
+    import comtypes
+except ImportError: # Not on Windows, only stand-in sources can be used
+    comtypes = None
+
 
 
 def safe2np(safearr_ptr, copy=True):
     """ Convert a SAFEARRAY buffer to its numpy equivalent """
+    if isinstance(safearr_ptr, np.ndarray): # Already converted by a stand-in source
+        return np.copy(safearr_ptr) if copy else safearr_ptr
     # Only support 1D data for now
     assert(comtypes._safearray.SafeArrayGetDim(safearr_ptr) == 1)
     # Access underlying pointer
@@ -23,9 +29,28 @@ def safe2np(safearr_ptr, copy=True):
     arr = np.ctypeslib.as_array(data_ptr, shape=(array_size,))
     return np.copy(arr) if copy else arr
 
-def frame2arr(frame):
+def frame2view(frame):
+    """ Strided view of the frame buffer, only valid as long as `frame` is """
     arr1d = safe2np(frame.data, copy=False)
     assert(arr1d.dtype == np.uint8) # Only tested with 1 byte element
-    arr3d = np.lib.stride_tricks.as_strided(arr1d, shape=frame.dims,
-                                            strides=(1, frame.stride0, frame.stride1))
-    return np.copy(arr3d)
+    return np.lib.stride_tricks.as_strided(arr1d, shape=frame.dims,
+                                           strides=(1, frame.stride0, frame.stride1))
+
+def frame2arr(frame):
+    return np.copy(frame2view(frame))
+
+def apply_lut(arr, lut, out=None, scratch=None):
+    """
+    Map `arr` values through `lut`, writing into `out` without any full size
+    intermediate array. Work slice by slice along the first axis, `scratch` holds
+    the indices of one slice. Give both `out` and `scratch` to not allocate anything.
+    """
+    if out is None:
+        out = np.empty(arr.shape, dtype=lut.dtype)
+    if scratch is None:
+        scratch = np.empty(arr.shape[1:], dtype=np.intp)
+    for i in range(arr.shape[0]):
+        np.copyto(scratch, arr[i], casting="unsafe")
+        # `clip` is never triggered with a full LUT, but it spares numpy a buffered copy
+        np.take(lut, scratch, out=out[i], mode="clip")
+    return out
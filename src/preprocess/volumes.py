@@ -0,0 +1,101 @@
+"""
+Right ventricle volume of each frame, computed from our own data (meshes and
+ground truth grids), and the ejection fraction derived from it. Volumes are in
+millilitres, like the AutoRVQ CSVs stored in `VolumeInfo/volumes`.
+"""
+
+import h5py
+import numpy as np
+
+from preprocess.affine import Affine
+from preprocess.index import closest_frames, file_entry
+from preprocess.layout import Grids
+from preprocess.sequence import MeshSequence
+
+
+
+ML_PER_M3 = 1e6
+SOURCES = ["mesh", "grid", "csv"]
+
+
+def mesh_volumes(hdf, nbf):
+    """ Volume of each of the `nbf` frames from the meshes in `Mesh/`, NaN where missing """
+    volumes = np.full(nbf, np.nan)
+    if "Mesh" not in hdf:
+        return volumes
+    meshes = MeshSequence.load(hdf["Mesh"])
+    volumes[meshes.frames] = meshes.volumes() * ML_PER_M3
+    return volumes
+
+def grid_volumes(hdf, nbf):
+    """
+    Volume of each of the `nbf` frames from the ground truth, its voxel count times
+    the volume of a voxel. Grids are only read if they have no `voxelCount`.
+    """
+    volumes = np.full(nbf, np.nan)
+    if "GroundTruth" not in hdf:
+        return volumes
+    grids = Grids(hdf["GroundTruth"])
+    # Axes may not be orthogonal, a voxel is the parallelepiped of the grid steps
+    voxel = abs(np.linalg.det(Affine.from_volume_info(hdf).delta)) * ML_PER_M3
+    for f in range(nbf):
+        if f not in grids:
+            continue
+        count = grids.attrs(f).get("voxelCount")
+        volumes[f] = (grids.crop(f).sum() if count is None else count) * voxel
+    return volumes
+
+def csv_volumes(hdf, nbf):
+    """ Volume of each of the `nbf` frames as given by AutoRVQ, NaN if not attached """
+    volumes = np.full(nbf, np.nan)
+    if "volumes" in hdf["VolumeInfo"]:
+        csv = hdf["VolumeInfo"]["volumes"][()]
+        volumes[:min(nbf, len(csv))] = csv[:nbf]
+    return volumes
+
+
+def ejection_fraction(volumes, ed, es):
+    """
+    End diastolic and systolic volumes (averaged over the `ed` and `es` frames of
+    every beat) and ejection fraction of each row of `volumes`, a `(S, T)` array
+    """
+    edv = volumes[:, ed].mean(axis=1)
+    esv = volumes[:, es].mean(axis=1)
+    return edv, esv, (edv - esv) / edv
+
+
+def file_volumes(hname):
+    """
+    Volumes of each frame of `hname` from every source (`<source>Volumes`), with the
+    EDV, ESV and EF they give if key frames are known (e.g. `efMesh`), and how far
+    mesh and grid volumes are from the CSV ones (`<source>Error`, the largest
+    relative difference over frames). Missing values are None.
+    """
+    with h5py.File(hname, 'r') as hdf:
+        nbf = int(hdf["FrameInfo"]["frameNumber"][()])
+        volumes = np.stack([mesh_volumes(hdf, nbf), grid_volumes(hdf, nbf), csv_volumes(hdf, nbf)])
+        keys = "endDiastole" in hdf["FrameInfo"] and "endSystole" in hdf["FrameInfo"]
+        ed = closest_frames(hdf, "endDiastole") if keys else None
+        es = closest_frames(hdf, "endSystole") if keys else None
+    # Flat, so the index table can be queried on any of them
+    result = { f"{s}Volumes": _floats(v) for s, v in zip(SOURCES, volumes) }
+    for k, values in zip(["edv", "esv", "ef"], ejection_fraction(volumes, ed, es) if keys
+                                               else [np.full(len(SOURCES), np.nan)] * 3):
+        result.update({ f"{k}{s.capitalize()}": _float(v) for s, v in zip(SOURCES, values) })
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error = np.abs(volumes[:2] - volumes[2]) / volumes[2]
+    for s, e in zip(SOURCES, error):
+        # All-NaN rows (e.g. no CSV attached) have no error
+        result[f"{s}Error"] = None if np.isnan(e).all() else float(np.nanmax(e))
+    return result
+
+def indexed_volumes(hname, uptodate=False):
+    """ Index entry of `hname` (None if `uptodate`) and its `file_volumes`, in one go for workers """
+    return None if uptodate else file_entry(hname), file_volumes(hname)
+
+def _float(value):
+    """ JSON-friendly `value`, NaN becoming None """
+    return None if np.isnan(value) else float(value)
+
+def _floats(values):
+    return [_float(v) for v in values]
@@ -1,70 +1,232 @@
 import click as cli
+import cProfile
 import h5py
 import json
 import numpy as np
+import os
 import pandas as pd
 import yaml
 
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing import Manager
-from pathlib import WindowsPath
+from pathlib import Path
 
 from preprocess import dcm2vox, ply2vox
-from utils.progress import NestedProgress
+from preprocess.checkpoint import Checkpoint
+from preprocess.dicoms import init_loaders, input_shape
+from preprocess.index import DatasetIndex, file_entry
+from preprocess.layout import LAYOUTS, storage_options
+from preprocess.pipeline import format_stats
+from preprocess.plyio import PlyCache
+from preprocess.pyramid import REDUCTIONS
+from preprocess.schedule import SCHEDULES, input_buffers, job_cost, longest_first, worker_count
+from preprocess.sdf import SDF_DTYPES, add_sdf
+from preprocess.sequence import MeshSequence
+from utils.profiling import NullProfiler, Profiler, profile_report
+from utils.progress import NestedProgress, ProgressChannel, ProgressListener
 
 
 
+# Stages of the pre-processing, and how they're named in checkpoints
+STAGES = { "extract-input": "input", "voxelize-gt": "groundtruth", "attach-metadata": "metadata" }
+
+
 def _get_dcm_name(mpath, dcm): #FIXME: Dunno if this is correct
     mname = next(mpath.glob("*.ply")).stem.split('_')[0]
     for dname in dcm.iterdir():
         if dname.stem != mname:
             return dname # If it has the same name as mesh, then it's EchoPAC annotation
 
-def file2vox(dcm, plydir, voldir, infodir, vres, opath, progress, tid):
+def _open_output(hname, checkpoint, resume):
+    """
+    Open the partial output file, resuming it if asked and possible. Unfinished
+    files have a `.part` suffix, so they're never mistaken for complete ones.
+    """
+    pname = hname.with_name(hname.name + ".part")
+    if resume and pname.exists():
+        try:
+            return h5py.File(pname, 'a'), pname
+        except OSError: # Interrupted while writing something it couldn't recover from
+            pass
+    checkpoint.clear()
+    return h5py.File(pname, 'w'), pname
+
+def _replace_dataset(group, name, data):
+    if name in group: # Written by an interrupted run
+        del group[name]
+    group.create_dataset(name, data=data)
+
+def file2vox(dcm, plydir, voldir, infodir, vres, opath, stages, storage, vox_opts, crop_input,
+             sdf, resume, queue_depth, profile, progress, tid):
     nmesh = len(list(plydir.iterdir()))
-    if not dcm.is_dir():
+    extract = "extract-input" in stages
+    if extract and not dcm.is_dir():
         progress[tid] = { "progress": nmesh, "total": nmesh }
         return
     mpath = plydir.joinpath(dcm.name)
-    # There's several dicom associated to the patient, we make sure to get the correct one
-    dname = _get_dcm_name(mpath, dcm)
-    hdf = h5py.File(opath.joinpath(mpath.name).with_suffix(".h5"), 'w')
-    dcm2vox(dname, hdf, vres) # Input 3D images
-    ply2vox(mpath, hdf, progress, tid) # Ground truth 3D mesh
-    # Add volumes + ES & ED frame number and time
-    if voldir is not None:
-        vol = pd.read_csv(next(voldir.joinpath(mpath.name).glob("*_volume.csv")))
-        hdf["VolumeInfo"].create_dataset("volumes", data=vol.volume)
-    if infodir is not None:
-        with open(next(infodir.joinpath(mpath.name).glob("*.json")), 'r') as fd:
-            key_frames = json.load(fd)["segmentation_stage"]["key_frames_time"]
-        # Storing only timestamp is sufficient
-        hdf["FrameInfo"].create_dataset("endDiastole", data=key_frames["ed"])
-        hdf["FrameInfo"].create_dataset("endSystole", data=key_frames["es"])
-    hdf.close()
+    hname = opath.joinpath(mpath.name + ".h5") # Patient names may have dots
+    if hname.exists() and (resume or not extract): # Already fully processed
+        progress[tid] = { "progress": nmesh, "total": nmesh }
+        return hname
+    if not extract and not hname.with_name(hname.name + ".part").exists(): # Never extracted
+        progress[tid] = { "progress": nmesh, "total": nmesh }
+        return
+    profiler = Profiler() if profile else NullProfiler()
+    if profile:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    try:
+        # Stages run on their own pick up the intermediate file where previous ones left it
+        keep = resume or not extract
+        checkpoint = Checkpoint(hname.with_name(hname.name + ".json"), keep)
+        hdf, pname = _open_output(hname, checkpoint, keep)
 
+        def todo(stage):
+            if stage not in stages or (resume and checkpoint.done(STAGES[stage])):
+                return False
+            if not resume: # Explicitly asked again, so redo it from scratch
+                checkpoint.reset(STAGES[stage])
+            return True
+
+        with profiler.stage("file"):
+            if todo("extract-input"):
+                # There's several dicom associated to the patient, we make sure to get the correct one
+                dname = _get_dcm_name(mpath, dcm)
+                meshes = None
+                if crop_input: # Meshes tell where to crop
+                    meshes = MeshSequence.from_plys(sorted(mpath.glob("*.ply")), vox_opts["ply_cache"])
+                with profiler.stage("input"): # Input 3D images
+                    stats = dcm2vox(dname, hdf, vres, storage, checkpoint, queue_depth, profiler,
+                                    meshes, vox_opts["roi_margin"])
+                for sname, s in stats.items():
+                    progress.timing(sname, s["busy"], s["items"])
+                checkpoint.mark("input", hdf=hdf)
+            if not checkpoint.done("input"):
+                hdf.close()
+                raise RuntimeError(f"Input extraction of {pname} is unfinished, run `extract-input` with `--resume`.")
+            if todo("voxelize-gt"):
+                with profiler.stage("groundtruth"): # Ground truth 3D mesh
+                    # Without PLYs, meshes stored by a previous run are voxelized again
+                    ply2vox(mpath if mpath.is_dir() else None, hdf, progress, tid, storage=storage,
+                            checkpoint=checkpoint, profiler=profiler, **vox_opts)
+                    if sdf is not None: # Derived from the grids, so part of the same stage
+                        add_sdf(hdf, sdf["band"], sdf["dtype"], storage, profiler)
+                checkpoint.mark("groundtruth", hdf=hdf)
+            if todo("attach-metadata"): # Add volumes + ES & ED frame number and time
+                with profiler.stage("metadata"):
+                    if voldir is not None:
+                        vol = pd.read_csv(next(voldir.joinpath(mpath.name).glob("*_volume.csv")))
+                        _replace_dataset(hdf["VolumeInfo"], "volumes", vol.volume)
+                    if infodir is not None:
+                        with open(next(infodir.joinpath(mpath.name).glob("*.json")), 'r') as fd:
+                            key_frames = json.load(fd)["segmentation_stage"]["key_frames_time"]
+                        # Storing only timestamp is sufficient
+                        _replace_dataset(hdf["FrameInfo"], "endDiastole", key_frames["ed"])
+                        _replace_dataset(hdf["FrameInfo"], "endSystole", key_frames["es"])
+                checkpoint.mark("metadata", hdf=hdf)
+        profiler.save(hdf)
+        hdf.close()
+        if all(checkpoint.done(stage) for stage in STAGES.values()):
+            # File is complete, make it visible as such
+            os.replace(pname, hname)
+            checkpoint.clear()
+    finally:
+        if profile: # Even when it failed, so the next files of this worker aren't profiled along
+            cprofiler.disable()
+            opath.joinpath("profiles").mkdir(exist_ok=True)
+            cprofiler.dump_stats(opath.joinpath("profiles", f"{mpath.name}.prof"))
+    if profile:
+        progress.profile(mpath.name, profiler.records)
+    return hname if hname.exists() else None
+
+def file2entry(index, *args):
+    """
+    `file2vox`, along with the index entry of the file (computed here, it reads the
+    whole file for its checksum). The entry is None if not `index`ing or up to date.
+    """
+    hname = file2vox(*args)
+    if not index or hname is None or DatasetIndex(hname.parent).uptodate(hname):
+        return hname, None
+    return hname, file_entry(hname)
 
 
 @cli.command(context_settings={"help_option_names": ["--help", "-h"], "show_default": True})
-@cli.argument("dcmdir", type=cli.Path(exists=True, resolve_path=True, path_type=WindowsPath))
-@cli.argument("plydir", type=cli.Path(exists=True, resolve_path=True, path_type=WindowsPath))
+@cli.argument("dcmdir", type=cli.Path(exists=True, resolve_path=True, path_type=Path))
+@cli.argument("plydir", type=cli.Path(exists=True, resolve_path=True, path_type=Path))
 @cli.option("--volumes-directory", "-v", "voldir",
-            type=cli.Path(exists=True, resolve_path=True, path_type=WindowsPath),
+            type=cli.Path(exists=True, resolve_path=True, path_type=Path),
             help="Directory of CSVs with the blood volume for each frame.")
 @cli.option("--information-directory", "-i", "infodir",
-            type=cli.Path(exists=True, resolve_path=True, path_type=WindowsPath),
+            type=cli.Path(exists=True, resolve_path=True, path_type=Path),
             help="Directory of information about ED & ES time frame.")
 @cli.option("--voxel-resolution", "-r", "vres", type=cli.Tuple([cli.FloatRange(min=0)] * 3),
-            nargs=3, default=[0.0005] * 3, help="Voxel spacing in meter.")
+            multiple=True, default=[(0.0005,) * 3],
+            help="Voxel spacing in meter. Repeat it to also store coarser grids in `/Pyramid`, reduced from the finest ones (resolutions must be multiples of the finest one).")
 @cli.option("--output-directory", "-o", "opath", default="voxel-grids",
-            type=cli.Path(resolve_path=True, path_type=WindowsPath),
+            type=cli.Path(resolve_path=True, path_type=Path),
             help="Where to store generated voxel grids.")
 @cli.option("--exclude-files", "-e", "exclude",
-            type=cli.Path(exists=True, dir_okay=False, resolve_path=True, path_type=WindowsPath),
+            type=cli.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
             help="List of file to exclude from pre-processing. If given, must be a YAML file.")
-@cli.option("--number-workers", "-n", "nb_workers", default=1, type=cli.IntRange(min=1),
-            help="Number of worker used to accelerate file processing.")
-def data2hdf(dcmdir, plydir, voldir, infodir, vres, opath, exclude, nb_workers):
+@cli.option("--stages", "-s", multiple=True, default=list(STAGES), type=cli.Choice(STAGES),
+            help="Stages to run, repeat to run several. Without `extract-input`, DCMDIR is not read (it must still exist) and stages continue the `.part` files already in the output directory.")
+@cli.option("--resume/--no-resume", "-R/-F", default=False,
+            help="Skip complete files, and finish interrupted ones from where they stopped.")
+@cli.option("--number-workers", "-n", "nb_workers", default=1, type=cli.IntRange(min=0),
+            help="Number of worker used to accelerate file processing, 0 to fit as many as the available memory allows with `--memory-budget`.")
+@cli.option("--schedule", default="cost", type=cli.Choice(SCHEDULES),
+            help="Order in which files are processed, `cost` starts with the ones with the most frames and the largest meshes.")
+@cli.option("--frame-workers", "-w", default=1, type=cli.IntRange(min=1),
+            help="Number of worker used to voxelize the frames of each file.")
+@cli.option("--profile/--no-profile", "-p/-P", default=False,
+            help="Time each stage of every frame, store it in `/Profile` and write a report. Also dump `cProfile` stats of each file.")
+@cli.option("--queue-depth", "-q", default=2, type=cli.IntRange(min=1),
+            help="Number of frames waiting between each step of the DICOM extraction pipeline.")
+@cli.option("--voxelizer", "-x", default="contains", type=cli.Choice(["contains", "scanline"]),
+            help="Engine used to voxelize meshes, `scanline` casts one ray per grid column.")
+@cli.option("--chunk-size", "-c", default=4096, type=cli.IntRange(min=1),
+            help="Number of voxels tested at once against a mesh, bound each worker memory.")
+@cli.option("--incremental/--no-incremental", "-I/-N", default=False,
+            help="Update the previous frame grid around the moving surface instead of voxelizing every frame from scratch.")
+@cli.option("--band-width", "-b", default=1, type=cli.IntRange(min=1),
+            help="Width (in voxels) of the band around surfaces re-tested by incremental voxelization.")
+@cli.option("--memory-budget", "-m", default=None, type=cli.IntRange(min=1),
+            help="Memory (in MiB) each worker voxelizes ground truth in, by slabs written as soon as they're done. Grids are the same as without it.")
+@cli.option("--ply-cache", "ply_cache", default=None,
+            type=cli.Path(file_okay=False, resolve_path=True, path_type=Path),
+            help="Directory where to keep parsed meshes, so re-runs don't parse PLYs again.")
+@cli.option("--ply-cache-size", default=1024, type=cli.IntRange(min=0),
+            help="Size (in MiB) above which least recently used meshes are evicted from the PLY cache.")
+@cli.option("--store-meshes/--no-store-meshes", default=False,
+            help="Also store meshes in `/Mesh`, so ground truth can be voxelized again (and volumes computed) without the PLYs.")
+@cli.option("--roi-margin", default=None, type=cli.IntRange(min=0),
+            help="Only voxelize and store ground truth in the box holding the ventricle of every frame, grown by that many voxels. Grids are read back full size with `Grids`.")
+@cli.option("--crop-input/--no-crop-input", default=False,
+            help="Also store input in that box only (needs `--roi-margin`).")
+@cli.option("--sdf/--no-sdf", default=False,
+            help="Also store the signed distance (in meters, negative inside) to the ground truth surface in `GroundTruthSDF`.")
+@cli.option("--sdf-band", default=None, type=cli.FloatRange(min=0, min_open=True),
+            help="Clip signed distances to that many meters around the surface.")
+@cli.option("--sdf-dtype", default="float16", type=cli.Choice(SDF_DTYPES),
+            help="Type signed distances are stored as, `int8` maps the band to [-127, 127] (needs `--sdf-band`).")
+@cli.option("--pyramid-reduction", "reduction", default="majority", type=cli.Choice(REDUCTIONS),
+            help="How coarser ground truth is reduced from the finest one, `fraction` stores the fraction of each voxel inside the mesh.")
+@cli.option("--layout", "-l", default="frames", type=cli.Choice(LAYOUTS),
+            help="Store grids as one dataset per frame, or as a single chunked 4D dataset per group.")
+@cli.option("--chunk-shape", "chunks", type=cli.IntRange(min=1), nargs=4, default=None,
+            help="Chunk shape (T, X, Y, Z) of grid datasets. Default to one frame in 64 voxels wide blocks for `stacked` layout.")
+@cli.option("--compression", "-z", default=None,
+            help="Compression filter of grid datasets (gzip, lzf, or the ID of a registered filter).")
+@cli.option("--compression-opts", "compression_opts", default=None, type=int,
+            help="Options of the compression filter (e.g. gzip level).")
+@cli.option("--shuffle/--no-shuffle", default=False, help="Whether to apply the shuffle filter to grid datasets.")
+@cli.option("--index/--no-index", default=False,
+            help="Add each complete file to the index of the output directory (`dataset-index.json` and `dataset-index.hdf5`).")
+def data2hdf(dcmdir, plydir, voldir, infodir, vres, opath, exclude, stages, resume, nb_workers,
+             schedule, frame_workers, profile, queue_depth, voxelizer, chunk_size, incremental,
+             band_width, memory_budget, ply_cache, ply_cache_size, store_meshes, roi_margin, crop_input, sdf,
+             sdf_band, sdf_dtype, reduction, layout, chunks, compression, compression_opts,
+             shuffle, index):
     """
     Convert GE DICOMs 3D volumes and 3D mesh to voxel grids. Store everything in an HDF.
 
@@ -73,37 +235,95 @@ def data2hdf(dcmdir, plydir, voldir, infodir, vres, opath, exclude, nb_workers):
     PLYDIR    PATH    Directory of PLYs output to convert to voxels.
     """
     opath.mkdir(exist_ok=True)
-    vres = np.array(vres)
+    # Coarser levels are reduced from the finest one by an integer factor
+    vres = np.array(sorted(vres, key=lambda r: r[0]))
+    factors = vres[1:] / vres[0]
+    if not (np.allclose(factors, np.round(factors)) and np.allclose(factors, factors[:, :1])):
+        raise cli.BadParameter("Resolutions must be the same integer multiple of the finest one on each axis.",
+                               param_hint="'--voxel-resolution'")
+    pyramid = [int(round(f)) for f in factors[:, 0]]
+    if crop_input and roi_margin is None:
+        raise cli.BadParameter("Input can only be cropped around the ventricle with a margin.",
+                               param_hint="'--roi-margin'")
+    vres = vres[0]
+    if memory_budget is not None and (incremental or frame_workers > 1):
+        raise cli.BadParameter("Frames are voxelized one after the other, from scratch, within a memory budget.",
+                               param_hint="'--memory-budget'")
+    if nb_workers == 0 and memory_budget is None:
+        raise cli.BadParameter("Workers can only be fit in memory with a memory budget.",
+                               param_hint="'--number-workers'")
+    if sdf and sdf_dtype == "int8" and sdf_band is None:
+        raise cli.BadParameter("Signed distances can only be quantized to int8 within a band.",
+                               param_hint="'--sdf-band'")
+    sdf = { "band": sdf_band, "dtype": sdf_dtype } if sdf else None
+    vox_opts = { "frame_workers": frame_workers, "voxelizer": voxelizer, "chunk_size": chunk_size,
+                 "incremental": incremental, "band_width": band_width, "roi_margin": roi_margin,
+                 "memory_budget": None if memory_budget is None else memory_budget * 2**20,
+                 "ply_cache": None if ply_cache is None else PlyCache(ply_cache, ply_cache_size * 2**20),
+                 "store_meshes": store_meshes }
+    storage = storage_options(layout, chunks, compression, compression_opts, shuffle, pyramid,
+                              reduction)
     if exclude is not None:
         with open(exclude, 'r') as fd:
             exclude = yaml.safe_load(fd)
     else:
         exclude = []
+    if "extract-input" in stages:
+        dcms = list(dcmdir.iterdir())
+    else: # DICOMs aren't needed, so this can run on another machine than the extraction
+        dcms = [dcmdir.joinpath(pname.name[:-len(".h5.part")]) for pname in opath.glob("*.h5.part")]
+    dcms = [dcm for dcm in dcms if dcm.name not in exclude]
+    if schedule == "cost": # Longest first, so none is left running alone at the end
+        dcms = longest_first(dcms, [job_cost(plydir.joinpath(dcm.name), vres) for dcm in dcms])
+    fit_workers = nb_workers == 0
+    if fit_workers:
+        input_bytes = 0
+        first = next((dcm for dcm in dcms if dcm.is_dir()), None)
+        if "extract-input" in stages and first is not None:
+            # Input buffers come on top of the budget, sized on the first file (the
+            # costliest one with `cost`)
+            shape = input_shape(_get_dcm_name(plydir.joinpath(first.name), first), vres)
+            input_bytes = input_buffers(shape, queue_depth)
+        nb_workers = worker_count(memory_budget * 2**20, input_bytes, len(dcms))
+    index = DatasetIndex(opath) if index else None
     with NestedProgress() as prb:
-        # Original code for multiprocessing:
-        # https://www.deanmontgomery.com/2022/03/24/rich-progress-and-multiprocessing/
+        if fit_workers:
+            prb.console.print(f"Using {nb_workers} workers.")
+        # Workers send updates through a queue, rendered by a thread waking up on each of them
         futures = [] # Keep track of jobs
         with Manager() as manager:
-            _progress = manager.dict()
+            channel = ProgressChannel(manager.Queue())
             tid1 = prb.add_task("Processing", progress_type="patient")
-            with ProcessPoolExecutor(max_workers=nb_workers) as executor:
-                for dcm in dcmdir.iterdir():
-                    if dcm.stem in exclude:
-                        continue
+            listener = ProgressListener(channel.queue, prb, tid1, len(dcms))
+            listener.start()
+            # Each worker creates its DICOM loaders once, and reuses them for every file
+            with ProcessPoolExecutor(max_workers=nb_workers, initializer=init_loaders) as executor:
+                for dcm in dcms:
                     # `visible` to False to not pollute output (only show on going voxelization)
                     tid2 = prb.add_task(f"Voxelizing {dcm.name}", visible=False, progress_type="voxel")
-                    futures.append(executor.submit(file2vox, dcm, plydir, voldir, infodir,
-                                                   vres, opath, _progress, tid2))
-                # Monitor the progress
-                while (n_done := sum([f.done() for f in futures])) < len(futures):
-                    prb.update(tid1, completed=n_done, total=len(futures))
-                    for tid, update_data in _progress.items():
-                        latest = update_data["progress"]
-                        tot = update_data["total"]
-                        prb.update(tid, completed=latest, total=tot, visible=(latest<tot))
-                for future in futures:
-                    future.result() # Raise any encountered errors
-
+                    futures.append(executor.submit(file2entry, index is not None, dcm, plydir,
+                                                   voldir, infodir, vres, opath, stages, storage,
+                                                   vox_opts, crop_input, sdf, resume, queue_depth,
+                                                   profile, channel, tid2))
+                    futures[-1].add_done_callback(lambda _: channel.done())
+                for future in as_completed(futures):
+                    hname, entry = future.result() # Raise any encountered errors
+                    # Only this process writes the index, as files are completed
+                    if entry is not None:
+                        index.update(hname, entry)
+            listener.stop()
+    if listener.timings:
+        print("Input frames throughput:")
+        print(format_stats(listener.timings))
+    if profile and not listener.profiles: # E.g. every file already complete, or excluded
+        print("No file processed, so no profile report.")
+    elif profile:
+        report = profile_report(listener.profiles)
+        with open(opath.joinpath("profile-report.json"), 'w') as fd:
+            json.dump(report, fd, indent=4)
+        stages = pd.DataFrame.from_dict(report["stages"], orient="index")
+        stages.to_csv(opath.joinpath("profile-report.csv"), index_label="stage")
+        print(stages.sort_values("total", ascending=False).to_string())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+"""
+Random access to the frames of pre-processed HDFs, for training. Plain numpy and
+iterators, so it fits in any framework's data loading.
+"""
+
+import h5py
+import numpy as np
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+
+from preprocess.index import DatasetIndex, key_frames
+from preprocess.layout import Grids
+from preprocess.pyramid import level_name
+
+
+
+class FilePool:
+    """ At most `max_open` HDFs kept open, the least recently used one is dropped first """
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, fname):
+        with self.lock:
+            if fname in self.files:
+                self.files.move_to_end(fname)
+                return self.files[fname]
+            if len(self.files) >= self.max_open:
+                # Not closed here, another thread may still be reading it. It's closed
+                # once nothing refers to it anymore.
+                self.files.popitem(last=False)
+            # Grids readers are kept along, they read metadata once opened
+            self.files[fname] = (h5py.File(fname, 'r'), {})
+            return self.files[fname]
+
+    def grids(self, fname, group):
+        hdf, grids = self.get(fname)
+        with self.lock:
+            if group not in grids:
+                grids[group] = Grids(hdf[group])
+            return grids[group]
+
+    def close(self):
+        with self.lock:
+            for hdf, _ in self.files.values():
+                hdf.close()
+            self.files.clear()
+
+
+class FrameCache:
+    """ Whole grids, the least recently used ones are dropped above `max_bytes` """
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.grids = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.grids:
+                return None
+            self.grids.move_to_end(key)
+            return self.grids[key]
+
+    def put(self, key, grid):
+        if grid.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.grids:
+                return
+            self.grids[key] = grid
+            self.nbytes += grid.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self.grids.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+
+class HDFDataset:
+    """
+    Frames of `fnames`, each sample being a dictionary with the grid of each of
+    `groups` (keyed by their lowercase name), the file name and the frame index.
+    - `selection` is `all` for every frame, or `ed-es` for key frames only. It can be
+      narrowed down to the frame indices of `frames`.
+    - `crop` is the shape of the random crop taken from each sample, only that part
+      is read from disk unless the frame is already cached.
+    - `level` is the factor of the pyramid level to read, the finest one if None.
+    Samples are drawn from `seed`, so runs are reproducible. Files found in `index` (a
+    `DatasetIndex`) aren't opened to list their samples. Grids are read-only, copy
+    them before changing them in place (e.g. for augmentation).
+    """
+    def __init__(self, fnames, selection="all", frames=None, groups=("Input", "GroundTruth"),
+                 crop=None, level=None, max_open=16, cache_bytes=2**30, seed=None, index=None):
+        self.groups = [g if level is None else f"{level_name(level)}/{g}" for g in groups]
+        self.keys = [g.lower() for g in groups]
+        self.crop = None if crop is None else np.asarray(crop)
+        self.pool = FilePool(max_open)
+        self.cache = FrameCache(cache_bytes)
+        self.rng = np.random.default_rng(seed)
+        # Only metadata is read to list samples
+        self.samples, self.shapes = [], {}
+        for fname in fnames:
+            entry = None if index is None else index.entries.get(Path(fname).stem)
+            if entry is None or (selection == "ed-es" and entry["keyFrames"] is None):
+                hdf, _ = self.pool.get(fname)
+                nbf = int(hdf["FrameInfo"]["frameNumber"][()])
+                selected = key_frames(hdf) if selection == "ed-es" else range(nbf)
+                self.shapes[fname] = np.array(self.pool.grids(fname, self.groups[0]).shape)
+            else:
+                selected = entry["keyFrames"] if selection == "ed-es" else range(entry["frames"])
+                # Same as `write_level_info`
+                self.shapes[fname] = np.array(entry["shape"]) // (1 if level is None else level)
+            if frames is not None:
+                selected = [f for f in selected if f in frames]
+            self.samples.extend((fname, f) for f in selected)
+
+    @classmethod
+    def from_index(cls, directory, query=None, **kwargs):
+        """
+        Files of the index of `directory`, narrowed down to the entries matching
+        `query` (a `pandas.DataFrame.query` expression, e.g. `"frames >= 25"`)
+        """
+        index = DatasetIndex(directory)
+        table = index.table()
+        if query is not None:
+            table = table.query(query)
+        fnames = [index.directory.joinpath(f) for f in table["file"]]
+        return cls(fnames, index=index, **kwargs)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def region(self, k):
+        """ Random crop of the `k`th sample, None if not cropping """
+        if self.crop is None:
+            return None
+        shape = self.shapes[self.samples[k][0]]
+        crop = np.minimum(self.crop, shape)
+        start = self.rng.integers(0, shape - crop + 1)
+        return tuple(slice(s, s + c) for s, c in zip(start, crop))
+
+    def _read(self, fname, group, frame, region):
+        grid = self.cache.get((fname, group, frame))
+        if grid is not None:
+            return grid if region is None else grid[region]
+        grid = self.pool.grids(fname, group).read(frame, region)
+        # Cached grids are shared between samples, so none can be changed (crops too, alike)
+        grid.setflags(write=False)
+        if region is None:
+            self.cache.put((fname, group, frame), grid)
+        return grid
+
+    def sample(self, k, region=None):
+        fname, frame = self.samples[k]
+        sample = { key: self._read(fname, group, frame, region)
+                   for key, group in zip(self.keys, self.groups) }
+        sample.update({ "file": fname, "frame": frame })
+        return sample
+
+    def __getitem__(self, k):
+        return self.sample(k, self.region(k))
+
+    def iterate(self, shuffle=True, prefetch=4, workers=2):
+        """
+        Yield every sample once, read by `workers` background threads that stay up
+        to `prefetch` samples ahead.
+        """
+        order = self.rng.permutation(len(self)) if shuffle else range(len(self))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for k in order:
+                # Crops are drawn here, the generator isn't shared between threads
+                pending.append(executor.submit(self.sample, k, self.region(k)))
+                if len(pending) > prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def __iter__(self):
+        return self.iterate()
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,77 @@
+"""
+Time spent in each stage of the pre-processing, per frame and per file.
+"""
+
+import numpy as np
+import time
+
+from contextlib import contextmanager, nullcontext
+
+
+
+class Profiler:
+    """ Record how long each `stage` takes, for each frame (-1 for the whole file) """
+    def __init__(self):
+        self.records = [] # (stage, frame, seconds)
+
+    @contextmanager
+    def stage(self, name, frame=-1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append((name, int(frame), time.perf_counter() - start))
+
+    def extend(self, records):
+        """ Add records made somewhere else, e.g. in another process """
+        self.records.extend(records)
+
+    def save(self, hdf):
+        """ Store records in the `/Profile` group of `hdf`, after those already there """
+        records = list(self.records)
+        if "Profile" in hdf: # From stages run before, keep them along
+            old = hdf["Profile"]
+            records = list(zip(old["stages"].asstr()[()], old["frames"][()], old["seconds"][()])) + records
+            del hdf["Profile"]
+        group = hdf.create_group("/Profile")
+        stages, frames, seconds = zip(*records) if records else ([], [], [])
+        group.create_dataset("stages", data=np.array(stages, dtype="S"))
+        group.create_dataset("frames", data=np.array(frames, dtype=int))
+        group.create_dataset("seconds", data=np.array(seconds, dtype=float))
+
+
+class NullProfiler:
+    """ Same interface as `Profiler`, but records nothing at (almost) no cost """
+    records = []
+    _null = nullcontext()
+
+    def stage(self, name, frame=-1):
+        return self._null
+
+    def extend(self, records):
+        pass
+
+    def save(self, hdf):
+        pass
+
+
+def profile_report(profiles, nslowest=10):
+    """
+    Aggregate records of several files, `profiles` being a dictionary of record lists
+    indexed by filename. Return total time and percentiles of each stage, and the
+    slowest files (according to their `file` stage).
+    """
+    per_stage = {}
+    for records in profiles.values():
+        for stage, _, seconds in records:
+            per_stage.setdefault(stage, []).append(seconds)
+    stages = {}
+    for stage, seconds in per_stage.items():
+        p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+        stages[stage] = { "total": float(np.sum(seconds)), "count": len(seconds),
+                          "p50": float(p50), "p90": float(p90), "p99": float(p99),
+                          "max": float(np.max(seconds)) }
+    totals = { name: sum(s for stage, _, s in records if stage == "file")
+               for name, records in profiles.items() }
+    slowest = sorted(totals.items(), key=lambda kv: kv[1], reverse=True)[:nslowest]
+    return { "stages": stages, "slowest": [{ "file": n, "seconds": s } for n, s in slowest] }
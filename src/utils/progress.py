@@ -1,4 +1,7 @@
 import rich.progress as rp
+import time
+
+from threading import Thread
 
 
 
@@ -26,3 +29,80 @@ class NestedProgress(rp.Progress):
                         rp.TimeRemainingColumn(elapsed_when_finished=True)
                         ]
             yield self.make_tasks_table([task])
+
+
+
+class ProgressChannel:
+    """
+    Send progress updates from workers to the process rendering them, through a
+    (picklable) queue. Used as `channel[tid] = { "progress": ..., "total": ... }`.
+    Updates of a task are sent at most every `interval` seconds, except the last one.
+    """
+    def __init__(self, queue, interval=0.5):
+        self.queue = queue
+        self.interval = interval
+        self._last = {} # Last time each task was updated, proper to each process
+
+    def __getstate__(self):
+        return { "queue": self.queue, "interval": self.interval }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __setitem__(self, tid, update):
+        now = time.monotonic()
+        if update["progress"] < update["total"] and now - self._last.get(tid, -self.interval) < self.interval:
+            return
+        self._last[tid] = now
+        self.queue.put(("progress", tid, int(update["progress"]), int(update["total"])))
+
+    def timing(self, stage, seconds, items=1):
+        """ Report `seconds` spent on `items` of `stage` """
+        self.queue.put(("timing", stage, seconds, items))
+
+    def profile(self, name, records):
+        """ Report profiling records of file `name` """
+        self.queue.put(("profile", name, records))
+
+    def done(self):
+        """ Report a finished job """
+        self.queue.put(("done",))
+
+
+class ProgressListener(Thread):
+    """
+    Render what's sent through a `ProgressChannel` queue, waking up only when
+    there's something new. Timings are accumulated per stage in `self.timings`, and
+    profiling records per file in `self.profiles`.
+    """
+    def __init__(self, queue, progress, tid, total):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.progress = progress
+        self.tid = tid # Task counting finished jobs
+        self.total = total
+        self.ndone = 0
+        self.timings = {}
+        self.profiles = {}
+
+    def run(self):
+        self.progress.update(self.tid, completed=0, total=self.total)
+        while (event := self.queue.get()) is not None:
+            if event[0] == "progress":
+                _, tid, latest, tot = event
+                self.progress.update(tid, completed=latest, total=tot, visible=(latest<tot))
+            elif event[0] == "timing":
+                _, stage, seconds, items = event
+                timing = self.timings.setdefault(stage, { "busy": 0., "items": 0 })
+                timing["busy"] += seconds
+                timing["items"] += items
+            elif event[0] == "profile":
+                _, name, records = event
+                self.profiles[name] = records
+            elif event[0] == "done":
+                self.ndone += 1
+                self.progress.update(self.tid, completed=self.ndone, total=self.total)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
@@ -0,0 +1,75 @@
+"""
+Synthetic acquisitions (closed meshes, grid description and image frames), to
+exercise the pre-processing without patient data nor Image3dAPI.
+"""
+
+import numpy as np
+import trimesh as tm
+
+from preprocess.sources import ArraySource
+
+
+
+def ellipsoid(radii, center, subdivisions=3):
+    mesh = tm.creation.icosphere(subdivisions=subdivisions)
+    mesh.vertices = mesh.vertices * radii + center
+    return mesh
+
+def deformed_sphere(radius, center, amplitude=0.15, subdivisions=3, seed=0):
+    """ Sphere with smooth random bumps, of at most `amplitude` times its radius """
+    rng = np.random.default_rng(seed)
+    mesh = tm.creation.icosphere(subdivisions=subdivisions)
+    # Sum of a few low frequency waves, so the surface stays smooth and closed
+    freqs, phases = rng.normal(size=(4, 3)) * 2, rng.uniform(0, 2 * np.pi, size=4)
+    bumps = np.sin(mesh.vertices @ freqs.T + phases).mean(axis=1)
+    mesh.vertices = mesh.vertices * radius * (1 + amplitude * bumps[:, None]) + center
+    return mesh
+
+def rv_like(scale, center, contraction=0., subdivisions=3):
+    """
+    Crescent shaped ventricle wrapped around a septum, shrunk by `contraction`
+    (0 at end of diastole, ~0.3 at end of systole).
+    """
+    mesh = tm.creation.icosphere(subdivisions=subdivisions)
+    v = mesh.vertices * [1.6, 1., 0.8]
+    # Push one side in, as if the left ventricle was pressing on it
+    v[:, 1] -= 0.6 * np.exp(-((v[:, 0] / 0.9) ** 2 + (v[:, 2] / 0.7) ** 2)) * v[:, 1].clip(0)
+    mesh.vertices = v * scale * (1 - contraction) + center
+    return mesh
+
+def rv_sequence(nbf, scale, center, subdivisions=3, max_contraction=0.3):
+    """ One heart beat of `rv_like` meshes, all sharing the same faces """
+    return [rv_like(scale, center, max_contraction * np.sin(np.pi * t / nbf) ** 2, subdivisions)
+            for t in range(nbf)]
+
+def write_plys(meshes, directory, prefix="synthetic"):
+    """ Store meshes as binary PLYs, named the way `ply2vox` expects them """
+    directory.mkdir(parents=True, exist_ok=True)
+    fnames = []
+    for i, mesh in enumerate(meshes):
+        fnames.append(directory.joinpath(f"{prefix}_{i:03d}.ply"))
+        mesh.export(fnames[-1], encoding="binary")
+    return fnames
+
+
+def volume_info(size, resolution, angle=0., origin=(0., 0., 0.)):
+    """
+    Grid description of a cube of `size` meter voxelized at `resolution`, rotated
+    by `angle` radians, with the same layout as `meshes.read_volume_info`.
+    """
+    rotation = tm.transformations.rotation_matrix(angle, [1, 1, 0])[:3, :3]
+    directions = rotation * size
+    resolution = np.array([resolution] * 3, dtype=float)
+    # Same as `dcm2vox`
+    shape = np.round(np.linalg.norm(directions, axis=1) / resolution).astype(int)
+    return { "VolumeInfo": { "shape": shape, "resolution": resolution,
+                             "origin": np.asarray(origin, dtype=float), "directions": directions } }
+
+def array_source(vinfo, nbf, seed=0):
+    """ Stand-in image source with random speckle frames on the grid `vinfo` """
+    rng = np.random.default_rng(seed)
+    vinfo = vinfo["VolumeInfo"]
+    frames = rng.integers(0, 256, size=(nbf, *vinfo["shape"]), dtype=np.uint8)
+    return ArraySource(frames, np.linspace(0, 1, nbf, endpoint=False), vinfo["origin"],
+                       vinfo["directions"], ecg_samples=rng.normal(size=500),
+                       ecg_times=np.array([0., 1.]))
@@ -0,0 +1,8 @@
+import sys
+
+from pathlib import Path
+
+
+
+# Modules are imported from `src/`, as scripts there do
+sys.path.insert(0, str(Path(__file__).parents[1].joinpath("src")))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from scipy.spatial.transform import Rotation
+
+from preprocess.affine import Affine
+
+
+
+def rotated_volume_info(seed=0):
+    """ Box of a different size along each axis, rotated, with anisotropic voxels """
+    rotation = Rotation.random(random_state=seed).as_matrix()
+    directions = rotation * np.array([0.04, 0.06, 0.05])[:, None] # One axis per row
+    resolution = np.array([0.0005, 0.001, 0.00075])
+    shape = np.round(np.linalg.norm(directions, axis=1) / resolution).astype(int)
+    return { "VolumeInfo": { "origin": np.array([0.01, -0.02, 0.03]), "directions": directions,
+                             "resolution": resolution, "shape": shape } }
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_round_trip(seed):
+    affine = Affine.from_volume_info(rotated_volume_info(seed))
+    idx = np.random.default_rng(seed).uniform(0, affine.shape, size=(5, 7, 3))
+    np.testing.assert_allclose(affine.to_voxel(affine.to_world(idx)), idx, atol=1e-9)
+    world = affine.to_world(idx)
+    np.testing.assert_allclose(affine.to_world(affine.to_voxel(world)), world, atol=1e-12)
+
+def test_steps_follow_directions():
+    vinfo = rotated_volume_info()["VolumeInfo"]
+    affine = Affine.from_volume_info({ "VolumeInfo": vinfo })
+    steps = affine.to_world(np.eye(3)) - affine.to_world(np.zeros(3))
+    np.testing.assert_allclose(np.linalg.norm(steps, axis=1), vinfo["resolution"])
+    # Step `i` goes along direction `i`
+    unit = vinfo["directions"] / np.linalg.norm(vinfo["directions"], axis=1)[:, None]
+    np.testing.assert_allclose(np.einsum("ij,ij->i", steps / vinfo["resolution"][:, None], unit), 1)
+    # Far corner of the grid is the far corner of the box
+    np.testing.assert_allclose(affine.to_world(affine.shape * 1.),
+                               vinfo["origin"] + vinfo["directions"].sum(axis=0),
+                               atol=max(vinfo["resolution"]))
+
+def test_bounds_clipped():
+    affine = Affine.from_volume_info(rotated_volume_info())
+    idx = np.array([[2.2, 3.7, 4.5], [10.1, 12.9, 8.]])
+    np.testing.assert_array_equal(affine.bounds(affine.to_world(idx)), [[2, 3, 4], [11, 13, 8]])
+    # Partly out of the grid on both sides
+    idx = np.array([[-5., 3.5, 2.5], [affine.shape[0] + 4., 5.5, affine.shape[2] + 0.5]])
+    np.testing.assert_array_equal(affine.bounds(affine.to_world(idx)),
+                                  [[0, 3, 2], [affine.shape[0] - 1, 6, affine.shape[2] - 1]])
+    # Entirely out of it
+    bounds = affine.bounds(affine.to_world(-np.ones((2, 3)) * 10))
+    np.testing.assert_array_equal(bounds, np.zeros((2, 3)))
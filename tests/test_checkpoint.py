@@ -0,0 +1,129 @@
+import h5py
+import numpy as np
+import pytest
+
+from click.testing import CliRunner
+from pathlib import Path
+
+import preprocessing
+from preprocess import dicoms, meshes
+from preprocess.checkpoint import Checkpoint
+from preprocess.layout import Grids, storage_options
+from utils.synthetic import array_source, rv_sequence, volume_info, write_plys
+
+
+
+NBF = 4
+
+
+class Progress(dict):
+    """ Stand-in of `ProgressChannel` """
+    def timing(self, stage, seconds, items=1):
+        pass
+
+    def profile(self, name, records):
+        pass
+
+
+def test_checkpoint_state(tmp_path):
+    path = tmp_path.joinpath("pat.h5.json")
+    checkpoint = Checkpoint(path)
+    checkpoint.mark("input", 0)
+    checkpoint.mark("input", 1)
+    checkpoint.mark("input")
+    checkpoint.mark("groundtruth", 0)
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.done("input") and resumed.frames("input") == [0, 1]
+    assert resumed.done("groundtruth", 0) and not resumed.done("groundtruth", 1)
+    assert not resumed.done("groundtruth")
+    resumed.reset("input")
+    assert not Checkpoint(path, resume=True).done("input", 0)
+    assert Checkpoint(path).state == { "stages": [], "frames": {} } # Not resuming
+    resumed.clear()
+    assert not path.exists()
+
+
+def make_acquisition(tmp_path, monkeypatch, patient="pat"):
+    """ DICOM directory (an extracted HDF, served by the stand-in loader) and its PLYs """
+    vinfo = volume_info(0.03, 0.001)
+    vinfo["VolumeInfo"]["origin"] = -vinfo["VolumeInfo"]["directions"].sum(axis=0) / 2
+    src = array_source(vinfo, NBF)
+    dcm = tmp_path.joinpath("dicoms", patient)
+    dcm.mkdir(parents=True)
+    monkeypatch.setattr(dicoms, "load_source", lambda fname: src)
+    with h5py.File(dcm.joinpath("acquisition.h5"), 'w') as hdf:
+        dicoms.dcm2vox(Path("dicom"), hdf, vinfo["VolumeInfo"]["resolution"])
+    monkeypatch.undo()
+    plydir = tmp_path.joinpath("plys")
+    write_plys(rv_sequence(NBF, 0.008, [0, 0, 0], subdivisions=2), plydir.joinpath(patient), "mesh")
+    return dcm, plydir, vinfo["VolumeInfo"]["resolution"]
+
+@pytest.fixture
+def acquisition(tmp_path, monkeypatch):
+    return make_acquisition(tmp_path, monkeypatch)
+
+def run(acquisition, opath, layout, resume, stages=tuple(preprocessing.STAGES)):
+    dcm, plydir, vres = acquisition
+    vox_opts = { "frame_workers": 1, "voxelizer": "scanline", "chunk_size": 4096,
+                 "incremental": False, "band_width": 1, "roi_margin": None, "memory_budget": None,
+                 "ply_cache": None, "store_meshes": False }
+    return preprocessing.file2vox(dcm, plydir, None, None, vres, opath,
+                                  list(stages), storage_options(layout), vox_opts,
+                                  False, None, resume, 2, False, Progress(), 0)
+
+
+@pytest.mark.parametrize("layout", ["frames", "stacked"])
+def test_resume_after_interruption(tmp_path, acquisition, monkeypatch, layout):
+    voxelized, stop = [], [2]
+    scanline = meshes.VOXELIZERS["scanline"]
+
+    def counted(hdf, mesh, **kwargs):
+        if len(voxelized) in stop:
+            raise KeyboardInterrupt # As if the run was stopped there
+        voxelized.append(mesh)
+        return scanline(hdf, mesh, **kwargs)
+
+    opath = tmp_path.joinpath("out")
+    opath.mkdir()
+    monkeypatch.setitem(meshes.VOXELIZERS, "scanline", counted)
+    with pytest.raises(KeyboardInterrupt):
+        run(acquisition, opath, layout, resume=False)
+    # Unfinished, and known to be so
+    assert not opath.joinpath("pat.h5").exists() and opath.joinpath("pat.h5.part").exists()
+    checkpoint = Checkpoint(opath.joinpath("pat.h5.json"), resume=True)
+    assert checkpoint.done("input") and checkpoint.frames("groundtruth") == [0, 1]
+    voxelized.clear()
+    stop.clear()
+    assert run(acquisition, opath, layout, resume=True) == opath.joinpath("pat.h5")
+    assert len(voxelized) == NBF - 2 # Only what was missing
+    assert not opath.joinpath("pat.h5.part").exists() and not opath.joinpath("pat.h5.json").exists()
+    # Same as a run that wasn't interrupted
+    monkeypatch.setitem(meshes.VOXELIZERS, "scanline", scanline)
+    whole = tmp_path.joinpath("whole")
+    whole.mkdir()
+    run(acquisition, whole, layout, resume=False)
+    with h5py.File(opath.joinpath("pat.h5"), 'r') as a, h5py.File(whole.joinpath("pat.h5"), 'r') as b:
+        for group in ["Input", "GroundTruth"]:
+            ga, gb = Grids(a[group]), Grids(b[group])
+            assert len(ga) == len(gb) == NBF
+            assert all(np.array_equal(ga[i], gb[i]) for i in range(NBF)), group
+            assert [ga.attrs(i).get("voxelCount") for i in range(NBF)] \
+                   == [gb.attrs(i).get("voxelCount") for i in range(NBF)]
+        np.testing.assert_array_equal(a["FrameInfo/frameTimes"][()], b["FrameInfo/frameTimes"][()])
+
+
+def test_stages_continue_dotted_patient(tmp_path, monkeypatch):
+    acquisition = make_acquisition(tmp_path, monkeypatch, "pat.01")
+    dcm, plydir, _ = acquisition
+    opath = tmp_path.joinpath("out")
+    opath.mkdir()
+    run(acquisition, opath, "frames", False, ["extract-input"])
+    assert opath.joinpath("pat.01.h5.part").exists()
+    # DICOMs aren't read anymore, the patient is found from the `.part` file
+    res = CliRunner().invoke(preprocessing.data2hdf, [str(plydir), str(plydir), "-o", str(opath),
+                                                     "-x", "scanline", "-s", "voxelize-gt",
+                                                     "-s", "attach-metadata"])
+    assert res.exit_code == 0, res.output
+    assert sorted(f.name for f in opath.iterdir()) == ["pat.01.h5"]
+    with h5py.File(opath.joinpath("pat.01.h5"), 'r') as hdf:
+        assert len(Grids(hdf["GroundTruth"])) == NBF
@@ -0,0 +1,43 @@
+import h5py
+import numpy as np
+import pytest
+
+from preprocess.layout import GridWriter
+from utils.dataset import HDFDataset
+
+
+
+@pytest.fixture
+def fname(tmp_path):
+    fname = tmp_path.joinpath("synthetic.h5")
+    rng = np.random.default_rng(0)
+    with h5py.File(fname, 'w') as hdf:
+        hdf.create_group("FrameInfo")["frameNumber"] = 2
+        for group, dtype in [("Input", np.uint8), ("GroundTruth", bool)]:
+            writer = GridWriter(hdf.create_group(group), 2)
+            for f in range(2):
+                writer.write(f, rng.integers(0, 2, size=(8, 10, 12)).astype(dtype))
+    return fname
+
+
+def test_cached_grids_unchanged(fname):
+    dataset = HDFDataset([fname])
+    first = dataset.sample(0)
+    expected = first["input"].copy()
+    cached = dataset.sample(0)
+    assert np.shares_memory(first["input"], cached["input"]) # Served from the cache
+    for sample in [first, cached, dataset.sample(0, (slice(2, 6),) * 3)]:
+        with pytest.raises(ValueError):
+            sample["input"] += 1
+    np.testing.assert_array_equal(dataset.sample(0)["input"], expected)
+    dataset.close()
+
+def test_crops_read_only(fname):
+    dataset = HDFDataset([fname], crop=(4, 4, 4), seed=0)
+    sample = dataset[1]
+    assert sample["groundtruth"].shape == (4, 4, 4)
+    assert not sample["groundtruth"].flags.writeable
+    # Copies can be augmented
+    x = sample["input"].copy()
+    x += 1
+    dataset.close()
@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+import pytest
+import threading
+
+from pathlib import Path
+
+from preprocess.dicoms import get_frames
+from preprocess.layout import Grids
+from preprocess.lookup_table import LUT
+from utils.synthetic import array_source, volume_info
+
+
+
+class Frame:
+    """ Frame recording which threads use it, as COM objects only allow their own """
+    def __init__(self, frame, threads):
+        object.__setattr__(self, "_frame", frame)
+        object.__setattr__(self, "_threads", threads)
+
+    def __getattr__(self, name):
+        self._threads.add(threading.get_ident())
+        return getattr(self._frame, name)
+
+    def __del__(self):
+        self._threads.add(threading.get_ident())
+
+class Source:
+    def __init__(self, src):
+        self.src = src
+        self.threads = set()
+        self.released = 0
+
+    def __getattr__(self, name):
+        return getattr(self.src, name)
+
+    def GetColorMap(self):
+        raise AttributeError # Served the default LUT, like the API may
+
+    def GetFrame(self, index, bbox=None, max_res=None):
+        self.threads.add(threading.get_ident())
+        return Frame(self.src.GetFrame(index, bbox, max_res), self.threads)
+
+
+@pytest.mark.parametrize("queue_depth", [1, 3])
+def test_frames_stay_on_fetch_thread(tmp_path, queue_depth):
+    nbf = 6
+    src = Source(array_source(volume_info(0.012, 0.001), nbf))
+    with h5py.File(tmp_path.joinpath("pat.h5"), 'w') as hdf:
+        hdf.create_group("VolumeInfo")
+        stats = get_frames(src, hdf, None, None, Path("dicoms", "pat", "acq"), queue_depth=queue_depth)
+        grids = Grids(hdf["Input"])
+        for f in range(nbf):
+            np.testing.assert_array_equal(grids[f], LUT[src.src.frames[f]])
+        np.testing.assert_allclose(hdf["FrameInfo/frameTimes"][()], src.src.times)
+    assert stats["lut"]["items"] == nbf
+    # Fetched, read and released on this thread only
+    assert src.threads == { threading.get_ident() }
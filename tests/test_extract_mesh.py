@@ -0,0 +1,105 @@
+import importlib.util
+import json
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from click.testing import CliRunner
+from pathlib import Path
+
+
+
+# Script name isn't a module name
+spec = importlib.util.spec_from_file_location(
+        "extract_mesh", Path(__file__).parents[1].joinpath("src", "preprocess", "extract-mesh.py"))
+extract_mesh = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(extract_mesh)
+
+# Stand-in of `PersistentStateLoader.exe`, behaving after the DICOM name
+STUB = f"""#!{sys.executable}
+import subprocess, sys, time
+from pathlib import Path
+dicom, output = Path(sys.argv[1]), Path(sys.argv[2])
+print("extracting", dicom.name, *sys.argv[3:])
+if "bad" in dicom.name:
+    sys.exit(3)
+if "slow" in dicom.name: # A child holding the pipes, as a tool starting helpers would
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    output.joinpath("child.pid").write_text(str(child.pid))
+    time.sleep(60)
+output.joinpath(dicom.name + ".ply").touch()
+"""
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    stub = tmp_path.joinpath("stub.py")
+    stub.write_text(STUB)
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    pdcm = tmp_path.joinpath("dicoms")
+    # Smallest DICOM is tried first
+    for patient, names in { "p1": ["a_bad", "b_good"], "p2": ["a_slow", "b_good"],
+                            "p3": ["a_bad"] }.items():
+        pdcm.joinpath(patient).mkdir(parents=True)
+        for size, name in enumerate(names, 1):
+            pdcm.joinpath(patient, name).write_bytes(b"\0" * size)
+    return stub, pdcm, tmp_path.joinpath("outputs")
+
+def invoke(stub, pdcm, pout, *args):
+    return CliRunner().invoke(extract_mesh.extract_mesh,
+                              [str(pdcm), "-o", str(pout), "-e", str(stub), "-V", "-t", "2", *args])
+
+def alive(pid, wait=5):
+    """ Whether process `pid` is still there after `wait` seconds at most """
+    for _ in range(int(wait / 0.1)):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        time.sleep(0.1)
+    return True
+
+def read_log(pout):
+    with open(pout.joinpath("extract-log.jsonl")) as fd:
+        return [json.loads(line) for line in fd]
+
+
+def test_fallback_and_timeout(dirs):
+    stub, pdcm, pout = dirs
+    start = time.perf_counter()
+    res = invoke(stub, pdcm, pout, "-n", "3")
+    assert time.perf_counter() - start < 30 # Children of the killed tool didn't hold it
+    assert not alive(int(pout.joinpath("p2", "child.pid").read_text())) # They're killed too
+    assert res.exit_code == 1 # p3 has no DICOM that works
+    assert "Failed: p3 (mesh)" in res.output
+    log = read_log(pout)
+    status = { (r["patient"], Path(r["dicom"]).name): r["status"] for r in log }
+    assert status == { ("p1", "a_bad"): "failed", ("p1", "b_good"): "ok",
+                       ("p2", "a_slow"): "timeout", ("p2", "b_good"): "ok",
+                       ("p3", "a_bad"): "failed" }
+    assert all("extracting" in r["stdout"] for r in log if r["status"] != "timeout")
+    for patient in ["p1", "p2"]:
+        assert pout.joinpath(patient, ".done-mesh").exists()
+        assert pout.joinpath(patient, "b_good.ply").exists()
+    assert not pout.joinpath("p3", ".done-mesh").exists()
+
+def test_rerun_skips_done(dirs):
+    stub, pdcm, pout = dirs
+    invoke(stub, pdcm, pout, "-n", "3")
+    before = len(read_log(pout))
+    res = invoke(stub, pdcm, pout)
+    assert "Skipping p1 (mesh)" in res.output and "Skipping p2 (mesh)" in res.output
+    # Only what failed is tried again
+    assert [r["patient"] for r in read_log(pout)[before:]] == ["p3"]
+    assert res.exit_code == 1
+
+def test_later_kinds_start_on_working_dicom(dirs):
+    stub, pdcm, pout = dirs
+    invoke(stub, pdcm, pout, "-d")
+    # End diastole is a job of its own, run after the meshes on the DICOM that worked
+    attempts = [Path(r["dicom"]).name for r in read_log(pout) if r["patient"] == "p1"]
+    assert attempts == ["a_bad", "b_good", "b_good"]
+    assert pout.joinpath("p1", ".done-ed").exists()
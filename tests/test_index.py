@@ -0,0 +1,45 @@
+import h5py
+import numpy as np
+import os
+
+from preprocess.index import DatasetIndex
+from preprocess.layout import GridWriter
+
+
+
+def write_file(hname):
+    with h5py.File(hname, 'w') as hdf:
+        hdf.create_group("FrameInfo")["frameNumber"] = 2
+        vinfo = hdf.create_group("VolumeInfo")
+        vinfo["shape"], vinfo["resolution"] = [4, 5, 6], [0.001] * 3
+        writer = GridWriter(hdf.create_group("GroundTruth"), 2)
+        for f in range(2):
+            writer.write(f, np.zeros((4, 5, 6), dtype=bool))
+
+
+def test_annotations_kept(tmp_path):
+    hname = tmp_path.joinpath("pat.h5")
+    write_file(hname)
+    index = DatasetIndex(tmp_path)
+    index.update(hname)
+    index.annotate("pat", { "efGrid": 0.5 })
+    index.save()
+    # Same content, indexed again
+    os.utime(hname, (0, 0))
+    index = DatasetIndex(tmp_path)
+    assert not index.uptodate(hname)
+    index.update(hname)
+    assert index["pat"]["efGrid"] == 0.5 and index.uptodate(hname)
+    index.update(hname, force=True)
+    assert index["pat"]["efGrid"] == 0.5
+
+def test_annotations_dropped(tmp_path):
+    hname = tmp_path.joinpath("pat.h5")
+    write_file(hname)
+    index = DatasetIndex(tmp_path)
+    index.update(hname)
+    index.annotate("pat", { "efGrid": 0.5 })
+    with h5py.File(hname, 'a') as hdf: # Re-processed
+        hdf["FrameInfo"]["frameTimes"] = [0., 0.1]
+    index.update(hname)
+    assert "efGrid" not in index["pat"]
@@ -0,0 +1,88 @@
+import h5py
+import importlib.util
+import numpy as np
+import pytest
+
+from click.testing import CliRunner
+from pathlib import Path
+
+from preprocess.index import DatasetIndex
+from preprocess.layout import LAYOUTS, GridWriter, Grids
+
+
+
+# Script name isn't a module name
+spec = importlib.util.spec_from_file_location(
+        "convert_layout", Path(__file__).parents[1].joinpath("src", "convert-layout.py"))
+convert_layout = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(convert_layout)
+
+SHAPE = (12, 10, 13) # Last axis isn't a whole number of bytes once bit-packed
+
+
+def frames(seed=0, nbf=3):
+    rng = np.random.default_rng(seed)
+    inputs = rng.integers(0, 256, size=(nbf, *SHAPE), dtype=np.uint8)
+    return inputs, inputs > 128
+
+def write_file(hname, layout, crop=None):
+    inputs, gt = frames()
+    crop = {} if crop is None else { "offset": crop[0], "full_shape": SHAPE }
+    box = tuple(slice(0, s) for s in SHAPE) if not crop else \
+          tuple(slice(o, o + s) for o, s in zip(crop["offset"], (8, 6, 9)))
+    with h5py.File(hname, 'w') as hdf:
+        hdf.create_group("FrameInfo")["frameNumber"] = len(gt)
+        vinfo = hdf.create_group("VolumeInfo")
+        vinfo["shape"], vinfo["resolution"] = SHAPE, [0.001] * 3
+        for name, grids in [("Input", inputs), ("GroundTruth", gt)]:
+            writer = GridWriter(hdf.create_group(name), len(grids), layout=layout, **crop)
+            for i, grid in enumerate(grids):
+                writer.write(i, grid[box], time=0.1 * i, voxelCount=grid[box].sum())
+    return box
+
+def check_file(hname, box):
+    inputs, gt = frames()
+    with h5py.File(hname, 'r') as hdf:
+        for name, expected in [("Input", inputs), ("GroundTruth", gt)]:
+            grids = Grids(hdf[name])
+            assert len(grids) == 3 and grids.shape == SHAPE and grids.dtype == expected.dtype
+            for i in range(3):
+                full = np.zeros(SHAPE, dtype=expected.dtype)
+                full[box] = expected[i][box]
+                np.testing.assert_array_equal(grids[i], full)
+                np.testing.assert_array_equal(grids.crop(i), expected[i][box])
+                region = (slice(2, 9), slice(None), slice(3, 12))
+                np.testing.assert_array_equal(grids.read(i, region), full[region])
+                assert grids.attrs(i)["time"] == pytest.approx(0.1 * i)
+                assert grids.attrs(i)["voxelCount"] == expected[i][box].sum()
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+@pytest.mark.parametrize("crop", [None, [[2, 4, 3]]])
+def test_round_trip(tmp_path, layout, crop):
+    hname = tmp_path.joinpath("pat.h5")
+    box = write_file(hname, layout, crop)
+    check_file(hname, box)
+    with h5py.File(hname, 'r') as hdf:
+        assert Grids(hdf["GroundTruth"]).layout == layout
+        if layout == "stacked": # Ground truth is bit-packed
+            assert hdf["GroundTruth/grids"].dtype == np.uint8
+            assert hdf["GroundTruth/grids"].shape[-1] == -(-(box[-1].stop - box[-1].start) // 8)
+
+@pytest.mark.parametrize("crop", [None, [[2, 4, 3]]])
+def test_convert_layout(tmp_path, crop):
+    hname = tmp_path.joinpath("pat.h5")
+    box = write_file(hname, "frames", crop)
+    DatasetIndex(tmp_path).update(hname)
+    for layout in ["stacked", "frames"]:
+        res = CliRunner().invoke(convert_layout.convert_layout, [str(tmp_path), "-l", layout, "-z", "gzip"])
+        assert res.exit_code == 0, res.output
+        with h5py.File(hname, 'r') as hdf:
+            assert Grids(hdf["Input"]).layout == layout
+            assert hdf["FrameInfo/frameNumber"][()] == 3 # Copied as is
+        check_file(hname, box)
+        index = DatasetIndex(tmp_path)
+        assert index["pat"]["layout"] == layout and index.uptodate(hname)
+        with index.open() as vhdf: # Virtual datasets follow the new layout
+            np.testing.assert_array_equal(Grids(vhdf["pat/GroundTruth"]).crop(1), frames()[1][1][box])
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,63 @@
+import numpy as np
+import tracemalloc
+
+from types import SimpleNamespace
+
+from preprocess.lookup_table import LUT
+from preprocess.utils import apply_lut, frame2arr, frame2view
+
+
+
+def strided_frame(dims=(24, 16, 10), pad=(5, 3), seed=0):
+    """
+    Frame as Image3dAPI gives it: a flat buffer going along the first axis first,
+    with padding after each row and each slice. Return it and the voxels it holds.
+    """
+    rng = np.random.default_rng(seed)
+    voxels = rng.integers(0, 256, size=dims, dtype=np.uint8)
+    stride0 = dims[0] + pad[0]
+    stride1 = stride0 * dims[1] + pad[1]
+    data = rng.integers(0, 256, size=stride1 * dims[2], dtype=np.uint8) # Padding is garbage
+    for j in range(dims[1]):
+        for k in range(dims[2]):
+            data[k * stride1 + j * stride0:][:dims[0]] = voxels[:, j, k]
+    return SimpleNamespace(data=data, dims=dims, stride0=stride0, stride1=stride1), voxels
+
+
+def test_frame2view_strides():
+    frame, voxels = strided_frame()
+    view = frame2view(frame)
+    assert np.shares_memory(view, frame.data)
+    np.testing.assert_array_equal(view, voxels)
+
+def test_apply_lut_matches_copy():
+    frame, _ = strided_frame()
+    view = frame2view(frame)
+    out = np.empty(view.shape, dtype=LUT.dtype)
+    scratch = np.empty(view.shape[1:], dtype=np.intp)
+    res = apply_lut(view, LUT, out, scratch)
+    assert res is out
+    np.testing.assert_array_equal(res, LUT[frame2arr(frame)])
+    # Allocating its own buffers gives the same
+    np.testing.assert_array_equal(apply_lut(view, LUT), res)
+
+def test_apply_lut_allocates_nothing():
+    frame, _ = strided_frame(dims=(64, 48, 32))
+    view = frame2view(frame)
+    out = np.empty(view.shape, dtype=LUT.dtype)
+    scratch = np.empty(view.shape[1:], dtype=np.intp)
+    apply_lut(view, LUT, out, scratch) # Warm up
+    tracemalloc.start()
+    try:
+        # Numpy allocations are traced, the old path does show up
+        LUT[frame2arr(frame)]
+        _, copied = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in range(10):
+            apply_lut(view, LUT, out, scratch)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert copied > out.nbytes
+    assert peak - start < 4096
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import struct
+
+from preprocess.plyio import full_load_ply, ply_bounds, read_ply
+from utils.synthetic import rv_like, write_plys
+
+
+
+def write_polygons(fname, vertices, faces):
+    """ Binary PLY with faces of any size, which `read_ply` can't map """
+    header = (f"ply\nformat binary_little_endian 1.0\nelement vertex {len(vertices)}\n"
+              "property float x\nproperty float y\nproperty float z\n"
+              f"element face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n")
+    body = np.asarray(vertices, dtype="<f4").tobytes()
+    body += b"".join(struct.pack(f"<B{len(f)}i", len(f), *f) for f in faces)
+    fname.write_bytes(header.encode() + body)
+    return fname
+
+CUBE = [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0], [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]]
+QUADS = [[0, 3, 2, 1], [4, 5, 6, 7], [0, 1, 5, 4], [1, 2, 6, 5], [2, 3, 7, 6], [3, 0, 4, 7]]
+
+
+def full_load(fname):
+    with open(fname, "br") as fd:
+        return full_load_ply(fd, prefer_color="face")
+
+def assert_same(kwargs, expected):
+    """ Same mesh arrays, Trimesh also gives its raw elements as metadata """
+    assert set(kwargs) <= set(expected)
+    for key, value in kwargs.items():
+        if key == "metadata":
+            continue
+        if value is None:
+            assert expected[key] is None, key
+        else:
+            np.testing.assert_array_equal(value, expected[key], err_msg=key)
+
+
+def test_read_ply_matches_trimesh(tmp_path):
+    fname, = write_plys([rv_like(0.01, [0.02, 0.03, 0.04])], tmp_path)
+    kwargs = read_ply(fname)
+    assert_same(kwargs, full_load(fname))
+    np.testing.assert_array_equal(ply_bounds(fname), [kwargs["vertices"].min(axis=0),
+                                                      kwargs["vertices"].max(axis=0)])
+
+def test_quads_fall_back(tmp_path):
+    fname = write_polygons(tmp_path.joinpath("quads.ply"), CUBE, QUADS)
+    assert_same(read_ply(fname), full_load(fname))
+
+@pytest.mark.parametrize("faces", [QUADS[:2], [[0, 3, 2], [0, 2, 1]] + QUADS[1:]])
+def test_bad_bodies_fall_back(tmp_path, faces):
+    """ Truncated, or mixed polygons: whatever Trimesh makes of it, not a numpy error """
+    fname = write_polygons(tmp_path.joinpath("bad.ply"), CUBE, faces)
+    if len(faces) == 2: # Cut in the middle of the vertices
+        fname.write_bytes(fname.read_bytes()[:-len(faces) * 17 - 40])
+    with pytest.raises(Exception) as expected:
+        full_load(fname)
+    with pytest.raises(type(expected.value), match=str(expected.value)):
+        read_ply(fname)
+    if len(faces) == 2:
+        with pytest.raises(type(expected.value)):
+            ply_bounds(fname)
+    else: # Vertices come first and are all there
+        np.testing.assert_array_equal(ply_bounds(fname), [[0, 0, 0], [1, 1, 1]])
+
+def test_full_load_ply_still_in_meshes():
+    # It lived there before `plyio`, scripts may still import it from there
+    from preprocess import meshes
+    assert meshes.full_load_ply is full_load_ply
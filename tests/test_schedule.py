@@ -0,0 +1,66 @@
+import h5py
+import numpy as np
+import pytest
+
+from pathlib import Path
+
+from preprocess import dicoms, schedule
+from preprocess.schedule import job_cost, longest_first, worker_count
+from utils.synthetic import array_source, rv_sequence, volume_info, write_plys
+
+
+
+def test_longest_first(tmp_path):
+    # Larger meshes and more frames cost more
+    for patient, (nbf, scale) in { "small": (4, 0.01), "long": (8, 0.01), "large": (4, 0.02),
+                                   "tie": (4, 0.01) }.items():
+        write_plys(rv_sequence(nbf, scale, [0, 0, 0], subdivisions=2), tmp_path.joinpath(patient))
+    tmp_path.joinpath("empty").mkdir()
+    jobs = ["empty", "small", "long", "tie", "large", "missing"]
+    costs = [job_cost(tmp_path.joinpath(j), 0.001) for j in jobs]
+    assert costs[0] == costs[-1] == 0
+    assert costs[1] == costs[3] and 0 < costs[1] < costs[2] and costs[2] == pytest.approx(2 * costs[1])
+    # Ties keep their order
+    assert longest_first(jobs, costs) == ["large", "long", "small", "tie", "empty", "missing"]
+
+
+@pytest.fixture
+def extracted(tmp_path, monkeypatch):
+    """ Input of a synthetic acquisition, as `extract-input` leaves it """
+    vinfo = volume_info(0.02, 0.001)
+    src = array_source(vinfo, 3)
+    monkeypatch.setattr(dicoms, "load_source", lambda fname: src)
+    fname = tmp_path.joinpath("acquisition.h5")
+    with h5py.File(fname, 'w') as hdf:
+        dicoms.dcm2vox(Path("dicom"), hdf, vinfo["VolumeInfo"]["resolution"])
+    monkeypatch.undo()
+    return fname
+
+def test_loaders_reused(extracted, tmp_path, monkeypatch):
+    monkeypatch.setattr(dicoms, "_LOADERS", {})
+    dicoms.init_loaders()
+    loader = dicoms.get_loader("hdf")
+    assert dicoms.get_loader("hdf") is loader and loader.loaded == 0
+    for i in range(2):
+        with h5py.File(tmp_path.joinpath(f"out{i}.h5"), 'w') as hdf:
+            dicoms.dcm2vox(extracted, hdf, np.full(3, 0.001))
+    assert dicoms.get_loader("hdf") is loader and loader.loaded == 2
+    with h5py.File(extracted) as src, h5py.File(tmp_path.joinpath("out1.h5")) as out:
+        assert (out["VolumeInfo/shape"][()] == src["VolumeInfo/shape"][()]).all()
+        assert all((out[f"Input/{k}"][()] == src[f"Input/{k}"][()]).all() for k in src["Input"])
+        # Known before forking workers, without keeping a loader
+        assert (dicoms.input_shape(extracted, np.full(3, 0.001)) == out["VolumeInfo/shape"][()]).all()
+        assert loader.loaded == 2
+    loader.source.close()
+
+def test_worker_count(monkeypatch):
+    monkeypatch.setattr(schedule, "available_memory", lambda: 10 * (2**30 + schedule.WORKER_OVERHEAD))
+    monkeypatch.setattr(schedule.os, "cpu_count", lambda: 64)
+    assert worker_count(2**30) == 10
+    assert worker_count(2**30, 2**30) < 10
+    assert worker_count(2**34, 2**30) == 1 # At least one, whatever the budget
+    # No more than CPUs, nor files
+    monkeypatch.setattr(schedule.os, "cpu_count", lambda: 4)
+    assert worker_count(2**20) == 4
+    assert worker_count(2**20, nb_jobs=3) == 3
+    assert worker_count(2**20, nb_jobs=0) == 1
@@ -0,0 +1,53 @@
+import h5py
+import numpy as np
+import pytest
+
+from preprocess.affine import Affine
+from preprocess.layout import GridWriter, Grids
+from preprocess.meshes import _write_grid, slab_rows, stream_frames, voxelize_frames
+from preprocess.pyramid import alignment
+from preprocess.sequence import MeshSequence
+from utils.synthetic import rv_sequence, volume_info
+
+
+
+@pytest.fixture(scope="module")
+def acquisition():
+    vinfo = volume_info(0.04, 0.001, angle=0.3)
+    vinfo["VolumeInfo"]["origin"] = -vinfo["VolumeInfo"]["directions"].sum(axis=0) / 2
+    meshes = MeshSequence.from_meshes(range(3), rv_sequence(3, 0.009, [0, 0, 0], subdivisions=3))
+    return vinfo, meshes
+
+def read_all(group):
+    grids = Grids(group)
+    return [grids[i] for i in range(len(grids))], [grids.attrs(i)["voxelCount"] for i in range(len(grids))]
+
+
+@pytest.mark.parametrize("layout", ["frames", "stacked"])
+@pytest.mark.parametrize("roi", [False, True])
+def test_stream_same_as_in_memory(tmp_path, acquisition, layout, roi):
+    vinfo, meshes = acquisition
+    pyramid = (2,)
+    align = alignment(pyramid)
+    bounds, crop = None, {}
+    if roi:
+        affine = Affine.from_volume_info(vinfo)
+        bounds = meshes.roi(affine, 1, align)
+        crop = { "offset": bounds[0], "full_shape": affine.shape }
+    box = bounds if roi else np.stack([np.zeros(3, dtype=int), vinfo["VolumeInfo"]["shape"]])
+    budget = 5 * np.prod(box[1, 1:] - box[0, 1:]) * 24 # A few rows at once
+    assert slab_rows(box, "scanline", budget, align) < (box[1, 0] - box[0, 0]) // 2
+    with h5py.File(tmp_path.joinpath("grids.h5"), 'w') as hdf:
+        writer = GridWriter(hdf.create_group("Memory"), 3, layout=layout, pyramid=pyramid, **crop)
+        for i, (grid, tested) in enumerate(voxelize_frames(meshes, vinfo, "scanline", bounds=bounds)):
+            _write_grid(writer, i, grid, tested)
+        # Pyramid levels are other groups of the same file, keep them apart
+        writer = GridWriter(hdf.create_group("Slabs/Memory"), 3, layout=layout, pyramid=pyramid, **crop)
+        assert list(stream_frames(meshes, vinfo, writer, range(3), bounds, "scanline",
+                                  memory_budget=budget, align=align)) == [0, 1, 2]
+        for level in ["", "Pyramid/x2/"]:
+            memory, counts = read_all(hdf[f"{level}Memory"])
+            slabs, slab_counts = read_all(hdf[f"{level}Slabs/Memory"])
+            assert all(g.any() for g in memory)
+            assert all(np.array_equal(m, s) for m, s in zip(memory, slabs)), level
+            np.testing.assert_array_equal(counts, slab_counts)
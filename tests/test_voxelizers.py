@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from preprocess.affine import Affine
+from preprocess.meshes import VOXELIZERS, mesh2vox, mesh2vox_incremental, mesh2vox_scanline
+from utils.synthetic import deformed_sphere, ellipsoid, rv_like, rv_sequence, volume_info
+
+
+
+@pytest.fixture(scope="module")
+def meshes():
+    return rv_sequence(4, 0.009, [0, 0, 0], subdivisions=3)
+
+def grid_info(angle=0.):
+    """ Box centered on the meshes """
+    vinfo = volume_info(0.04, 0.001, angle=angle)
+    vinfo["VolumeInfo"]["origin"] = -vinfo["VolumeInfo"]["directions"].sum(axis=0) / 2
+    return vinfo
+
+
+@pytest.mark.parametrize("mesh", [ellipsoid([0.012, 0.009, 0.007], [0.001, -0.002, 0.]),
+                                  deformed_sphere(0.01, [0, 0, 0.001]), rv_like(0.009, [0, 0, 0])],
+                         ids=["ellipsoid", "deformed", "rv"])
+@pytest.mark.parametrize("angle", [0., 0.4])
+def test_scanline_agrees_with_contains(mesh, angle):
+    vinfo = grid_info(angle)
+    scanline = mesh2vox_scanline(vinfo, mesh)
+    contains = mesh2vox(vinfo, mesh)
+    # Only voxels whose center is (nearly) on the surface may differ
+    assert (scanline != contains).sum() <= 0.01 * contains.sum()
+    voxel = abs(np.linalg.det(Affine.from_volume_info(vinfo).delta))
+    assert scanline.sum() * voxel == pytest.approx(mesh.volume, rel=0.05)
+    # On a closed mesh, both rules see the same inside
+    np.testing.assert_array_equal(mesh2vox_scanline(vinfo, mesh, rule="winding"), scanline)
+    # Regions are crops of the whole grid
+    region = np.array([[5, 12, 0], [30, 25, 40]])
+    for voxelizer, grid in [("scanline", scanline), ("contains", contains)]:
+        crop = VOXELIZERS[voxelizer](vinfo, mesh, region=region)
+        assert (crop != grid[5:30, 12:25]).sum() <= (0 if voxelizer == "scanline" else 0.01 * crop.sum())
+
+@pytest.mark.parametrize("voxelizer, angle", [("scanline", 0.), ("scanline", 0.4), ("contains", 0.4)])
+def test_incremental_same_as_full(meshes, voxelizer, angle):
+    vinfo = grid_info(angle)
+    affine = Affine.from_volume_info(vinfo)
+    grid = np.zeros(affine.shape, dtype=bool)
+    for mesh in meshes:
+        grid, tested = mesh2vox_incremental(vinfo, mesh, grid, voxelizer=voxelizer, affine=affine)
+        full = VOXELIZERS[voxelizer](vinfo, mesh, affine=affine)
+        assert 0 < tested < full.size # Not a fallback
+        assert not full[[0, -1]].any() and not full[:, [0, -1]].any() and not full[..., [0, -1]].any()
+        if voxelizer == "scanline": # Same rays
+            np.testing.assert_array_equal(grid, full)
+        else: # Rays cast by `contains` go either way on points (nearly) on the surface
+            assert (grid != full).sum() <= 0.01 * full.sum()